@@ -1,17 +1,22 @@
 import os
-import requests
 import json
 from datetime import datetime
-from src.models.user import User, Transaction
+from src.models.transaction import ledger
+from src.models.user import REFERRAL_SIGNUP_BONUS, User
+from src.telegram_api import outbox_for
+from src.telegram_updates import UpdateDispatcher
+
+BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 
 class TelegramBot:
     def __init__(self, token):
         self.token = token
-        self.base_url = f"https://api.telegram.org/bot{token}"
+        # Sends go through a queue shared by every bot with this token
+        self.outbox = outbox_for(token)
+        self.api = self.outbox.api
         
     def send_message(self, chat_id, text, reply_markup=None):
-        """Send a message to a Telegram chat"""
-        url = f"{self.base_url}/sendMessage"
+        """Queue a message to a Telegram chat; wait() on the result for the sent message"""
         data = {
             'chat_id': chat_id,
             'text': text,
@@ -20,12 +25,10 @@ class TelegramBot:
         if reply_markup:
             data['reply_markup'] = json.dumps(reply_markup)
         
-        response = requests.post(url, data=data)
-        return response.json()
+        return self.outbox.enqueue('sendMessage', data, chat_id=chat_id)
     
     def send_photo(self, chat_id, photo_path, caption=None, reply_markup=None):
-        """Send a photo to a Telegram chat"""
-        url = f"{self.base_url}/sendPhoto"
+        """Queue a photo to a Telegram chat"""
         data = {
             'chat_id': chat_id,
             'caption': caption or '',
@@ -34,17 +37,30 @@ class TelegramBot:
         if reply_markup:
             data['reply_markup'] = json.dumps(reply_markup)
         
+        # Read now so a retried send has the same bytes
         with open(photo_path, 'rb') as photo:
-            files = {'photo': photo}
-            response = requests.post(url, data=data, files=files)
-        return response.json()
+            files = {'photo': (os.path.basename(photo_path), photo.read())}
+        return self.outbox.enqueue('sendPhoto', data, files, chat_id=chat_id)
     
     def get_user_profile_photos(self, user_id):
         """Get user profile photos"""
-        url = f"{self.base_url}/getUserProfilePhotos"
-        data = {'user_id': user_id, 'limit': 1}
-        response = requests.post(url, data=data)
-        return response.json()
+        return self.api.call('getUserProfilePhotos', {'user_id': user_id, 'limit': 1})
+    
+    def handle_update(self, update):
+        """Route an incoming update to its handler"""
+        message = update.get('message')
+        if message and 'from' in message:
+            text = message.get('text') or ''
+            # Commands may be addressed to the bot, as in /start@AlphaWulfBot
+            command = text.split()[0].split('@')[0] if text.startswith('/') else None
+            if command == '/start':
+                self.handle_start_command(message)
+            elif command == '/balance':
+                self.handle_balance_command(message)
+            elif command == '/help':
+                self.handle_help_command(message)
+        elif 'callback_query' in update:
+            self.handle_callback_query(update['callback_query'])
     
     def create_inline_keyboard(self, buttons):
         """Create inline keyboard markup"""
@@ -74,34 +90,26 @@ class TelegramBot:
                 telegram_id=telegram_id,
                 username=user_data.get('username'),
                 first_name=user_data.get('first_name'),
-                last_name=user_data.get('last_name'),
                 coins=2500,  # Welcome bonus
                 energy=100
             )
-            user.save()
-            
-            # Log welcome bonus transaction
-            transaction = Transaction(
-                user_id=user.id,
-                transaction_type='welcome',
-                amount=2500,
-                description='Welcome bonus'
-            )
-            transaction.save()
             
-            # Process referral if exists
+            # Referred users are created and the referrer credited in one atomic step
+            referred_user = None
             if referrer_id and referrer_id != telegram_id:
                 try:
-                    import requests
-                    webhook_url = os.getenv("WEBHOOK_URL", "https://alphawulf-backend-gfgy.onrender.com")
-                    referral_url = f"{webhook_url}/api/process_referral"
-                    requests.post(referral_url, json={
-                                    "referrer_telegram_id": referrer_id,
-                                    "referred_telegram_id": telegram_id
-                                })
+                    _, referred_user, _ = User.apply_referral(referrer_id, telegram_id, *REFERRAL_SIGNUP_BONUS, new_user=user)
                 except Exception as e:
                     print(f"Failed to process referral: {e}")
             
+            if referred_user:
+                user = referred_user
+            else:
+                user.save()
+            
+            # Log welcome bonus transaction
+            ledger.record(user.telegram_id, "welcome", 2500, "Welcome bonus")
+            
             welcome_text = f"""🐺 <b>Welcome to Alpha Wulf!</b> 🐺
 
 Hello {user.first_name or 'Alpha'}! 
@@ -117,11 +125,11 @@ Hello {user.first_name or 'Alpha'}!
 
 Ready to become the Alpha? Let's start tapping! 🚀"""
         else:
-            user.update_energy()  # Update energy based on time passed
+            energy = int(user.current_energy())  # Derived from time passed, nothing is written
             welcome_text = f"""🐺 <b>Welcome back, Alpha {user.first_name or 'Wolf'}!</b> 🐺
 
 💰 Coins: <b>{user.coins:,}</b>
-⚡ Energy: <b>{user.energy}/{user.max_energy}</b>
+⚡ Energy: <b>{energy}/{user.max_energy}</b>
 💪 Tap Power: <b>{user.tap_power}</b>
 
 Ready to continue your hunt? 🎯"""
@@ -150,19 +158,15 @@ Ready to continue your hunt? 🎯"""
             self.send_message(message['chat']['id'], "Please start the bot first with /start")
             return
         
-        user.update_energy()
+        energy = int(user.current_energy())  # Derived from time passed, nothing is written
         
         balance_text = f"""🐺 <b>Alpha {user.first_name or 'Wolf'} Stats</b> 🐺
 
 💰 <b>Wolf Coins:</b> {user.coins:,}
-⚡ <b>Energy:</b> {user.energy}/{user.max_energy}
+⚡ <b>Energy:</b> {energy}/{user.max_energy}
 💪 <b>Tap Power:</b> {user.tap_power} coins per tap
 🔋 <b>Energy Regen:</b> {user.energy_regen_rate}/min
 
-📊 <b>Lifetime Stats:</b>
-• Total Earned: {user.total_earned:,} coins
-• Total Withdrawn: ₹{user.total_withdrawn:,}
-
 🎯 Keep tapping to earn more coins!"""
         
         keyboard = self.create_inline_keyboard([
@@ -237,6 +241,8 @@ Need more help? Contact @AlphaWulfSupport"""
         # Add more callback handlers as needed
         
         # Answer the callback query to remove loading state
-        answer_url = f"{self.base_url}/answerCallbackQuery"
-        requests.post(answer_url, data={'callback_query_id': callback_query['id']})
+        self.outbox.enqueue('answerCallbackQuery', {'callback_query_id': callback_query['id']})
 
+bot = TelegramBot(BOT_TOKEN)
+# Updates from the webhook or the poller, handled in order per chat
+update_dispatcher = UpdateDispatcher(bot.handle_update)
@@ -0,0 +1,546 @@
+-- Database functions used by the backend.
+-- Run this in the Supabase SQL editor after creating the tables listed in
+-- src/config/database.py. The backend falls back to compare-and-swap
+-- updates when these functions are missing, at the cost of extra round trips.
+
+-- Energy a user holds at p_now, including regeneration (1 unit per 30s per regen level)
+create or replace function user_regenerated_energy(u users, p_now bigint)
+returns double precision
+language sql stable as $$
+    select case
+        when u.last_energy_update is null then u.energy::double precision
+        else least(
+            u.max_energy::double precision,
+            u.energy + greatest(p_now - u.last_energy_update, 0) / 30.0 * u.energy_regen_rate
+        )
+    end;
+$$;
+
+-- Spend up to p_taps energy and credit tap_power coins per accepted tap.
+-- Returns the user row plus an "accepted" key, or null if the user does not exist.
+create or replace function user_tap(p_telegram_id text, p_taps integer, p_now bigint)
+returns jsonb
+language plpgsql as $$
+declare
+    u users%rowtype;
+    v_energy double precision;
+    v_accepted integer;
+begin
+    select * into u from users where telegram_id = p_telegram_id for update;
+    if not found then
+        return null;
+    end if;
+
+    v_energy := user_regenerated_energy(u, p_now);
+    v_accepted := greatest(0, least(p_taps, floor(v_energy)::integer));
+
+    if v_accepted > 0 then
+        update users
+           set coins = coins + v_accepted * tap_power,
+               energy = v_energy - v_accepted,
+               last_energy_update = p_now
+         where id = u.id
+        returning * into u;
+    else
+        -- Nothing spent, report the regenerated energy without writing it
+        u.energy := v_energy;
+        u.last_energy_update := p_now;
+    end if;
+
+    return to_jsonb(u) || jsonb_build_object('accepted', v_accepted);
+end;
+$$;
+
+-- Add deltas to a user's balance and upgrade levels in one statement.
+-- p_min_coins guards debits (coins >= p_min_coins before applying),
+-- p_clamp_coins floors the balance at zero and p_expect maps fields to the
+-- values the change was priced against. Returns no row when a guard fails.
+create or replace function user_apply_delta(
+    p_telegram_id text,
+    p_coins bigint default 0,
+    p_min_coins bigint default null,
+    p_clamp_coins boolean default false,
+    p_tap_power integer default 0,
+    p_max_energy integer default 0,
+    p_energy_regen_rate double precision default 0,
+    p_expect jsonb default '{}'::jsonb,
+    p_now bigint default extract(epoch from now())::bigint
+)
+returns setof users
+language plpgsql as $$
+declare
+    u users%rowtype;
+begin
+    select * into u from users where telegram_id = p_telegram_id for update;
+    if not found then
+        return;
+    end if;
+
+    if p_min_coins is not null and u.coins < p_min_coins then
+        return;
+    end if;
+
+    if (p_expect ? 'tap_power' and u.tap_power <> (p_expect->>'tap_power')::double precision)
+       or (p_expect ? 'max_energy' and u.max_energy <> (p_expect->>'max_energy')::double precision)
+       or (p_expect ? 'energy_regen_rate' and u.energy_regen_rate <> (p_expect->>'energy_regen_rate')::double precision) then
+        return;
+    end if;
+
+    -- Settle regenerated energy before capacity or rate changes
+    if p_max_energy <> 0 or p_energy_regen_rate <> 0 then
+        u.energy := user_regenerated_energy(u, p_now);
+        u.last_energy_update := p_now;
+    end if;
+
+    return query
+    update users
+       set coins = case when p_clamp_coins then greatest(0, u.coins + p_coins) else u.coins + p_coins end,
+           tap_power = u.tap_power + p_tap_power,
+           max_energy = u.max_energy + p_max_energy,
+           energy_regen_rate = u.energy_regen_rate + p_energy_regen_rate,
+           energy = u.energy,
+           last_energy_update = u.last_energy_update
+     where id = u.id
+    returning *;
+end;
+$$;
+
+-- Apply buffered tap deltas for many users in one statement (write-behind flush).
+-- p_deltas is a JSON array of {"telegram_id", "coins", "energy"}: coins earned
+-- and energy spent since the previous flush.
+create or replace function user_apply_tap_deltas(p_deltas jsonb, p_now bigint)
+returns setof users
+language sql as $$
+    update users u
+       set coins = u.coins + d.coins,
+           energy = greatest(0, user_regenerated_energy(u, p_now) - d.energy),
+           last_energy_update = p_now
+      from jsonb_to_recordset(p_deltas) as d(telegram_id text, coins bigint, energy double precision)
+     where u.telegram_id = d.telegram_id
+    returning u.*;
+$$;
+
+-- Append-only referrer bonuses. Signup bursts under one referrer insert rows
+-- here instead of all updating the referrer's users row.
+create table if not exists referral_credits (
+    id bigserial primary key,
+    referrer_id text not null,
+    coins bigint not null default 0,
+    referral_count integer not null default 0,
+    referral_earnings bigint not null default 0,
+    created_at bigint not null
+);
+create index if not exists idx_referral_credits_referrer on referral_credits (referrer_id);
+
+-- A user can be referred once. Databases from before the unique index may
+-- hold duplicates; the first run keeps the first record of each and reports
+-- how many it removed. Once the index exists, re-running this never deletes.
+do $$
+declare
+    removed integer;
+begin
+    if to_regclass('idx_referred_users_user') is null then
+        delete from referred_users a
+         using referred_users b
+         where a.user_id = b.user_id
+           and a.id > b.id;
+        get diagnostics removed = row_count;
+        raise notice 'Removed % duplicate referred_users rows before adding idx_referred_users_user', removed;
+    end if;
+end;
+$$;
+create unique index if not exists idx_referred_users_user on referred_users (user_id);
+
+-- Credit a referral of p_telegram_id by p_referrer_id exactly once. Creates
+-- the referee from p_new_user if missing, records the referred_users row
+-- (the unique index above makes it the claim), sets referred_by and adds both
+-- bonuses. Returns {"status", "user", "referrer"}; status is applied,
+-- duplicate, already_referred or invalid_referrer.
+create or replace function apply_referral(
+    p_referrer_id text,
+    p_telegram_id text,
+    p_new_user jsonb,
+    p_referee_bonus bigint,
+    p_referrer_bonus bigint,
+    p_now bigint
+)
+returns jsonb
+language plpgsql as $$
+declare
+    r users%rowtype;
+    u users%rowtype;
+    v_claim bigint;
+begin
+    select * into r from users where telegram_id = p_referrer_id;
+    if not found then
+        return jsonb_build_object('status', 'invalid_referrer');
+    end if;
+
+    insert into users (telegram_id, username, first_name, coins, energy, max_energy, tap_power,
+                       energy_regen_rate, last_energy_update, referral_count, referral_earnings, upi_id)
+    select p_telegram_id, n.username, n.first_name, coalesce(n.coins, 0), coalesce(n.energy, 100),
+           coalesce(n.max_energy, 100), coalesce(n.tap_power, 1), coalesce(n.energy_regen_rate, 1),
+           coalesce(n.last_energy_update, p_now), 0, 0, n.upi_id
+      from jsonb_populate_record(null::users, p_new_user) n
+    on conflict (telegram_id) do nothing;
+
+    -- Concurrent calls for the same referee queue here
+    select * into u from users where telegram_id = p_telegram_id for update;
+    if u.referred_by is not null then
+        return jsonb_build_object(
+            'status', case when u.referred_by = p_referrer_id then 'duplicate' else 'already_referred' end,
+            'user', to_jsonb(u),
+            'referrer', to_jsonb(r)
+        );
+    end if;
+
+    insert into referred_users (referrer_id, user_id, username, name, joined_date, earnings_from_referral)
+    values (p_referrer_id, p_telegram_id, u.username, u.first_name, p_now, p_referrer_bonus)
+    on conflict (user_id) do nothing
+    returning id into v_claim;
+    if v_claim is null then
+        return jsonb_build_object('status', 'duplicate', 'user', to_jsonb(u), 'referrer', to_jsonb(r));
+    end if;
+
+    update users
+       set referred_by = p_referrer_id,
+           coins = coins + p_referee_bonus
+     where id = u.id
+    returning * into u;
+
+    -- The referrer's bonus is appended, not written to its row (see merge_referral_credits)
+    insert into referral_credits (referrer_id, coins, referral_count, referral_earnings, created_at)
+    values (p_referrer_id, p_referrer_bonus, 1, p_referrer_bonus, p_now);
+
+    return jsonb_build_object('status', 'applied', 'user', to_jsonb(u), 'referrer', to_jsonb(r));
+end;
+$$;
+
+-- Fold up to p_limit pending referral credits (only p_referrer_id's when
+-- given) into users with one update per referrer. Concurrent merges never
+-- double count: each credit row is deleted by exactly one of them.
+-- Returns {"merged": number of credits, "users": updated rows}.
+create or replace function merge_referral_credits(p_referrer_id text default null, p_limit integer default null)
+returns jsonb
+language plpgsql as $$
+declare
+    v_merged bigint;
+    v_users jsonb;
+begin
+    with merged as (
+        delete from referral_credits
+         where id in (
+            select id from referral_credits
+             where p_referrer_id is null or referrer_id = p_referrer_id
+             order by id
+             limit p_limit
+         )
+        returning referrer_id, coins, referral_count, referral_earnings
+    ), totals as (
+        select referrer_id,
+               count(*) as credits,
+               sum(coins) as coins,
+               sum(referral_count) as referral_count,
+               sum(referral_earnings) as referral_earnings
+          from merged
+         group by referrer_id
+    ), updated as (
+        update users u
+           set coins = u.coins + t.coins,
+               referral_count = u.referral_count + t.referral_count,
+               referral_earnings = u.referral_earnings + t.referral_earnings
+          from totals t
+         where u.telegram_id = t.referrer_id
+        returning u.*
+    )
+    select coalesce((select sum(credits) from totals), 0),
+           coalesce((select jsonb_agg(to_jsonb(updated)) from updated), '[]'::jsonb)
+      into v_merged, v_users;
+    return jsonb_build_object('merged', v_merged, 'users', v_users);
+end;
+$$;
+
+-- Review withdrawals in bulk: move the pending ones among p_ids to p_status
+-- and, for rejections, credit the amounts back with one update per user.
+-- Withdrawals that are no longer pending are skipped, so each is reviewed once.
+create or replace function review_withdrawals(p_ids bigint[], p_status text, p_refund boolean default false)
+returns setof withdrawals
+language sql as $$
+    with reviewed as (
+        update withdrawals
+           set status = p_status
+         where id = any(p_ids)
+           and status = 'pending'
+        returning *
+    ), refunded as (
+        update users u
+           set coins = u.coins + r.amount
+          from (select user_id, sum(amount) as amount from reviewed group by user_id) r
+         where p_refund
+           and u.telegram_id = r.user_id
+        returning u.id
+    )
+    select * from reviewed;
+$$;
+
+-- Withdrawals carry the client's idempotency key; a key is used once per user
+alter table withdrawals add column if not exists final_amount bigint;
+alter table withdrawals add column if not exists fee bigint;
+alter table withdrawals add column if not exists inr_amount double precision;
+alter table withdrawals add column if not exists idempotency_key text;
+create unique index if not exists idx_withdrawals_user_idempotency_key
+    on withdrawals (user_id, idempotency_key) where idempotency_key is not null;
+
+-- Debit p_amount from p_telegram_id and insert the withdrawal p_row in one
+-- transaction. A repeated p_idempotency_key returns the withdrawal stored by
+-- the first call without debiting again. Returns {"status", "withdrawal",
+-- "user"}; status is created, replayed, insufficient_funds or user_not_found.
+create or replace function create_withdrawal(
+    p_telegram_id text,
+    p_amount bigint,
+    p_row jsonb,
+    p_idempotency_key text default null
+)
+returns jsonb
+language plpgsql as $$
+declare
+    u users%rowtype;
+    w withdrawals%rowtype;
+begin
+    -- Retries of the same request queue on the user's row lock, so the
+    -- lookup below sees a withdrawal committed by an earlier attempt
+    select * into u from users where telegram_id = p_telegram_id for update;
+    if not found then
+        return jsonb_build_object('status', 'user_not_found');
+    end if;
+
+    if p_idempotency_key is not null then
+        select * into w from withdrawals
+         where user_id = p_telegram_id and idempotency_key = p_idempotency_key;
+        if found then
+            return jsonb_build_object('status', 'replayed', 'withdrawal', to_jsonb(w), 'user', to_jsonb(u));
+        end if;
+    end if;
+
+    if u.coins < p_amount then
+        return jsonb_build_object('status', 'insufficient_funds', 'user', to_jsonb(u));
+    end if;
+
+    update users set coins = coins - p_amount where id = u.id returning * into u;
+
+    insert into withdrawals (user_id, amount, final_amount, fee, inr_amount, upi_id, status, created_at, idempotency_key)
+    select p_telegram_id, p_amount, n.final_amount, n.fee, n.inr_amount, n.upi_id,
+           coalesce(n.status, 'pending'), now(), p_idempotency_key
+      from jsonb_populate_record(null::withdrawals, p_row) n
+    returning * into w;
+
+    return jsonb_build_object('status', 'created', 'withdrawal', to_jsonb(w), 'user', to_jsonb(u));
+end;
+$$;
+
+-- Append-only ledger of coin movements (taps aggregated per batch, upgrades,
+-- minigames, referrals, withdrawals, admin adjustments), written in batches
+create table if not exists transactions (
+    id bigserial primary key,
+    user_id text not null,
+    type text not null,
+    amount bigint not null,
+    description text,
+    created_at bigint not null
+);
+create index if not exists idx_transactions_user on transactions (user_id, id);
+
+create or replace function transactions_append_only()
+returns trigger
+language plpgsql as $$
+begin
+    raise exception 'transactions are append-only';
+end;
+$$;
+
+drop trigger if exists transactions_append_only on transactions;
+create trigger transactions_append_only
+before update or delete on transactions
+for each row execute function transactions_append_only();
+
+-- Running ledger total per user, advanced with every batch, so balance
+-- audits never sum the ledger
+create table if not exists ledger_balances (
+    user_id text primary key,
+    balance bigint not null default 0,
+    entries bigint not null default 0,
+    last_transaction_id bigint,
+    updated_at bigint not null
+);
+
+-- Insert a batch of transactions and advance each user's ledger_balances
+-- row in the same transaction. Returns the number of rows inserted.
+create or replace function append_transactions(p_rows jsonb)
+returns integer
+language plpgsql as $$
+declare
+    v_count integer;
+begin
+    with inserted as (
+        insert into transactions (user_id, type, amount, description, created_at)
+        select user_id, type, amount, description, created_at
+          from jsonb_populate_recordset(null::transactions, p_rows)
+        returning id, user_id, amount, created_at
+    ), balances as (
+        -- Users in a fixed order, so concurrent batches cannot deadlock
+        insert into ledger_balances as b (user_id, balance, entries, last_transaction_id, updated_at)
+        select user_id, sum(amount), count(*), max(id), max(created_at)
+          from inserted
+         group by user_id
+         order by user_id
+        on conflict (user_id) do update
+           set balance = b.balance + excluded.balance,
+               entries = b.entries + excluded.entries,
+               last_transaction_id = greatest(b.last_transaction_id, excluded.last_transaction_id),
+               updated_at = greatest(b.updated_at, excluded.updated_at)
+        returning 1
+    )
+    select count(*) into v_count from inserted;
+    return v_count;
+end;
+$$;
+
+-- Admin broadcasts; last_user_id is the users.id every recipient up to has
+-- been handled, and owner/lease_until the process currently sending
+create table if not exists broadcasts (
+    id bigserial primary key,
+    text text not null,
+    parse_mode text,
+    reply_markup text,
+    paid boolean not null default false,
+    rate real not null,
+    status text not null default 'running',
+    total bigint not null default 0,
+    last_user_id bigint not null default 0,
+    delivered bigint not null default 0,
+    blocked bigint not null default 0,
+    failed bigint not null default 0,
+    error text,
+    owner text,
+    lease_until bigint,
+    created_at bigint not null,
+    updated_at bigint not null,
+    finished_at bigint
+);
+create index if not exists idx_broadcasts_status on broadcasts (status);
+
+-- Indexes for the per-user and per-status lookups the backend runs
+create index if not exists idx_withdrawals_user_created on withdrawals (user_id, created_at);
+create index if not exists idx_withdrawals_status_created on withdrawals (status, created_at);
+create index if not exists idx_withdrawals_created on withdrawals (created_at);
+create index if not exists idx_referred_users_referrer_id on referred_users (referrer_id, id);
+create index if not exists idx_minigame_rewards_telegram_id on minigame_rewards (telegram_id);
+
+-- Admin user listing: keyset sorts by (coins, id) and (last_energy_update, id),
+-- case-insensitive username prefix search and telegram_id prefix search
+create extension if not exists pg_trgm;
+create index if not exists idx_users_coins_id on users (coins, id);
+create index if not exists idx_users_username_trgm on users using gin (username gin_trgm_ops);
+create index if not exists idx_users_telegram_id_pattern on users (telegram_id text_pattern_ops);
+
+-- Admin dashboard counters, maintained by triggers on every write so the
+-- stats endpoint never scans users or withdrawals. Counters are spread over
+-- 16 shard rows (by row id) so concurrent taps do not queue on one row lock;
+-- readers sum the shards.
+create table if not exists app_stats (
+    shard smallint primary key,
+    total_users bigint not null default 0,
+    total_coins bigint not null default 0,
+    total_withdrawals bigint not null default 0,
+    pending_withdrawals bigint not null default 0,
+    completed_withdrawals bigint not null default 0,
+    total_withdrawn bigint not null default 0
+);
+
+create index if not exists idx_users_last_energy_update on users (last_energy_update, id);
+
+create or replace function app_stats_users_trigger()
+returns trigger
+language plpgsql as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        update app_stats
+           set total_users = total_users - 1,
+               total_coins = total_coins - coalesce(old.coins, 0)
+         where shard = old.id % 16;
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        update app_stats
+           set total_users = total_users + 1,
+               total_coins = total_coins + coalesce(new.coins, 0)
+         where shard = new.id % 16;
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists app_stats_users on users;
+create trigger app_stats_users
+after insert or delete or update of coins on users
+for each row execute function app_stats_users_trigger();
+
+create or replace function app_stats_withdrawals_trigger()
+returns trigger
+language plpgsql as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        update app_stats
+           set total_withdrawals = total_withdrawals - 1,
+               pending_withdrawals = pending_withdrawals - case when old.status = 'pending' then 1 else 0 end,
+               completed_withdrawals = completed_withdrawals - case when old.status = 'completed' then 1 else 0 end,
+               total_withdrawn = total_withdrawn - case when old.status = 'completed' then coalesce(old.amount, 0) else 0 end
+         where shard = old.id % 16;
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        update app_stats
+           set total_withdrawals = total_withdrawals + 1,
+               pending_withdrawals = pending_withdrawals + case when new.status = 'pending' then 1 else 0 end,
+               completed_withdrawals = completed_withdrawals + case when new.status = 'completed' then 1 else 0 end,
+               total_withdrawn = total_withdrawn + case when new.status = 'completed' then coalesce(new.amount, 0) else 0 end
+         where shard = new.id % 16;
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists app_stats_withdrawals on withdrawals;
+create trigger app_stats_withdrawals
+after insert or delete or update of status, amount on withdrawals
+for each row execute function app_stats_withdrawals_trigger();
+
+-- Reconciliation: rebuild the counters from scratch (run after bulk imports
+-- or from a periodic job; also exposed as POST /api/admin/stats/rebuild)
+create or replace function rebuild_app_stats()
+returns void
+language plpgsql as $$
+begin
+    lock table app_stats in exclusive mode;
+    delete from app_stats;
+    insert into app_stats (shard) select generate_series(0, 15);
+    update app_stats s
+       set total_users = u.total_users,
+           total_coins = u.total_coins
+      from (select id % 16 as shard, count(*) as total_users, coalesce(sum(coins), 0) as total_coins
+              from users group by 1) u
+     where s.shard = u.shard;
+    update app_stats s
+       set total_withdrawals = w.total_withdrawals,
+           pending_withdrawals = w.pending_withdrawals,
+           completed_withdrawals = w.completed_withdrawals,
+           total_withdrawn = w.total_withdrawn
+      from (select id % 16 as shard,
+                   count(*) as total_withdrawals,
+                   count(*) filter (where status = 'pending') as pending_withdrawals,
+                   count(*) filter (where status = 'completed') as completed_withdrawals,
+                   coalesce(sum(amount) filter (where status = 'completed'), 0) as total_withdrawn
+              from withdrawals group by 1) w
+     where s.shard = w.shard;
+end;
+$$;
+
+select rebuild_app_stats();
@@ -0,0 +1,218 @@
+from flask import g, jsonify, request
+import logging
+import math
+import os
+import threading
+import time
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LOAD_SHEDDING_ENABLED = os.environ.get("LOAD_SHEDDING_ENABLED", "true").lower() == "true"
+# Requests handled at once by this process, across all classes
+LOAD_SHED_MAX_IN_FLIGHT = int(os.environ.get("LOAD_SHED_MAX_IN_FLIGHT", 32))
+# Header the proxy sets to the time it received the request ("t=<epoch>"),
+# so time queued before reaching the worker counts against the deadline
+LOAD_SHED_REQUEST_START_HEADER = os.environ.get("LOAD_SHED_REQUEST_START_HEADER", "X-Request-Start")
+
+# Endpoint classes as (priority, concurrency limit, queue deadline in seconds,
+# Retry-After hint). Lower priority numbers are admitted first. Override with
+# LOAD_SHED_<CLASS>="limit/deadline", e.g. LOAD_SHED_GAME="12/0.05".
+DEFAULT_PRIORITY_CLASSES = {
+    "critical": (0, 32, 5.0, 5),
+    "read": (1, 24, 1.0, 2),
+    "game": (2, 16, 0.1, 1)
+}
+
+# Money and admin paths
+CRITICAL_ENDPOINTS = {
+    "withdraw.withdraw",
+    "user.update_upi",
+    "referral.use_referral"
+}
+
+# Coin-earning gameplay, the first to go under overload
+GAME_ENDPOINTS = {
+    "user.tap",
+    "user.tap_batch",
+    "upgrades.upgrade",
+    "minigames.minigame_reward"
+}
+
+class PriorityClass:
+    def __init__(self, name, priority, limit, deadline, retry_after):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+        self.deadline = deadline
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.waiting = 0
+
+        # Counters
+        self.admitted = 0
+        self.shed = 0
+        self.queued = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+def _configured_classes():
+    classes = {}
+    for name, (priority, limit, deadline, retry_after) in DEFAULT_PRIORITY_CLASSES.items():
+        value = os.environ.get(f"LOAD_SHED_{name.upper()}")
+        if value:
+            try:
+                limit_text, deadline_text = value.split("/")
+                limit, deadline = int(limit_text), float(deadline_text)
+            except ValueError:
+                logger.error(f"Ignoring malformed LOAD_SHED_{name.upper()}={value!r}, expected limit/deadline")
+        classes[name] = PriorityClass(name, priority, limit, deadline, retry_after)
+    return classes
+
+class AdmissionController:
+    """
+    Admits requests by endpoint class under per-class and global concurrency
+    limits. A request that finds no slot waits, up to its class deadline, and
+    is shed if none frees in time. Waiting higher-priority requests take
+    freed slots before lower-priority ones, so under overload taps are shed
+    first while withdrawals and admin actions keep moving. Limits are per
+    process.
+    """
+
+    def __init__(self, classes, max_in_flight=LOAD_SHED_MAX_IN_FLIGHT):
+        self.classes = classes
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def _can_admit(self, priority_class):
+        if self.in_flight >= self.max_in_flight or priority_class.in_flight >= priority_class.limit:
+            return False
+        # Leave freed slots to anyone more important who is already waiting
+        return not any(
+            other.waiting for other in self.classes.values()
+            if other.priority < priority_class.priority
+        )
+
+    def acquire(self, name, queued_for=0.0):
+        """
+        Take a slot for a request of class `name`, waiting up to the class
+        deadline less `queued_for` (time already spent upstream). Returns True
+        if admitted; admitted requests must call release().
+        """
+        priority_class = self.classes[name]
+        started = time.monotonic()
+        remaining = priority_class.deadline - queued_for
+        with self._released:
+            if not self._can_admit(priority_class):
+                if remaining <= 0:
+                    priority_class.shed += 1
+                    return False
+                priority_class.queued += 1
+                priority_class.waiting += 1
+                try:
+                    admitted = self._released.wait_for(lambda: self._can_admit(priority_class), timeout=remaining)
+                finally:
+                    priority_class.waiting -= 1
+                if not admitted:
+                    priority_class.shed += 1
+                    # Lower classes may have been held back for this request
+                    self._released.notify_all()
+                    return False
+            waited = time.monotonic() - started
+            priority_class.queue_time_total += waited
+            priority_class.queue_time_max = max(priority_class.queue_time_max, waited)
+            priority_class.in_flight += 1
+            priority_class.admitted += 1
+            self.in_flight += 1
+            return True
+
+    def release(self, name):
+        with self._released:
+            self.classes[name].in_flight -= 1
+            self.in_flight -= 1
+            self._released.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "classes": {
+                    name: {
+                        "priority": priority_class.priority,
+                        "limit": priority_class.limit,
+                        "deadline_seconds": priority_class.deadline,
+                        "in_flight": priority_class.in_flight,
+                        "waiting": priority_class.waiting,
+                        "admitted": priority_class.admitted,
+                        "queued": priority_class.queued,
+                        "shed": priority_class.shed,
+                        "avg_queue_seconds": round(priority_class.queue_time_total / priority_class.admitted, 4) if priority_class.admitted else 0,
+                        "max_queue_seconds": round(priority_class.queue_time_max, 4)
+                    }
+                    for name, priority_class in self.classes.items()
+                }
+            }
+
+admission = AdmissionController(_configured_classes())
+
+def endpoint_class(endpoint):
+    """
+    The priority class of a Flask endpoint, or None for unmanaged routes
+    (static files and pages)
+    """
+    if not endpoint:
+        return None
+    if endpoint in CRITICAL_ENDPOINTS or endpoint.startswith("admin."):
+        return "critical"
+    if endpoint in GAME_ENDPOINTS:
+        return "game"
+    if "." in endpoint and request.method == "GET":
+        return "read"
+    return None
+
+def _upstream_queue_time():
+    """
+    Seconds between the proxy receiving the request and now, if the proxy says
+    """
+    value = request.headers.get(LOAD_SHED_REQUEST_START_HEADER, "")
+    try:
+        started = float(value[2:] if value.startswith("t=") else value)
+    except ValueError:
+        return 0.0
+    # Proxies send seconds, milliseconds or microseconds since the epoch
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, time.time() - started)
+
+def _admit():
+    name = endpoint_class(request.endpoint)
+    if name is None:
+        return None
+    if not admission.acquire(name, _upstream_queue_time()):
+        retry_after = admission.classes[name].retry_after
+        response = jsonify({"error": "Server busy, please retry", "retry_after": retry_after})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(math.ceil(retry_after))
+        return response
+    g.admission_class = name
+    return None
+
+def _release(exception=None):
+    name = g.pop("admission_class", None)
+    if name:
+        admission.release(name)
+
+def init_app(app):
+    """
+    Put every request through the admission controller
+    """
+    if not LOAD_SHEDDING_ENABLED:
+        return
+    app.before_request(_admit)
+    app.teardown_request(_release)
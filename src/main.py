@@ -1,12 +1,16 @@
 from flask import Flask, render_template, send_from_directory
 from flask_cors import CORS
 import os
+from src.load_shedding import init_app as init_load_shedding
+from src.models.broadcast import BROADCAST_AUTO_RESUME, broadcasts
 from src.routes.user import user_bp
 from src.routes.admin import admin_bp
 from src.routes.upgrades import upgrades_bp
 from src.routes.withdrawal import withdraw_bp
 from src.routes.referrals import referral_bp
 from src.routes.minigames import minigames_bp
+from src.routes.leaderboard import leaderboard_bp
+from src.routes.bot import bot_bp
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 app.secret_key = os.environ.get('SECRET_KEY', 'alphawulf2025secretkey')
@@ -14,6 +18,9 @@ app.secret_key = os.environ.get('SECRET_KEY', 'alphawulf2025secretkey')
 # Enable CORS
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# Shed low-priority requests under overload
+init_load_shedding(app)
+
 # Register blueprints
 app.register_blueprint(user_bp)
 app.register_blueprint(admin_bp)
@@ -21,6 +28,12 @@ app.register_blueprint(upgrades_bp)
 app.register_blueprint(withdraw_bp)
 app.register_blueprint(referral_bp)
 app.register_blueprint(minigames_bp)
+app.register_blueprint(leaderboard_bp)
+app.register_blueprint(bot_bp)
+
+# Continue broadcasts interrupted by a restart
+if BROADCAST_AUTO_RESUME:
+    broadcasts.start_resumer()
 
 @app.route('/')
 def index():
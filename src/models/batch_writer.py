@@ -0,0 +1,322 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class BatchWriter:
+    """
+    Hands rows to a bounded in-process queue and writes them from a background
+    thread in multi-row batches, off the request path.
+
+    `write_fn(rows)` stores a list of rows in one call. A failed batch is
+    retried with exponential backoff; if the store is still unavailable the
+    batch, and everything queued behind it, is appended to `spill_path`
+    (JSON lines) and written back once writes succeed again. Without a spill
+    path the batch stays queued and is retried on the next round.
+
+    When the queue is full, put() waits up to `block_timeout` for room
+    (backpressure on producers). Rows that still do not fit are spilled to
+    disk, or written from the caller's thread when there is no spill path.
+    stop() drains the queue on shutdown, spilling whatever cannot be written.
+
+    Use one spill path per process: a `{pid}` in `spill_path` is replaced
+    with the process ID, and on startup spill files left by exited processes
+    are claimed (by atomic rename, so only one process gets each) and
+    written back along with this process's own.
+    """
+
+    def __init__(self, write_fn, name, batch_size=500, flush_interval=2.0, max_queue=20000,
+                 block_timeout=0.5, max_retries=3, retry_backoff=0.5, spill_path=None):
+        self.write_fn = write_fn
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.block_timeout = block_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._spill_template = spill_path if spill_path and "{pid}" in spill_path else None
+        if self._spill_template:
+            spill_path = spill_path.replace("{pid}", str(os.getpid()))
+        self.spill_path = spill_path
+        self._replay_path = f"{spill_path}.replay" if spill_path else None
+        # While the store is failing, spilled rows are only retried this often
+        self.replay_cooldown = max(flush_interval * 5, 5.0)
+        self._next_replay_at = 0.0
+        # Spill files taken over from exited processes, replayed before our own
+        self._adopted = []
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Metrics
+        self._written = 0
+        self._batches = 0
+        self._failed_batches = 0
+        self._retries = 0
+        self._inline_flushes = 0
+        self._blocked_puts = 0
+        self._spilled = 0
+        self._replayed = 0
+        self._last_flush_at = None
+        self._last_flush_duration = 0.0
+
+        if spill_path:
+            os.makedirs(os.path.dirname(os.path.abspath(spill_path)), exist_ok=True)
+            if self._spill_template:
+                self._adopt_orphans()
+            # Rows spilled before a restart are written back by the worker
+            if self._has_spilled():
+                self._ensure_started()
+
+    def put(self, row):
+        """
+        Queue a row for the next batch, waiting briefly for room when the queue is full
+        """
+        with self._room:
+            if len(self._queue) >= self.max_queue:
+                self._blocked_puts += 1
+                self._wakeup.set()
+                self._room.wait_for(lambda: len(self._queue) < self.max_queue, timeout=self.block_timeout)
+            queued = None
+            if len(self._queue) < self.max_queue:
+                self._queue.append(row)
+                queued = len(self._queue)
+        self._ensure_started()
+
+        if queued is None:
+            # The store is not keeping up
+            self._overflow(row)
+        elif queued >= self.batch_size:
+            self._wakeup.set()
+
+    def _overflow(self, row):
+        if self.spill_path:
+            self._spill([row])
+            return
+        # Without a spill file, write from the caller's thread until there is room
+        self._inline_flushes += 1
+        with self._lock:
+            self._queue.append(row)
+        try:
+            self.flush(retries=1)
+        except Exception:
+            # Already logged, the rows stay queued
+            pass
+
+    def flush(self, retries=None):
+        """
+        Write everything queued, one batch at a time
+        """
+        retries = self.max_retries if retries is None else retries
+        with self._flush_lock:
+            while True:
+                with self._room:
+                    batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                    self._room.notify_all()
+                if not batch:
+                    return
+                if not self._write_with_retry(batch, retries):
+                    # Store unavailable: move the rest of the queue to disk as well
+                    with self._room:
+                        rest = list(self._queue)
+                        self._queue.clear()
+                        self._room.notify_all()
+                    self._spill(batch + rest)
+                    self._next_replay_at = time.time() + self.replay_cooldown
+                    return
+
+    def _write_with_retry(self, batch, retries):
+        """
+        Write a batch, retrying with backoff. Returns False if the batch should
+        be spilled; raises if it cannot be written and there is no spill file.
+        """
+        for attempt in range(retries):
+            try:
+                self._write(batch)
+                return True
+            except Exception as e:
+                self._failed_batches += 1
+                logger.error(f"Error writing {len(batch)} {self.name} rows (attempt {attempt + 1}/{retries}): {str(e)}")
+                if attempt + 1 < retries:
+                    self._retries += 1
+                    time.sleep(self.retry_backoff * 2 ** attempt)
+        if self.spill_path:
+            return False
+        with self._room:
+            self._queue.extendleft(reversed(batch))
+        raise RuntimeError(f"Could not write {len(batch)} {self.name} rows")
+
+    def _write(self, batch):
+        started = time.time()
+        self.write_fn(batch)
+        finished = time.time()
+        self._written += len(batch)
+        self._batches += 1
+        self._last_flush_at = finished
+        self._last_flush_duration = finished - started
+
+    def _spill(self, rows, replaying=False):
+        """
+        Append rows to the spill file
+        """
+        if not rows:
+            return
+        with self._spill_lock:
+            with open(self.spill_path, "a") as spill_file:
+                for row in rows:
+                    spill_file.write(json.dumps(row, separators=(",", ":")) + "\n")
+                spill_file.flush()
+                os.fsync(spill_file.fileno())
+        if not replaying:
+            self._spilled += len(rows)
+            logger.warning(f"Spilled {len(rows)} {self.name} rows to {self.spill_path}")
+
+    def _has_spilled(self):
+        return bool(self.spill_path) and (
+            bool(self._adopted) or os.path.exists(self.spill_path) or os.path.exists(self._replay_path)
+        )
+
+    def _adopt_orphans(self):
+        """
+        Claim the spill files of processes that are no longer running, plus
+        any this process ID claimed in an earlier life
+        """
+        prefix, suffix = self._spill_template.split("{pid}", 1)
+        pattern = glob.escape(prefix) + "*" + glob.escape(suffix) + "*"
+        for path in sorted(glob.glob(pattern)):
+            owner = path[len(prefix):].split(suffix, 1)[0]
+            if not owner.isdigit():
+                continue
+            if int(owner) == os.getpid():
+                if path.startswith(f"{self.spill_path}.adopted."):
+                    self._adopted.append(path)
+                continue
+            if _pid_alive(int(owner)):
+                continue
+            claimed = f"{self.spill_path}.adopted.{time.time_ns()}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # Another process claimed it first
+                continue
+            logger.info(f"Claimed spilled {self.name} rows from {path}")
+            self._adopted.append(claimed)
+
+    def _replay(self):
+        """
+        Write spilled rows back, once. Rows that still fail go back to the spill file.
+        """
+        if not self._has_spilled() or time.time() < self._next_replay_at:
+            return
+        while self._adopted:
+            # Rows that fail are moved to this process's spill file
+            if not self._replay_file(self._adopted.pop(0)):
+                return
+        with self._spill_lock:
+            # A replay file left by a crash is finished before new spills are taken
+            if not os.path.exists(self._replay_path):
+                if not os.path.exists(self.spill_path):
+                    return
+                os.replace(self.spill_path, self._replay_path)
+        self._replay_file(self._replay_path)
+
+    def _replay_file(self, path):
+        """
+        Write the rows in `path` back and remove it. Returns False if the store failed.
+        """
+        with open(path) as replay_file:
+            rows = [json.loads(line) for line in replay_file if line.strip()]
+        replayed = True
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f"Error replaying spilled {self.name} rows: {str(e)}")
+                self._spill(rows[start:], replaying=True)
+                self._next_replay_at = time.time() + self.replay_cooldown
+                replayed = False
+                break
+            self._replayed += len(batch)
+        os.remove(path)
+        return replayed
+
+    def _ensure_started(self):
+        if self._thread or self._stopped.is_set():
+            return
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                self._replay()
+            except Exception:
+                # Already logged, the rows are retried next round
+                pass
+
+    def stop(self):
+        """
+        Stop the background writer and drain the queue (graceful shutdown).
+        Rows that cannot be written are spilled when a spill path is set.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.flush_interval + 5)
+        try:
+            self.flush()
+        except Exception:
+            logger.error(f"{len(self._queue)} {self.name} rows lost on shutdown")
+
+    def metrics(self):
+        """
+        Queue depth, throughput and spill metrics
+        """
+        with self._lock:
+            queued = len(self._queue)
+        return {
+            "queued": queued,
+            "max_queue": self.max_queue,
+            "written": self._written,
+            "batches": self._batches,
+            "failed_batches": self._failed_batches,
+            "retries": self._retries,
+            "blocked_puts": self._blocked_puts,
+            "inline_flushes": self._inline_flushes,
+            "spilled": self._spilled,
+            "replayed": self._replayed,
+            "spill_pending": self._has_spilled(),
+            "last_flush_at": self._last_flush_at,
+            "last_flush_duration_seconds": round(self._last_flush_duration, 3)
+        }
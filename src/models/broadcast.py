@@ -0,0 +1,270 @@
+from concurrent.futures import ThreadPoolExecutor
+from src.storage import storage
+from src.telegram_api import TelegramError, outbox_for
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
+# Messages per second. Telegram allows about 30 overall; broadcasts go through
+# the bot's outbound queue behind its replies. A million users takes about 11 hours.
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))
+# Paid broadcasts (allow_paid_broadcast, charged in Telegram Stars) may send
+# up to 1000 messages per second, about 17 minutes per million users
+BROADCAST_PAID_RATE = float(os.environ.get("BROADCAST_PAID_RATE", 1000))
+# Sends in flight at once (the outbound queue's TELEGRAM_SEND_WORKERS bounds
+# how many actually reach Telegram together)
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 32))
+# Recipients read and checkpointed at a time; a restart resends at most one page
+BROADCAST_PAGE_SIZE = int(os.environ.get("BROADCAST_PAGE_SIZE", 500))
+# Seconds a sender's claim lasts without a checkpoint before another process takes over
+BROADCAST_LEASE_SECONDS = int(os.environ.get("BROADCAST_LEASE_SECONDS", 60))
+# Pick up running broadcasts left by a restart or a dead process
+BROADCAST_AUTO_RESUME = os.environ.get("BROADCAST_AUTO_RESUME", "true").lower() == "true"
+
+BROADCAST_STATUSES = ("running", "paused", "completed", "cancelled")
+PARSE_MODES = ("HTML", "MarkdownV2")
+
+def _blocked(error):
+    """
+    Whether a send failed because the user cannot be messaged any more
+    (blocked the bot, deleted their account or never started it)
+    """
+    description = str(error).lower()
+    return error.error_code == 403 or (error.error_code == 400 and "chat not found" in description)
+
+class Pacer:
+    """
+    Spaces calls from many threads to at most `rate` per second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class Broadcasts:
+    """
+    Sends admin broadcasts to every user. A sender walks users in id order one
+    page at a time, sends the page with bounded concurrency at the
+    broadcast's rate, then checkpoints last_user_id and the counts, so a
+    restart resumes from the last page. The sending process holds a lease on
+    the broadcast row, renewed at each checkpoint, so only one process sends
+    a broadcast at a time.
+
+    Messages go through the bot's shared outbound queue as bulk sends, so
+    they count against the same global pace and flood waits as the bot's
+    replies and only use what the replies leave.
+    """
+
+    def __init__(self, token=BOT_TOKEN, concurrency=BROADCAST_CONCURRENCY, page_size=BROADCAST_PAGE_SIZE):
+        self.outbox = outbox_for(token)
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._senders = {}
+        self._lock = threading.Lock()
+        self._resumer = None
+
+    def create(self, text, parse_mode="HTML", reply_markup=None, paid=False, rate=None):
+        """
+        Store a broadcast and start sending it
+        """
+        max_rate = BROADCAST_PAID_RATE if paid else BROADCAST_RATE
+        current_time = int(time.time())
+        row = storage.broadcasts.insert({
+            "text": text,
+            "parse_mode": parse_mode,
+            "reply_markup": json.dumps(reply_markup) if reply_markup else None,
+            "paid": bool(paid),
+            "rate": min(float(rate), max_rate) if rate else max_rate,
+            "status": "running",
+            "total": storage.stats.totals()["total_users"],
+            "created_at": current_time,
+            "updated_at": current_time
+        })
+        self.start(row["id"])
+        return row
+
+    def start(self, broadcast_id):
+        """
+        Send a running broadcast from this process, unless it already is
+        """
+        with self._lock:
+            sender = self._senders.get(broadcast_id)
+            if sender and sender.is_alive():
+                return
+            sender = threading.Thread(target=self._run, args=(broadcast_id,), name=f"broadcast-{broadcast_id}", daemon=True)
+            self._senders[broadcast_id] = sender
+            sender.start()
+
+    def pause(self, broadcast_id):
+        """
+        Stop sending after the current page; resume() continues from there
+        """
+        return storage.broadcasts.update(broadcast_id, {"status": "paused", "updated_at": int(time.time())}, status="running")
+
+    def resume(self, broadcast_id):
+        row = storage.broadcasts.update(broadcast_id, {
+            "status": "running",
+            "owner": None,
+            "lease_until": None,
+            "updated_at": int(time.time())
+        }, status="paused")
+        if row:
+            self.start(broadcast_id)
+        return row
+
+    def cancel(self, broadcast_id):
+        current_time = int(time.time())
+        for status in ("running", "paused"):
+            row = storage.broadcasts.update(broadcast_id, {
+                "status": "cancelled",
+                "updated_at": current_time,
+                "finished_at": current_time
+            }, status=status)
+            if row:
+                return row
+        return None
+
+    def resume_interrupted(self):
+        """
+        Send every running broadcast not already being sent; claims fail for
+        those another process holds a live lease on
+        """
+        for row in storage.broadcasts.list(statuses=["running"], limit=100):
+            self.start(row["id"])
+
+    def start_resumer(self, interval=BROADCAST_LEASE_SECONDS):
+        """
+        Check for interrupted broadcasts now and every `interval` seconds
+        """
+        if self._resumer:
+            return
+
+        def resume_loop():
+            while True:
+                try:
+                    self.resume_interrupted()
+                except Exception as e:
+                    logger.error(f"Error resuming broadcasts: {str(e)}")
+                time.sleep(interval)
+
+        self._resumer = threading.Thread(target=resume_loop, name="broadcast-resumer", daemon=True)
+        self._resumer.start()
+
+    def _run(self, broadcast_id):
+        try:
+            self._send_all(broadcast_id)
+        except Exception as e:
+            logger.error(f"Broadcast {broadcast_id} stopped: {str(e)}")
+            storage.broadcasts.update(broadcast_id, {"error": str(e)[:500], "updated_at": int(time.time())})
+
+    def _lease_until(self, row):
+        # Long enough for a page at the broadcast's rate
+        return time.time() + max(BROADCAST_LEASE_SECONDS, 2 * self.page_size / row["rate"])
+
+    def _send_all(self, broadcast_id):
+        row = storage.broadcasts.get(broadcast_id)
+        if row is None or row["status"] != "running":
+            return
+        row = storage.broadcasts.claim(broadcast_id, self.owner, self._lease_until(row), time.time())
+        if row is None:
+            return
+        logger.info(f"Sending broadcast {broadcast_id} from user id {row['last_user_id']}")
+
+        message = {"text": row["text"]}
+        if row.get("parse_mode"):
+            message["parse_mode"] = row["parse_mode"]
+        if row.get("reply_markup"):
+            message["reply_markup"] = row["reply_markup"]
+        if row.get("paid"):
+            message["allow_paid_broadcast"] = "true"
+        pacer = Pacer(row["rate"])
+
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix=f"broadcast-{broadcast_id}") as pool:
+            while True:
+                recipients = storage.users.id_page(row["last_user_id"], self.page_size)
+                if not recipients:
+                    current_time = int(time.time())
+                    storage.broadcasts.update(broadcast_id, {
+                        "status": "completed",
+                        "owner": None,
+                        "lease_until": None,
+                        "updated_at": current_time,
+                        "finished_at": current_time
+                    }, status="running", owner=self.owner)
+                    logger.info(f"Broadcast {broadcast_id} completed")
+                    return
+
+                outcomes = list(pool.map(
+                    lambda recipient: self._deliver(pacer, message, recipient["telegram_id"]), recipients
+                ))
+                # Compare-and-set on status and owner: a sender whose lease ran
+                # out during the page must not overwrite the new sender's progress
+                checkpoint = row
+                row = storage.broadcasts.update(broadcast_id, {
+                    "last_user_id": recipients[-1]["id"],
+                    "delivered": row["delivered"] + outcomes.count("delivered"),
+                    "blocked": row["blocked"] + outcomes.count("blocked"),
+                    "failed": row["failed"] + outcomes.count("failed"),
+                    "lease_until": int(self._lease_until(row)),
+                    "updated_at": int(time.time())
+                }, status="running", owner=self.owner)
+                if row is None:
+                    # Paused, cancelled, or the lease was released (resumed
+                    # during the page) or taken over. Carry on only if the
+                    # lease is free to claim again, from the stored checkpoint.
+                    row = storage.broadcasts.claim(broadcast_id, self.owner, self._lease_until(checkpoint), time.time())
+                    if row is None:
+                        logger.info(f"Broadcast {broadcast_id} no longer sent from {self.owner}, stopping")
+                        return
+
+    def _deliver(self, pacer, message, chat_id):
+        """
+        Send the broadcast to one user: delivered, blocked or failed. The
+        outbound queue retries 429s, 5xx responses and connection errors.
+        """
+        pacer.wait()
+        try:
+            self.outbox.enqueue(
+                "sendMessage", dict(message, chat_id=chat_id), chat_id=chat_id,
+                bulk=True, global_pace="allow_paid_broadcast" not in message
+            ).wait()
+            return "delivered"
+        except TelegramError as e:
+            if _blocked(e):
+                return "blocked"
+            logger.warning(f"Broadcast to {chat_id} failed: {str(e)}")
+            return "failed"
+
+broadcasts = Broadcasts()
+
+def broadcast_to_dict(row):
+    """
+    A broadcast row with its progress, for the admin API
+    """
+    handled = row["delivered"] + row["blocked"] + row["failed"]
+    return dict(
+        {column: value for column, value in row.items() if column not in ("owner", "lease_until")},
+        paid=bool(row.get("paid")),
+        reply_markup=json.loads(row["reply_markup"]) if row.get("reply_markup") else None,
+        handled=handled,
+        progress=round(min(handled / row["total"], 1.0), 4) if row["total"] else None,
+        sending=row["status"] == "running" and bool(row.get("lease_until")) and row["lease_until"] >= time.time()
+    )
@@ -0,0 +1,416 @@
+import atexit
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_ENABLED = os.environ.get("LEADERBOARD_ENABLED", "true").lower() == "true"
+# Optional JSON file the daily/weekly windows are saved to, so restarts keep them
+LEADERBOARD_SNAPSHOT_PATH = os.environ.get("LEADERBOARD_SNAPSHOT_PATH")
+LEADERBOARD_SNAPSHOT_INTERVAL = float(os.environ.get("LEADERBOARD_SNAPSHOT_INTERVAL", 60))
+# Rows per query when loading balances from storage
+LEADERBOARD_LOAD_BATCH = 1000
+# Seconds between reloads of every balance from storage (0 loads once), so
+# each worker also picks up balances changed by the others
+LEADERBOARD_RELOAD_INTERVAL = float(os.environ.get("LEADERBOARD_RELOAD_INTERVAL", 600))
+
+_MAX_LEVEL = 32
+_P = 0.25
+
+class _Node:
+    __slots__ = ("key", "next", "span")
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # span[i]: how many positions next[i] skips ahead
+        self.span = [0] * level
+
+class IndexableSkipList:
+    """
+    Sorted set of comparable keys with O(log n) insert, remove, rank and
+    access by rank. Every forward link records how many nodes it skips, so
+    positions can be counted while searching.
+    """
+
+    def __init__(self):
+        self._head = _Node(None, _MAX_LEVEL)
+        self._level = 1
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _random_level(self):
+        level = 1
+        while level < _MAX_LEVEL and random.random() < _P:
+            level += 1
+        return level
+
+    def insert(self, key):
+        update = [None] * _MAX_LEVEL
+        rank = [0] * _MAX_LEVEL
+        node = self._head
+        for i in range(self._level - 1, -1, -1):
+            rank[i] = 0 if i == self._level - 1 else rank[i + 1]
+            while node.next[i] is not None and node.next[i].key < key:
+                rank[i] += node.span[i]
+                node = node.next[i]
+            update[i] = node
+
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                rank[i] = 0
+                update[i] = self._head
+                self._head.span[i] = self._size
+            self._level = level
+
+        new = _Node(key, level)
+        for i in range(level):
+            new.next[i] = update[i].next[i]
+            update[i].next[i] = new
+            new.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = rank[0] - rank[i] + 1
+        for i in range(level, self._level):
+            update[i].span[i] += 1
+        self._size += 1
+
+    def remove(self, key):
+        """
+        Remove key, returning False if it was not present
+        """
+        update = [None] * _MAX_LEVEL
+        node = self._head
+        for i in range(self._level - 1, -1, -1):
+            while node.next[i] is not None and node.next[i].key < key:
+                node = node.next[i]
+            update[i] = node
+
+        target = node.next[0]
+        if target is None or target.key != key:
+            return False
+        for i in range(self._level):
+            if update[i].next[i] is target:
+                update[i].span[i] += target.span[i] - 1
+                update[i].next[i] = target.next[i]
+            else:
+                update[i].span[i] -= 1
+        while self._level > 1 and self._head.next[self._level - 1] is None:
+            self._level -= 1
+        self._size -= 1
+        return True
+
+    def rank(self, key):
+        """
+        1-based position of key, or None if it is not present
+        """
+        rank = 0
+        node = self._head
+        for i in range(self._level - 1, -1, -1):
+            while node.next[i] is not None and node.next[i].key <= key:
+                rank += node.span[i]
+                node = node.next[i]
+            if node is not self._head and node.key == key:
+                return rank
+        return None
+
+    def slice(self, start, count):
+        """
+        Up to `count` keys starting at 1-based position `start`
+        """
+        if count <= 0 or start < 1 or start > self._size:
+            return []
+        traversed = 0
+        node = self._head
+        for i in range(self._level - 1, -1, -1):
+            while node.next[i] is not None and traversed + node.span[i] <= start:
+                traversed += node.span[i]
+                node = node.next[i]
+            if traversed == start:
+                break
+        keys = []
+        while node is not None and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+class Leaderboard:
+    """
+    Scores by member, highest first (ties broken by member id), with
+    logarithmic updates and rank queries
+    """
+
+    def __init__(self):
+        self._scores = {}
+        self._ranking = IndexableSkipList()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scores)
+
+    def set(self, member, score, only_if_absent=False):
+        with self._lock:
+            previous = self._scores.get(member)
+            if previous == score or (only_if_absent and previous is not None):
+                return
+            if previous is not None:
+                self._ranking.remove((-previous, member))
+            self._ranking.insert((-score, member))
+            self._scores[member] = score
+
+    def add(self, member, amount):
+        with self._lock:
+            previous = self._scores.get(member)
+            score = (previous or 0) + amount
+            if previous is not None:
+                self._ranking.remove((-previous, member))
+            self._ranking.insert((-score, member))
+            self._scores[member] = score
+
+    def remove(self, member):
+        with self._lock:
+            previous = self._scores.pop(member, None)
+            if previous is not None:
+                self._ranking.remove((-previous, member))
+
+    def score(self, member):
+        return self._scores.get(member)
+
+    def rank(self, member):
+        """
+        1-based rank of member, or None
+        """
+        with self._lock:
+            score = self._scores.get(member)
+            return None if score is None else self._ranking.rank((-score, member))
+
+    def range(self, start, count):
+        """
+        [(rank, member, score)] for `count` entries from 1-based rank `start`
+        """
+        with self._lock:
+            keys = self._ranking.slice(start, count)
+        return [(start + offset, member, -negative) for offset, (negative, member) in enumerate(keys)]
+
+    def top(self, count, offset=0):
+        return self.range(offset + 1, count)
+
+    def around(self, member, radius):
+        """
+        Entries within `radius` ranks of member, or [] if member is not ranked
+        """
+        rank = self.rank(member)
+        if rank is None:
+            return []
+        start = max(1, rank - radius)
+        return self.range(start, rank + radius - start + 1)
+
+    def items(self):
+        with self._lock:
+            return dict(self._scores)
+
+def _day(current_time):
+    return int(current_time // 86400)
+
+def _week(current_time):
+    # 1970-01-01 was a Thursday; shift so weeks start on Monday (UTC)
+    return (int(current_time // 86400) + 3) // 7
+
+class WindowedLeaderboard:
+    """
+    Coins earned during the current period. When the period changes the
+    board is swapped for an empty one, so resets never rescan users.
+    """
+
+    def __init__(self, period_of):
+        self.period_of = period_of
+        self.period = period_of(time.time())
+        self.board = Leaderboard()
+        self._lock = threading.Lock()
+
+    def current(self, current_time=None):
+        period = self.period_of(current_time or time.time())
+        with self._lock:
+            if period != self.period:
+                self.period = period
+                self.board = Leaderboard()
+            return self.board
+
+class Leaderboards:
+    """
+    In-process leaderboards: all-time ranks by balance, fed by every user row
+    the model reads or writes, and daily and weekly ranks by coins earned
+    (taps, minigames and referrals; not refunds or admin changes).
+
+    Balances are loaded from storage in the background on first use and
+    reloaded every `reload_interval` seconds; until the first load finishes
+    the all-time board only holds the users seen so far (see `loading`).
+    Each worker process keeps its own boards: the all-time board catches up
+    with other workers' changes at each reload, but the daily and weekly
+    windows only count earnings made in this process, so run a single
+    worker (or route leaderboard requests to one) for exact windows.
+    """
+    WINDOWS = ("all", "daily", "weekly")
+
+    def __init__(self, load_rows, enabled=LEADERBOARD_ENABLED, snapshot_path=LEADERBOARD_SNAPSHOT_PATH,
+                 snapshot_interval=LEADERBOARD_SNAPSHOT_INTERVAL, reload_interval=LEADERBOARD_RELOAD_INTERVAL):
+        self.load_rows = load_rows
+        self.enabled = enabled
+        self.snapshot_path = snapshot_path
+        self.reload_interval = reload_interval
+        self.all_time = Leaderboard()
+        self.daily = WindowedLeaderboard(_day)
+        self.weekly = WindowedLeaderboard(_week)
+        self._loaded = threading.Event()
+        self._loader = None
+        self._loader_lock = threading.Lock()
+        # Balances observed while a load is running, applied over the loaded ones
+        self._observed = None
+        self._observed_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        if enabled and snapshot_path:
+            self._restore()
+            threading.Thread(target=self._snapshot_loop, args=(snapshot_interval,), daemon=True).start()
+            atexit.register(self.snapshot)
+
+    @property
+    def loading(self):
+        """
+        Whether the first load from storage is still running
+        """
+        return not self._loaded.is_set()
+
+    def observe(self, telegram_id, coins):
+        """
+        Record a user's current balance
+        """
+        if not self.enabled:
+            return
+        self._start_loading()
+        with self._observed_lock:
+            self.all_time.set(telegram_id, coins)
+            if self._observed is not None:
+                self._observed[telegram_id] = coins
+
+    def earned(self, telegram_id, amount, current_time=None):
+        """
+        Count coins a user earned towards the daily and weekly windows
+        """
+        amount = int(amount)
+        if not self.enabled or amount <= 0:
+            return
+        telegram_id = str(telegram_id)
+        self.daily.current(current_time).add(telegram_id, amount)
+        self.weekly.current(current_time).add(telegram_id, amount)
+
+    def forget(self, telegram_id):
+        """
+        Drop a deleted user from every board
+        """
+        with self._observed_lock:
+            self.all_time.remove(telegram_id)
+            if self._observed is not None:
+                self._observed[telegram_id] = None
+        self.daily.current().remove(telegram_id)
+        self.weekly.current().remove(telegram_id)
+
+    def board(self, window="all"):
+        """
+        The leaderboard for a window. Never waits for the load from storage.
+        """
+        self._start_loading()
+        if window == "daily":
+            return self.daily.current()
+        if window == "weekly":
+            return self.weekly.current()
+        return self.all_time
+
+    def _start_loading(self):
+        if self._loader is not None:
+            return
+        with self._loader_lock:
+            if self._loader is None:
+                self._loader = threading.Thread(target=self._load_loop, name="leaderboard-loader", daemon=True)
+                self._loader.start()
+
+    def _load_loop(self):
+        while True:
+            self._load()
+            self._loaded.set()
+            if not self.reload_interval or self._stop.wait(self.reload_interval):
+                return
+
+    def _load(self):
+        """
+        Build a fresh all-time board from storage and swap it in
+        """
+        started = time.time()
+        with self._observed_lock:
+            self._observed = {}
+        board = Leaderboard()
+        try:
+            for row in self.load_rows(LEADERBOARD_LOAD_BATCH):
+                board.set(str(row["telegram_id"]), int(row.get("coins") or 0))
+        except Exception as e:
+            logger.error(f"Error loading leaderboard: {str(e)}")
+            with self._observed_lock:
+                self._observed = None
+            return
+        with self._observed_lock:
+            # Users observed while loading already hold a newer balance
+            for telegram_id, coins in self._observed.items():
+                if coins is None:
+                    board.remove(telegram_id)
+                else:
+                    board.set(telegram_id, coins)
+            self._observed = None
+            self.all_time = board
+        logger.info(f"Leaderboard loaded {len(board)} users in {time.time() - started:.2f}s")
+
+    def snapshot(self):
+        """
+        Save the daily and weekly windows to the snapshot file
+        """
+        if not self.snapshot_path:
+            return
+        data = {}
+        for name, window in (("daily", self.daily), ("weekly", self.weekly)):
+            board = window.current()
+            data[name] = {"period": window.period, "scores": board.items()}
+        temporary = f"{self.snapshot_path}.tmp"
+        try:
+            with open(temporary, "w") as snapshot_file:
+                json.dump(data, snapshot_file)
+            os.replace(temporary, self.snapshot_path)
+        except Exception as e:
+            logger.error(f"Error saving leaderboard snapshot: {str(e)}")
+
+    def _restore(self):
+        try:
+            with open(self.snapshot_path) as snapshot_file:
+                data = json.load(snapshot_file)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Error reading leaderboard snapshot: {str(e)}")
+            return
+        for name, window in (("daily", self.daily), ("weekly", self.weekly)):
+            saved = data.get(name) or {}
+            # A snapshot from an earlier period has already been reset
+            if saved.get("period") == window.period:
+                board = window.current()
+                for telegram_id, score in saved.get("scores", {}).items():
+                    board.set(telegram_id, score)
+        logger.info(f"Restored leaderboard windows from {self.snapshot_path}")
+
+    def _snapshot_loop(self, interval):
+        while not self._stop.wait(interval):
+            self.snapshot()
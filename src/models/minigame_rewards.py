@@ -0,0 +1,27 @@
+from src.models.batch_writer import BatchWriter
+from src.storage import storage
+import os
+
+# Seconds between background writes of minigame reward logs
+MINIGAME_REWARDS_FLUSH_INTERVAL = float(os.environ.get("MINIGAME_REWARDS_FLUSH_INTERVAL", 2))
+# Reward logs per multi-row insert
+MINIGAME_REWARDS_BATCH_SIZE = int(os.environ.get("MINIGAME_REWARDS_BATCH_SIZE", 500))
+# Queued logs beyond which requests wait for room
+MINIGAME_REWARDS_MAX_QUEUE = int(os.environ.get("MINIGAME_REWARDS_MAX_QUEUE", 10000))
+# Logs are spilled here while the database is unavailable and written back later.
+# `{pid}` keeps each worker process on its own file.
+MINIGAME_REWARDS_SPILL_PATH = os.environ.get(
+    "MINIGAME_REWARDS_SPILL_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "database", "minigame_rewards.{pid}.spill")
+)
+
+# Reward logs are an audit trail only (coins are credited on the users row),
+# so they are written in the background instead of before the response
+minigame_reward_log = BatchWriter(
+    lambda rows: storage.minigame_rewards.insert_many(rows),
+    "minigame_rewards",
+    batch_size=MINIGAME_REWARDS_BATCH_SIZE,
+    flush_interval=MINIGAME_REWARDS_FLUSH_INTERVAL,
+    max_queue=MINIGAME_REWARDS_MAX_QUEUE,
+    spill_path=MINIGAME_REWARDS_SPILL_PATH
+)
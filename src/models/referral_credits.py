@@ -0,0 +1,151 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds between background merges of referral credits into users
+REFERRAL_MERGE_INTERVAL = float(os.environ.get("REFERRAL_MERGE_INTERVAL", 5))
+# Credits folded per merge call
+REFERRAL_MERGE_BATCH = int(os.environ.get("REFERRAL_MERGE_BATCH", 5000))
+
+class ReferralCreditMerger:
+    """
+    Merges append-only referral credits into users.coins, referral_count and
+    referral_earnings. A referral only inserts a credit row, so a burst of
+    signups under one referrer never queues on the referrer's users row;
+    merges fold many credits into one update per referrer.
+
+    `merge_fn(referrer_id, limit)` merges up to `limit` credits (all of one
+    referrer's when referrer_id is given) and returns (user_rows, merged_credits).
+
+    Referrers credited from this process are remembered until merged, so
+    merge_user() skips the database for everyone else. Credits written by
+    other processes are merged by the background merger.
+    """
+
+    def __init__(self, merge_fn, interval=REFERRAL_MERGE_INTERVAL, batch_size=REFERRAL_MERGE_BATCH):
+        self.merge_fn = merge_fn
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        # Credits written from this process and not yet merged, by referrer
+        self._pending = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Metrics
+        self._merges = 0
+        self._merged_credits = 0
+        self._failed_merges = 0
+        self._last_merge_at = None
+        self._last_merge_duration = 0.0
+
+    def credited(self, referrer_id):
+        """
+        Note that a credit was written, starting the background merger
+        """
+        referrer_id = str(referrer_id)
+        with self._lock:
+            self._pending[referrer_id] = self._pending.get(referrer_id, 0) + 1
+        self._ensure_started()
+
+    def merge(self):
+        """
+        Merge every pending credit, one batch at a time
+        """
+        with self._lock:
+            pending = dict(self._pending)
+        while True:
+            merged = self._merge(None, self.batch_size)
+            if merged < self.batch_size:
+                break
+        # Credits noted while merging may not have been merged yet
+        with self._lock:
+            for referrer_id, count in pending.items():
+                remaining = self._pending.get(referrer_id, 0) - count
+                if remaining > 0:
+                    self._pending[referrer_id] = remaining
+                else:
+                    self._pending.pop(referrer_id, None)
+
+    def merge_user(self, telegram_id, force=False):
+        """
+        Merge one referrer's pending credits, used before money is moved.
+        Without `force` this is skipped unless this process credited them.
+        """
+        telegram_id = str(telegram_id)
+        self._ensure_started()
+        with self._lock:
+            pending = self._pending.pop(telegram_id, 0)
+        if not pending and not force:
+            return
+        try:
+            self._merge(telegram_id, None)
+        except Exception:
+            with self._lock:
+                self._pending[telegram_id] = self._pending.get(telegram_id, 0) + pending
+            raise
+
+    def _merge(self, referrer_id, limit):
+        started = time.time()
+        try:
+            _, merged = self.merge_fn(referrer_id, limit)
+        except Exception as e:
+            self._failed_merges += 1
+            logger.error(f"Error merging referral credits: {str(e)}")
+            raise
+        if merged:
+            finished = time.time()
+            self._merges += 1
+            self._merged_credits += merged
+            self._last_merge_at = finished
+            self._last_merge_duration = finished - started
+        return merged
+
+    def _ensure_started(self):
+        if self._thread or self._stopped.is_set():
+            return
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name="referral-credit-merger", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.merge()
+            except Exception:
+                # Already logged, credits stay pending until the next round
+                pass
+
+    def stop(self):
+        """
+        Stop the background merger and merge what is left (graceful shutdown)
+        """
+        self._stopped.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.interval + 5)
+        try:
+            self.merge()
+        except Exception:
+            logger.error("Referral credits left unmerged on shutdown")
+
+    def metrics(self):
+        """
+        Merge throughput metrics
+        """
+        return {
+            "merge_interval_seconds": self.interval,
+            "merges": self._merges,
+            "merged_credits": self._merged_credits,
+            "failed_merges": self._failed_merges,
+            "last_merge_at": self._last_merge_at,
+            "last_merge_duration_seconds": round(self._last_merge_duration, 3)
+        }
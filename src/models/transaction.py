@@ -0,0 +1,158 @@
+from src.models.batch_writer import BatchWriter
+from src.storage import storage
+import logging
+import os
+import time
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LEDGER_ENABLED = os.environ.get("LEDGER_ENABLED", "true").lower() == "true"
+# Seconds between background ledger writes
+LEDGER_FLUSH_INTERVAL = float(os.environ.get("LEDGER_FLUSH_INTERVAL", 2))
+# Entries per multi-row insert
+LEDGER_BATCH_SIZE = int(os.environ.get("LEDGER_BATCH_SIZE", 500))
+# Queued entries beyond which producers are held back
+LEDGER_MAX_QUEUE = int(os.environ.get("LEDGER_MAX_QUEUE", 20000))
+# Optional file entries are spilled to while the database is unavailable;
+# include `{pid}` when several worker processes share the directory
+LEDGER_SPILL_PATH = os.environ.get("LEDGER_SPILL_PATH")
+
+# Kinds of coin movement recorded in the ledger
+TRANSACTION_TYPES = (
+    "welcome", "tap", "upgrade", "minigame", "referral", "referral_bonus",
+    "withdrawal", "withdrawal_refund", "admin_adjustment", "admin_reset"
+)
+
+def _aggregate_taps(rows):
+    """
+    Collapse a batch's tap entries into one entry per user
+    """
+    aggregated = []
+    taps = {}
+    for row in rows:
+        if row["type"] != "tap":
+            aggregated.append(row)
+            continue
+        total = taps.get(row["user_id"])
+        if total is None:
+            total = taps[row["user_id"]] = dict(row)
+            aggregated.append(total)
+        else:
+            total["amount"] += row["amount"]
+            total["taps"] += row["taps"]
+            total["created_at"] = max(total["created_at"], row["created_at"])
+    for total in taps.values():
+        total["description"] = f"Earned from {total['taps']} taps"
+    return aggregated
+
+class Ledger:
+    """
+    Append-only record of every coin movement. Entries are queued and
+    written in batches by a background thread (see BatchWriter), so
+    recording never adds a round trip to a request. Taps are aggregated into
+    one entry per user per batch, and each batch also advances the users'
+    ledger_balances snapshots.
+    """
+
+    def __init__(self, append_fn, enabled=LEDGER_ENABLED, batch_size=LEDGER_BATCH_SIZE,
+                 flush_interval=LEDGER_FLUSH_INTERVAL, max_queue=LEDGER_MAX_QUEUE, spill_path=LEDGER_SPILL_PATH):
+        self.append_fn = append_fn
+        self.enabled = enabled
+        self.writer = BatchWriter(self._append, "ledger", batch_size, flush_interval, max_queue, spill_path=spill_path)
+
+    def record(self, user_id, transaction_type, amount, description=None, current_time=None):
+        """
+        Queue a ledger entry; zero amounts are not recorded
+        """
+        if not self.enabled or not amount:
+            return
+        if transaction_type not in TRANSACTION_TYPES:
+            raise ValueError(f"Unknown transaction type: {transaction_type}")
+        self.writer.put({
+            "user_id": str(user_id),
+            "type": transaction_type,
+            "amount": int(amount),
+            "description": description,
+            "created_at": int(current_time or time.time())
+        })
+
+    def record_taps(self, user_id, taps, coins, current_time=None):
+        """
+        Queue coins earned from taps, merged with the user's other taps in the batch
+        """
+        if not self.enabled or not coins:
+            return
+        self.writer.put({
+            "user_id": str(user_id),
+            "type": "tap",
+            "amount": int(coins),
+            "taps": int(taps),
+            "description": None,
+            "created_at": int(current_time or time.time())
+        })
+
+    def _append(self, rows):
+        self.append_fn(_aggregate_taps(rows))
+
+    def flush(self):
+        self.writer.flush()
+
+    def stop(self):
+        self.writer.stop()
+
+    def metrics(self):
+        return dict(self.writer.metrics(), enabled=self.enabled)
+
+ledger = Ledger(lambda rows: storage.transactions.append(rows))
+
+class Transaction:
+    """
+    One ledger entry. Saving queues it for the next batch write.
+    """
+
+    def __init__(self, user_id, transaction_type, amount, description=None, created_at=None, id=None):
+        self.id = id
+        self.user_id = str(user_id)
+        self.transaction_type = transaction_type
+        self.amount = amount
+        self.description = description
+        self.created_at = created_at
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            user_id=row["user_id"],
+            transaction_type=row["type"],
+            amount=row["amount"],
+            description=row.get("description"),
+            created_at=row.get("created_at"),
+            id=row.get("id")
+        )
+
+    def save(self):
+        ledger.record(self.user_id, self.transaction_type, self.amount, self.description, self.created_at)
+
+    @classmethod
+    def get_by_user_id(cls, user_id, after_id=None, limit=20):
+        """
+        A page of a user's written transactions, newest first
+        """
+        return [cls.from_row(row) for row in storage.transactions.page(user_id, after_id, limit)]
+
+    @staticmethod
+    def balance(user_id):
+        """
+        The user's ledger_balances snapshot, or None
+        """
+        return storage.transactions.balance(user_id)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "type": self.transaction_type,
+            "amount": self.amount,
+            "description": self.description,
+            "created_at": self.created_at
+        }
@@ -1,4 +1,12 @@
-from src.config.database import supabase
+from src.models.cache import LRUCache
+from src.models.leaderboard import Leaderboards
+from src.models.referral_credits import ReferralCreditMerger
+from src.models.transaction import ledger
+from src.storage import storage
+from src.storage.base import USER_COLUMNS, energy_at
+from src.models.write_behind import WriteBehindBuffer
+import copy
+import os
 import time
 import logging
 
@@ -6,7 +14,49 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# In-process cache of hydrated users, kept current on save and atomic mutations
+USER_CACHE_ENABLED = os.environ.get("USER_CACHE_ENABLED", "true").lower() == "true"
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+# Bounds how stale a user can look to other workers, which keep their own cache
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 5))
+
+user_cache = LRUCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, enabled=USER_CACHE_ENABLED)
+
+# Short-lived cache of referral stats responses, dropped when the referrer gains a referral
+REFERRAL_STATS_CACHE_TTL = float(os.environ.get("REFERRAL_STATS_CACHE_TTL", 30))
+referral_stats_cache = LRUCache(
+    max_size=int(os.environ.get("REFERRAL_STATS_CACHE_SIZE", 10000)),
+    ttl=REFERRAL_STATS_CACHE_TTL
+)
+
+# Coins credited per referral as (referee bonus, referrer bonus)
+REFERRAL_CODE_BONUS = (500, 500) # Referral code entered in the app
+REFERRAL_SIGNUP_BONUS = (0, 100) # New user arriving through a referral link
+
+def _leaderboard_rows(batch_size):
+    """
+    Every user's balance, read in id order one keyset page at a time
+    """
+    after = None
+    while True:
+        rows = storage.users.page("id, telegram_id, coins", "created", after, None, batch_size)
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        after = (rows[-1]["id"], rows[-1]["id"])
+
+# All-time ranks kept current from every user row the model reads or
+# writes; earning events feed the daily and weekly windows
+leaderboards = Leaderboards(_leaderboard_rows)
+
+# Persisted columns, excluding the database id
+_COLUMNS = USER_COLUMNS[1:]
+_COLUMN_INDEX = {column: index for index, column in enumerate(_COLUMNS)}
+
 class User:
+    # Slots keep users compact so large batches (admin, leaderboard, broadcasts) fit in memory
+    __slots__ = USER_COLUMNS + ("_loaded",)
+
     def __init__(self, telegram_id, username=None, first_name=None, coins=0, energy=100, max_energy=100, 
                  tap_power=1, energy_regen_rate=1, last_energy_update=None, referred_by=None, 
                  referral_count=0, referral_earnings=0, upi_id=None, id=None):
@@ -24,33 +74,110 @@ class User:
         self.referral_count = int(referral_count) # Ensure referral_count is integer
         self.referral_earnings = int(referral_earnings) # Ensure referral_earnings is integer
         self.upi_id = upi_id
+        # Column values (in _COLUMNS order) as last read or written; None for new users
+        self._loaded = None
+
+    def current_energy(self, current_time=None):
+        """
+        Energy available now, derived from the stored (energy, last_energy_update) pair
+        """
+        return energy_at(self.energy, self.last_energy_update, self.max_energy, self.energy_regen_rate,
+                         int(current_time or time.time()))
+
+    def settle_energy(self, current_time=None):
+        """
+        Fold regenerated energy into the stored pair (in memory only), before
+        energy is spent or max_energy changes
+        """
+        current_time = int(current_time or time.time())
+        self.energy = self.current_energy(current_time)
+        self.last_energy_update = current_time
+        return self
+
+    @classmethod
+    def from_row(cls, user_data):
+        """
+        Build a user from a users table row. Skips __init__ so bulk hydration stays cheap.
+        """
+        def get(key, default=None):
+            # Only missing or NULL columns take the default; stored zeros are kept
+            value = user_data.get(key, default)
+            return default if value is None else value
+
+        user = cls.__new__(cls)
+        user.id = get("id")
+        user.telegram_id = str(get("telegram_id"))
+        user.username = get("username")
+        user.first_name = get("first_name")
+        user.coins = int(get("coins", 0))
+        user.energy = float(get("energy", 100))
+        user.max_energy = int(get("max_energy", 100))
+        user.tap_power = int(get("tap_power", 1))
+        user.energy_regen_rate = float(get("energy_regen_rate", 1))
+        user.last_energy_update = int(get("last_energy_update", int(time.time())))
+        referred_by = get("referred_by")
+        user.referred_by = str(referred_by) if referred_by else None
+        user.referral_count = int(get("referral_count", 0))
+        user.referral_earnings = int(get("referral_earnings", 0))
+        user.upi_id = get("upi_id")
+        user._loaded = user._values()
+        leaderboards.observe(user.telegram_id, user.coins)
+        return user
+
+    @classmethod
+    def get_many(cls, telegram_ids, use_cache=True):
+        """
+        Get many users by Telegram ID, keyed by telegram_id. Cached users are
+        reused and the rest are fetched with chunked `in` queries; bulk results
+        are not added to the cache so they cannot evict hot users.
+        """
+        users = {}
+        missing = []
+        for telegram_id in dict.fromkeys(str(telegram_id) for telegram_id in telegram_ids):
+            cached = user_cache.get(telegram_id) if use_cache else None
+            if cached is not None:
+                users[telegram_id] = copy.copy(cached)
+            else:
+                missing.append(telegram_id)
+        
+        if missing:
+            for user_data in storage.users.get_many(missing):
+                user = cls.from_row(user_data)
+                users[user.telegram_id] = user
+        return users
+
+    @classmethod
+    def _cache_row(cls, user_data):
+        """
+        Build a user from a freshly read or written row and cache it
+        """
+        user = cls.from_row(user_data)
+        user_cache.set(user.telegram_id, copy.copy(user))
+        return user
+
+    @classmethod
+    def invalidate_cache(cls, telegram_id):
+        """
+        Forget a cached user after a write that bypassed the model
+        """
+        user_cache.invalidate(str(telegram_id))
 
     @classmethod
-    def get_by_telegram_id(cls, telegram_id):
+    def get_by_telegram_id(cls, telegram_id, use_cache=True):
         """
-        Get user by Telegram ID
+        Get user by Telegram ID. use_cache=False reads the stored row, for
+        writes that must not be diffed against a stale cached copy.
         """
+        cached = user_cache.get(str(telegram_id)) if use_cache else None
+        if cached is not None:
+            # Callers mutate the result, so never hand out the cached object
+            return copy.copy(cached)
+        
         try:
-            response = supabase.table("users").select("*").eq("telegram_id", str(telegram_id)).execute()
+            user_data = storage.users.get(telegram_id)
             
-            if response.data and len(response.data) > 0:
-                user_data = response.data[0]
-                return cls(
-                    id=user_data.get("id"),
-                    telegram_id=user_data.get("telegram_id"),
-                    username=user_data.get("username"),
-                    first_name=user_data.get("first_name"),
-                    coins=user_data.get("coins", 0),
-                    energy=user_data.get("energy", 100),
-                    max_energy=user_data.get("max_energy", 100),
-                    tap_power=user_data.get("tap_power", 1),
-                    energy_regen_rate=user_data.get("energy_regen_rate", 1),
-                    last_energy_update=user_data.get("last_energy_update"),
-                    referred_by=user_data.get("referred_by"),
-                    referral_count=user_data.get("referral_count", 0),
-                    referral_earnings=user_data.get("referral_earnings", 0),
-                    upi_id=user_data.get("upi_id")
-                )
+            if user_data:
+                return cls._cache_row(user_data)
             return None
         except Exception as e:
             logger.error(f"Error in get_by_telegram_id: {str(e)}")
@@ -68,84 +195,200 @@ class User:
                 last_energy_update=int(time.time())
             )
 
-    def save(self):
+    @classmethod
+    def tap_atomic(cls, telegram_id, taps, current_time=None):
         """
-        Save user to database
+        Spend up to `taps` energy and credit coins in one atomic step.
+        Returns (user, accepted_taps), or (None, 0) if the user does not exist.
         """
-        try:
-            user_data = self.to_dict()
-            
-            # Remove id from dict if it's None
-            if "id" in user_data and user_data["id"] is None:
-                del user_data["id"]
-            
-            # Ensure last_energy_update is an integer
-            if "last_energy_update" in user_data and user_data["last_energy_update"] is not None:
-                user_data["last_energy_update"] = int(user_data["last_energy_update"])
-            
-            # Check if user already exists
-            existing_user = None
-            if self.id:
-                existing_user = self.id
-            else:
-                existing_response = supabase.table("users").select("id").eq("telegram_id", self.telegram_id).execute()
-                if existing_response.data and len(existing_response.data) > 0:
-                    existing_user = existing_response.data[0].get("id")
-            
-            if existing_user:
-                # Update existing user
-                response = supabase.table("users").update(user_data).eq("id", existing_user).execute()
-            else:
-                # Create new user
-                response = supabase.table("users").insert(user_data).execute()
-            
-            if response.data and len(response.data) > 0:
-                self.id = response.data[0].get("id")
-            
+        current_time = int(current_time or time.time())
+        row, accepted = storage.users.tap(telegram_id, taps, current_time)
+        if row is None:
+            return None, 0
+        earned = accepted * int(row.get("tap_power") or 1)
+        ledger.record_taps(telegram_id, accepted, earned, current_time)
+        leaderboards.earned(telegram_id, earned, current_time)
+        return cls._cache_row(row), accepted
+
+    @classmethod
+    def apply_delta(cls, telegram_id, coins=0, min_coins=None, clamp_coins=False, tap_power=0,
+                    max_energy=0, energy_regen_rate=0, expect=None, current_time=None):
+        """
+        Atomically add deltas to a user's balance and upgrade levels.
+        `min_coins` guards the debit (coins >= min_coins before applying),
+        `clamp_coins` floors the resulting balance at zero and `expect` maps
+        fields to the values the change was priced against.
+        Returns the updated user, or None if the user is missing or a guard failed.
+        """
+        row = storage.users.apply_delta(
+            telegram_id,
+            coins=coins,
+            min_coins=min_coins,
+            clamp_coins=clamp_coins,
+            tap_power=tap_power,
+            max_energy=max_energy,
+            energy_regen_rate=energy_regen_rate,
+            expect=expect,
+            current_time=int(current_time or time.time())
+        )
+        if row is None:
+            cls.invalidate_cache(telegram_id)
+            return None
+        return cls._cache_row(row)
+
+    @classmethod
+    def tap_buffered(cls, telegram_id, taps, current_time=None):
+        """
+        Write-behind variant of tap_atomic: validates against stored energy
+        minus pending taps and queues the delta instead of writing it.
+        Returns (user, accepted_taps) with pending deltas applied to the user.
+        """
+        current_time = int(current_time or time.time())
+        # Stored state only changes on flush, so a cached user is as good as a fresh read
+        user = cls.get_by_telegram_id(telegram_id)
+        if not user:
+            return None, 0
+        accepted, _ = write_behind.reserve_taps(
+            telegram_id, taps, user.tap_power, user.current_energy(current_time)
+        )
+        earned = accepted * int(user.tap_power)
+        ledger.record_taps(telegram_id, accepted, earned, current_time)
+        leaderboards.earned(telegram_id, earned, current_time)
+        return user.with_pending(current_time), accepted
+
+    @classmethod
+    def apply_tap_deltas(cls, deltas, current_time=None):
+        """
+        Apply many {"telegram_id", "coins", "energy"} tap deltas in bulk:
+        coins are added and the spent energy is taken off the regenerated energy.
+        Returns the deltas that could not be applied.
+        """
+        rows, failed = storage.users.apply_tap_deltas(deltas, int(current_time or time.time()))
+        for row in rows:
+            cls._cache_row(row)
+        return failed
+
+    @classmethod
+    def apply_referral(cls, referrer_id, telegram_id, referee_bonus, referrer_bonus, new_user=None, current_time=None):
+        """
+        Credit a referral once, atomically: creates the referee from
+        `new_user` (a User) if missing, then adds both bonuses. Replays and
+        concurrent calls for the same referee never credit twice.
+        Returns (status, user, referrer); status is "applied", "duplicate",
+        "already_referred" or "invalid_referrer".
+        """
+        new_user = new_user or cls(telegram_id=telegram_id)
+        status, user_row, referrer_row = storage.users.apply_referral(
+            referrer_id,
+            telegram_id,
+            new_user.changed_fields(),
+            referee_bonus,
+            referrer_bonus,
+            int(current_time or time.time())
+        )
+        user = cls._cache_row(user_row) if user_row else None
+        referrer = cls._cache_row(referrer_row) if referrer_row else None
+        if status == "applied":
+            # The referrer's bonus lands when its credit is merged
+            referral_credits.credited(referrer_id)
+            ledger.record(telegram_id, "referral_bonus", referee_bonus, f"Referred by {referrer_id}", current_time)
+            ledger.record(referrer_id, "referral", referrer_bonus, f"Referred {telegram_id}", current_time)
+            leaderboards.earned(telegram_id, referee_bonus, current_time)
+            leaderboards.earned(referrer_id, referrer_bonus, current_time)
+        return status, user, referrer
+
+    @classmethod
+    def withdraw(cls, telegram_id, amount, withdrawal, idempotency_key=None):
+        """
+        Debit `amount` coins and record the `withdrawal` row in one atomic
+        step. Replays with the same idempotency key return the stored
+        withdrawal instead of debiting again.
+        Returns (status, withdrawal_row, user); status is "created",
+        "replayed", "insufficient_funds" or "user_not_found".
+        """
+        status, withdrawal_row, user_row = storage.withdrawals.create(telegram_id, amount, withdrawal, idempotency_key)
+        if status == "created":
+            ledger.record(telegram_id, "withdrawal", -int(amount), f"Withdrawal #{withdrawal_row.get('id')}")
+        if user_row is None:
+            cls.invalidate_cache(telegram_id)
+            return status, withdrawal_row, None
+        return status, withdrawal_row, cls._cache_row(user_row)
+
+    @classmethod
+    def merge_referral_credits(cls, referrer_id=None, limit=None):
+        """
+        Fold pending referral credits into the referrers' rows.
+        Returns (users, merged_credit_count).
+        """
+        rows, merged = storage.users.merge_referral_credits(referrer_id, limit)
+        users = []
+        for row in rows:
+            user = cls._cache_row(row)
+            referral_stats_cache.invalidate(user.telegram_id)
+            users.append(user)
+        return users, merged
+
+    def with_pending(self, current_time=None):
+        """
+        Apply this user's unflushed write-behind delta (in memory only)
+        """
+        delta = write_behind.pending_for(self.telegram_id)
+        if delta:
+            self.settle_energy(current_time)
+            self.energy = max(0.0, self.energy - delta["energy"])
+            self.coins += delta["coins"]
+            if self._loaded is not None:
+                # The flush writes these, so save() must not treat them as changes
+                loaded = list(self._loaded)
+                for field in ("coins", "energy", "last_energy_update"):
+                    loaded[_COLUMN_INDEX[field]] = getattr(self, field)
+                self._loaded = tuple(loaded)
+        return self
+
+    def changed_fields(self):
+        """
+        Columns whose values differ from what was loaded (every column for new users)
+        """
+        values = self._values()
+        if self._loaded is None:
+            return dict(zip(_COLUMNS, values))
+        return {
+            field: value
+            for field, value, loaded in zip(_COLUMNS, values, self._loaded)
+            if value != loaded
+        }
+
+    def save(self, force=()):
+        """
+        Save user to database: a single upsert on telegram_id carrying only
+        the changed columns, plus the `force` columns whatever was loaded.
+        Saving an unchanged user is a no-op.
+        """
+        changes = self.changed_fields()
+        changes.update({field: getattr(self, field) for field in force if field not in changes})
+        if not changes:
             return self
+        
+        try:
+            stored = storage.users.upsert(self.telegram_id, changes)
         except Exception as e:
-            logger.error(f"Error in save: {str(e)}")
-            
-            # Try again without problematic fields if there's an error
-            try:
-                user_data = self.to_dict()
-                
-                # Remove id from dict if it's None
-                if "id" in user_data and user_data["id"] is None:
-                    del user_data["id"]
-                
-                # Remove problematic fields
-                if "last_energy_update" in user_data:
-                    user_data["last_energy_update"] = int(time.time())
-                
-                if "upi_id" in user_data and "upi_id" in str(e):
-                    del user_data["upi_id"]
-                
-                # Check if user already exists
-                existing_user = None
-                if self.id:
-                    existing_user = self.id
-                else:
-                    existing_response = supabase.table("users").select("id").eq("telegram_id", self.telegram_id).execute()
-                    if existing_response.data and len(existing_response.data) > 0:
-                        existing_user = existing_response.data[0].get("id")
-                
-                if existing_user:
-                    # Update existing user
-                    response = supabase.table("users").update(user_data).eq("id", existing_user).execute()
-                else:
-                    # Create new user
-                    response = supabase.table("users").insert(user_data).execute()
-                
-                if response.data and len(response.data) > 0:
-                    self.id = response.data[0].get("id")
-                
-                return self
-            except Exception as e2:
-                logger.error(f"Error in save (retry): {str(e2)}")
-            
-            logger.warning(f"Failed to save user {self.telegram_id} to database")
-            return self
+            logger.error(f"Error saving user {self.telegram_id}: {str(e)}")
+            user_cache.invalidate(self.telegram_id)
+            raise
+        
+        if stored:
+            self.id = stored.get("id")
+        self._loaded = self._values()
+        leaderboards.observe(self.telegram_id, self.coins)
+        user_cache.set(self.telegram_id, copy.copy(self))
+        return self
+
+    def _values(self):
+        values = [getattr(self, column) for column in _COLUMNS]
+        last_energy_update = values[_COLUMN_INDEX["last_energy_update"]]
+        if last_energy_update is not None:
+            values[_COLUMN_INDEX["last_energy_update"]] = int(last_energy_update)
+        return tuple(values)
 
     def to_dict(self):
         """
@@ -168,5 +411,8 @@ class User:
             "upi_id": self.upi_id
         }
 
+# Optional write-behind buffer for tap deltas (see src/models/write_behind.py)
+write_behind = WriteBehindBuffer(User.apply_tap_deltas)
 
-
+# Background merge of referrer bonuses (see src/models/referral_credits.py)
+referral_credits = ReferralCreditMerger(User.merge_referral_credits)
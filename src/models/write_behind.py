@@ -0,0 +1,205 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Write-behind is opt-in: taps are acknowledged before they reach the database
+WRITE_BEHIND_ENABLED = os.environ.get("WRITE_BEHIND_ENABLED", "false").lower() == "true"
+# Seconds between background flushes
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL", 2))
+# Number of users with pending deltas that triggers an early flush
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get("WRITE_BEHIND_MAX_PENDING", 500))
+
+class WriteBehindBuffer:
+    """
+    Accumulates per-user tap deltas in process memory and flushes them in bulk.
+
+    Each pending entry holds the coins earned and the energy spent since the
+    last flush. `flush_fn(deltas, current_time)` receives a list of
+    {"telegram_id", "coins", "energy"} dicts, applies them in one go and
+    returns the ones that failed; if it raises, none are considered applied.
+    Buffers are per process, so with several workers the energy check is
+    only exact within a worker; the flush never lets energy go below zero.
+    """
+
+    def __init__(self, flush_fn, enabled=WRITE_BEHIND_ENABLED, flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+                 max_pending=WRITE_BEHIND_MAX_PENDING):
+        self.flush_fn = flush_fn
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Metrics
+        self._flushes = 0
+        self._flushed_users = 0
+        self._failed_flushes = 0
+        self._last_flush_at = None
+        self._last_flush_duration = 0.0
+        self._last_flush_lag = 0.0
+
+    def reserve_taps(self, telegram_id, taps, tap_power, available_energy):
+        """
+        Accept up to `taps` taps against `available_energy` minus what is
+        already pending for the user. Returns (accepted, pending_delta).
+        """
+        telegram_id = str(telegram_id)
+        with self._lock:
+            delta = self._pending.get(telegram_id)
+            spent = delta["energy"] if delta else 0
+            accepted = max(0, min(int(taps), int(available_energy - spent)))
+            if accepted > 0:
+                if not delta:
+                    delta = {"coins": 0, "energy": 0, "since": time.time()}
+                    self._pending[telegram_id] = delta
+                delta["coins"] += accepted * int(tap_power)
+                delta["energy"] += accepted
+            snapshot = dict(delta) if delta else None
+            pending_users = len(self._pending)
+
+        if accepted > 0:
+            self._ensure_started()
+            if pending_users >= self.max_pending:
+                self._wakeup.set()
+        return accepted, snapshot
+
+    def pending_for(self, telegram_id):
+        """
+        Pending delta for a user, or None
+        """
+        with self._lock:
+            delta = self._pending.get(str(telegram_id))
+            return dict(delta) if delta else None
+
+    def flush(self):
+        """
+        Flush all pending deltas
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = {}
+            self._write(batch)
+
+    def flush_user(self, telegram_id):
+        """
+        Flush one user's pending delta, used before money is moved
+        """
+        telegram_id = str(telegram_id)
+        with self._flush_lock:
+            with self._lock:
+                delta = self._pending.pop(telegram_id, None)
+            if delta:
+                self._write({telegram_id: delta})
+
+    def discard_user(self, telegram_id):
+        """
+        Drop a user's pending delta without writing it
+        """
+        with self._lock:
+            self._pending.pop(str(telegram_id), None)
+
+    def _write(self, batch):
+        if not batch:
+            return
+        started = time.time()
+        oldest = min(delta["since"] for delta in batch.values())
+        deltas = [
+            {"telegram_id": telegram_id, "coins": delta["coins"], "energy": delta["energy"]}
+            for telegram_id, delta in batch.items()
+        ]
+        try:
+            failed = self.flush_fn(deltas, int(started)) or []
+        except Exception as e:
+            logger.error(f"Error flushing {len(deltas)} pending user deltas: {str(e)}")
+            self._requeue(batch, batch.keys())
+            raise
+        if failed:
+            self._requeue(batch, [delta["telegram_id"] for delta in failed])
+            raise RuntimeError(f"Failed to flush {len(failed)} of {len(deltas)} pending user deltas")
+
+        finished = time.time()
+        self._flushes += 1
+        self._flushed_users += len(deltas)
+        self._last_flush_at = finished
+        self._last_flush_duration = finished - started
+        self._last_flush_lag = finished - oldest
+
+    def _requeue(self, batch, telegram_ids):
+        """
+        Put unwritten deltas back so they are retried on the next flush
+        """
+        self._failed_flushes += 1
+        with self._lock:
+            for telegram_id in telegram_ids:
+                delta = batch[telegram_id]
+                current = self._pending.get(telegram_id)
+                if current:
+                    current["coins"] += delta["coins"]
+                    current["energy"] += delta["energy"]
+                    current["since"] = min(current["since"], delta["since"])
+                else:
+                    self._pending[telegram_id] = delta
+
+    def _ensure_started(self):
+        if self._thread or self._stopped.is_set():
+            return
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name="write-behind-flusher", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Already logged, deltas are retried next round
+                pass
+
+    def stop(self):
+        """
+        Stop the background flusher and flush what is left (graceful shutdown)
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.flush_interval + 5)
+        try:
+            self.flush()
+        except Exception:
+            logger.error("Pending user deltas lost on shutdown")
+
+    def metrics(self):
+        """
+        Flush lag and throughput metrics
+        """
+        now = time.time()
+        with self._lock:
+            pending_users = len(self._pending)
+            oldest = min((delta["since"] for delta in self._pending.values()), default=None)
+        return {
+            "enabled": self.enabled,
+            "pending_users": pending_users,
+            "current_lag_seconds": round(now - oldest, 3) if oldest else 0.0,
+            "last_flush_lag_seconds": round(self._last_flush_lag, 3),
+            "last_flush_duration_seconds": round(self._last_flush_duration, 3),
+            "last_flush_at": self._last_flush_at,
+            "flushes": self._flushes,
+            "flushed_users": self._flushed_users,
+            "failed_flushes": self._failed_flushes
+        }
@@ -0,0 +1,155 @@
+from collections import OrderedDict
+from functools import wraps
+from flask import jsonify, request
+import logging
+import math
+import os
+import threading
+import time
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# Trusted proxies in front of the app; the client IP is taken from that many
+# entries from the end of X-Forwarded-For. 0 uses the socket address, since
+# without a proxy clients write X-Forwarded-For themselves. Set it to match
+# the deployment (1 on Render, which adds one entry).
+RATE_LIMIT_PROXY_HOPS = int(os.environ.get("RATE_LIMIT_PROXY_HOPS", 0))
+# An IP bucket holds this many times a user's bucket, for users sharing a NAT
+RATE_LIMIT_IP_MULTIPLIER = float(os.environ.get("RATE_LIMIT_IP_MULTIPLIER", 5))
+# Buckets kept per limiter; the least recently used are dropped first
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))
+
+# Default buckets per endpoint as (capacity, tokens refilled per second).
+# Override with RATE_LIMIT_<NAME>="capacity/per_second", e.g. RATE_LIMIT_TAP="40/20".
+DEFAULT_RATE_LIMITS = {
+    "tap": (40, 20),
+    "tap_batch": (10, 2),
+    "minigame_reward": (5, 0.2),
+    "upgrade": (10, 1)
+}
+
+def _configured_limit(name):
+    capacity, refill_rate = DEFAULT_RATE_LIMITS[name]
+    value = os.environ.get(f"RATE_LIMIT_{name.upper()}")
+    if value:
+        try:
+            capacity, refill_rate = (float(part) for part in value.split("/"))
+        except ValueError:
+            logger.error(f"Ignoring malformed RATE_LIMIT_{name.upper()}={value!r}, expected capacity/per_second")
+    return capacity, refill_rate
+
+class TokenBucketLimiter:
+    """
+    In-memory token buckets keyed by an arbitrary string. Each bucket holds
+    up to `capacity` tokens and refills at `refill_rate` tokens per second;
+    a request spends one. Buckets are per process.
+    """
+
+    def __init__(self, capacity, refill_rate, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.capacity = float(capacity)
+        self.refill_rate = float(refill_rate)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.allowed = 0
+        self.rejected = 0
+
+    def allow(self, key, cost=1.0):
+        """
+        Spend `cost` tokens from key's bucket. Returns (allowed, retry_after_seconds).
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = self.capacity
+                if len(self._buckets) >= self.max_keys:
+                    # The oldest bucket has been refilling longest, so dropping it rarely matters
+                    self._buckets.popitem(last=False)
+            else:
+                tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.refill_rate)
+                self._buckets.move_to_end(key)
+
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                self.allowed += 1
+                return True, 0
+            self._buckets[key] = (tokens, now)
+            self.rejected += 1
+            if self.refill_rate <= 0:
+                return False, 60
+            return False, math.ceil((cost - tokens) / self.refill_rate)
+
+    def stats(self):
+        with self._lock:
+            keys = len(self._buckets)
+        return {
+            "capacity": self.capacity,
+            "refill_per_second": self.refill_rate,
+            "keys": keys,
+            "allowed": self.allowed,
+            "rejected": self.rejected
+        }
+
+# Limiters by endpoint name, as (per user, per IP)
+limiters = {}
+
+def client_ip():
+    """
+    The client address, as seen by the outermost trusted proxy
+    """
+    forwarded = [part.strip() for part in request.headers.get("X-Forwarded-For", "").split(",") if part.strip()]
+    if RATE_LIMIT_PROXY_HOPS and len(forwarded) >= RATE_LIMIT_PROXY_HOPS:
+        return forwarded[-RATE_LIMIT_PROXY_HOPS]
+    return request.remote_addr or "unknown"
+
+def _telegram_id():
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and data.get("telegram_id") is not None:
+        return str(data["telegram_id"])
+    return (request.view_args or {}).get("telegram_id")
+
+def rate_limited(name):
+    """
+    Route decorator applying the `name` buckets per telegram_id and per
+    client IP. Routes sharing a name share buckets. Rejections are 429s
+    with Retry-After, decided in memory.
+    """
+    if name not in limiters:
+        capacity, refill_rate = _configured_limit(name)
+        limiters[name] = (
+            TokenBucketLimiter(capacity, refill_rate),
+            TokenBucketLimiter(capacity * RATE_LIMIT_IP_MULTIPLIER, refill_rate * RATE_LIMIT_IP_MULTIPLIER)
+        )
+    user_limiter, ip_limiter = limiters[name]
+
+    def decorator(view):
+        @wraps(view)
+        def limited(*args, **kwargs):
+            if RATE_LIMIT_ENABLED:
+                allowed, retry_after = ip_limiter.allow(client_ip())
+                telegram_id = _telegram_id()
+                if allowed and telegram_id:
+                    allowed, retry_after = user_limiter.allow(telegram_id)
+                if not allowed:
+                    response = jsonify({"error": "Too many requests", "retry_after": retry_after})
+                    response.status_code = 429
+                    response.headers["Retry-After"] = str(retry_after)
+                    return response
+            return view(*args, **kwargs)
+        return limited
+    return decorator
+
+def rate_limit_stats():
+    """
+    Bucket counters per endpoint
+    """
+    return {
+        name: {"per_user": user_limiter.stats(), "per_ip": ip_limiter.stats()}
+        for name, (user_limiter, ip_limiter) in limiters.items()
+    }
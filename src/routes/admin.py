@@ -1,8 +1,17 @@
 from flask import Blueprint, render_template, jsonify, request, redirect, url_for, session, flash
-from src.models.user import User
-from src.config.database import supabase
+from src.bot import update_dispatcher
+from src.load_shedding import admission
+from src.models.broadcast import BROADCAST_STATUSES, PARSE_MODES, broadcast_to_dict, broadcasts
+from src.models.minigame_rewards import minigame_reward_log
+from src.models.transaction import ledger
+from src.models.user import User, leaderboards, referral_credits, user_cache, write_behind
+from src.rate_limit import rate_limit_stats
+from src.storage import storage
+from src.storage.base import CREATED_AT_PATTERN, USER_SORT_COLUMNS, decode_cursor, encode_cursor
+from src.telegram_api import outbox_metrics
 import logging
 import os
+import re
 import time
 from functools import wraps
 
@@ -16,6 +25,46 @@ admin_bp = Blueprint("admin", __name__)
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME", "admin")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "AlphaWulf@#321admin") # Set admin password
 
+# User listing page size (default and upper bound)
+USERS_PAGE_SIZE = int(os.environ.get("ADMIN_USERS_PAGE_SIZE", 50))
+USERS_MAX_PAGE_SIZE = 200
+USER_LIST_COLUMNS = "id, telegram_id, username, first_name, coins, energy, max_energy, tap_power, referral_count, referral_earnings, last_energy_update"
+# Telegram usernames and IDs only contain these characters
+USER_SEARCH_PATTERN = re.compile(r"^[A-Za-z0-9_]{1,64}$")
+
+# Withdrawal queue page size and the most ids one bulk review may touch
+WITHDRAWALS_PAGE_SIZE = int(os.environ.get("ADMIN_WITHDRAWALS_PAGE_SIZE", 50))
+WITHDRAWALS_MAX_PAGE_SIZE = 200
+WITHDRAWAL_BULK_MAX_IDS = 1000
+# Queue filters; "all" lists pending withdrawals (oldest first) before the
+# rest (newest first)
+WITHDRAWAL_QUEUE_STATUSES = ("all", "pending", "completed", "rejected")
+WITHDRAWAL_ACTIONS = {"approve": "completed", "reject": "rejected"}
+# Columns reset_user_data writes back to their new-user values (coins are
+# set separately, against the stored balance)
+RESET_COLUMNS = (
+    "energy", "max_energy", "tap_power", "energy_regen_rate", "last_energy_update",
+    "referral_count", "referral_earnings", "upi_id"
+)
+# Tries at a balance change before concurrent taps are reported as an error
+BALANCE_CHANGE_ATTEMPTS = 5
+
+def _change_coins(telegram_id, change):
+    """
+    Add `change(balance)` coins to a user's current balance, compare-and-set
+    on that balance so the ledger gets exactly what moved. Returns
+    (user, coins before), or (None, 0) if the user does not exist.
+    """
+    for _ in range(BALANCE_CHANGE_ATTEMPTS):
+        current = storage.users.get(telegram_id)
+        if current is None:
+            return None, 0
+        before = int(current["coins"] or 0)
+        user = User.apply_delta(telegram_id, coins=change(before), expect={"coins": before})
+        if user:
+            return user, before
+    raise RuntimeError(f"Balance of user {telegram_id} kept changing, try again")
+
 # Login required decorator
 def login_required(f):
     @wraps(f)
@@ -56,102 +105,277 @@ def admin_dashboard():
 @login_required
 def get_users():
     try:
-        # Get all users from database, including username and telegram_id
-        response = supabase.table("users").select("telegram_id, username, first_name, coins, energy, max_energy, tap_power, referral_count, referral_earnings, last_energy_update").execute()
+        sort = request.args.get("sort", "created")
+        if sort not in USER_SORT_COLUMNS:
+            return jsonify({"users": [], "error": f"sort must be one of {', '.join(USER_SORT_COLUMNS)}"}), 400
         
-        if response.data:
-            users = response.data
-            logger.info(f"Retrieved {len(users)} users")
-            return jsonify({"users": users})
-        else:
-            logger.info("Retrieved 0 users")
-            return jsonify({"users": []})
+        limit = request.args.get("limit", USERS_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, USERS_MAX_PAGE_SIZE))
+        
+        search = request.args.get("q", "").strip().lstrip("@")
+        if search and not USER_SEARCH_PATTERN.match(search):
+            return jsonify({"users": [], "error": "Search by username or Telegram ID prefix"}), 400
+        
+        cursor = request.args.get("cursor")
+        try:
+            after = decode_cursor(cursor, 2) if cursor else None
+            # Sort keys are numeric; anything else is a tampered cursor
+            if after and not (isinstance(after[1], int) and (after[0] is None or isinstance(after[0], (int, float)))):
+                raise ValueError("Invalid cursor")
+        except ValueError as e:
+            return jsonify({"users": [], "error": str(e)}), 400
+        
+        # Fetch one extra row to know whether there is a next page
+        users = storage.users.page(USER_LIST_COLUMNS, sort, after, search or None, limit + 1)
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            last = users[-1]
+            next_cursor = encode_cursor([last[USER_SORT_COLUMNS[sort]], last["id"]])
+        
+        logger.info(f"Retrieved {len(users)} users (sort={sort}, q={search!r})")
+        return jsonify({"success": True, "users": users, "next_cursor": next_cursor})
     except Exception as e:
         logger.error(f"Error retrieving users: {str(e)}")
         return jsonify({"users": [], "error": str(e)}), 500
 
+def _withdrawal_queue_phases(status):
+    """
+    (status, exclude_status, descending) for each ordered part of the queue
+    """
+    if status == "all":
+        return [("pending", None, False), (None, "pending", True)]
+    if status == "pending":
+        return [("pending", None, False)]
+    return [(status, None, True)]
+
 @admin_bp.route("/api/admin/withdrawals")
 @login_required
 def get_withdrawals():
     try:
-        # Get all withdrawals from database, ordered by created_at desc
-        response = supabase.table("withdrawals").select("*").order("created_at", desc=True).execute()
+        status = request.args.get("status", "all")
+        if status not in WITHDRAWAL_QUEUE_STATUSES:
+            return jsonify({"withdrawals": [], "error": f"status must be one of {', '.join(WITHDRAWAL_QUEUE_STATUSES)}"}), 400
         
-        if response.data:
-            withdrawals = response.data
-            logger.info(f"Retrieved {len(withdrawals)} withdrawals")
-            return jsonify({"withdrawals": withdrawals})
-        else:
-            logger.info("Retrieved 0 withdrawals")
-            return jsonify({"withdrawals": []})
+        limit = request.args.get("limit", WITHDRAWALS_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, WITHDRAWALS_MAX_PAGE_SIZE))
+        phases = _withdrawal_queue_phases(status)
+        
+        # Cursor is (queue phase, created_at, id) of the previous page's last row
+        cursor = request.args.get("cursor")
+        try:
+            phase, created_at, last_id = decode_cursor(cursor, 3) if cursor else (0, None, None)
+            if cursor and not (isinstance(phase, int) and 0 <= phase < len(phases) and isinstance(last_id, int)
+                               and isinstance(created_at, str) and CREATED_AT_PATTERN.match(created_at)):
+                raise ValueError("Invalid cursor")
+        except ValueError as e:
+            return jsonify({"withdrawals": [], "error": str(e)}), 400
+        
+        # Fill the page from each phase in turn, fetching one extra row to
+        # know whether there is a next page
+        rows = []
+        for index in range(phase, len(phases)):
+            only_status, exclude_status, descending = phases[index]
+            after = (created_at, last_id) if index == phase and last_id is not None else None
+            page = storage.withdrawals.page(only_status, after, limit + 1 - len(rows), descending, exclude_status)
+            rows.extend((index, withdrawal) for withdrawal in page)
+            if len(rows) > limit:
+                break
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            index, last = rows[-1]
+            next_cursor = encode_cursor([index, last["created_at"], last["id"]])
+        withdrawals = [withdrawal for _, withdrawal in rows]
+        
+        logger.info(f"Retrieved {len(withdrawals)} withdrawals (status={status})")
+        return jsonify({"success": True, "withdrawals": withdrawals, "next_cursor": next_cursor})
     except Exception as e:
         logger.error(f"Error retrieving withdrawals: {str(e)}")
         return jsonify({"withdrawals": [], "error": str(e)}), 500
 
-@admin_bp.route("/api/admin/stats")
+def _review_withdrawals(withdrawal_ids, action):
+    """
+    Apply an approve/reject action to pending withdrawals, refunding rejections
+    """
+    reviewed = storage.withdrawals.review(withdrawal_ids, WITHDRAWAL_ACTIONS[action], refund=action == "reject")
+    if action == "reject":
+        for user_id in {str(withdrawal["user_id"]) for withdrawal in reviewed}:
+            User.invalidate_cache(user_id)
+        for withdrawal in reviewed:
+            ledger.record(withdrawal["user_id"], "withdrawal_refund", withdrawal["amount"], f"Withdrawal #{withdrawal['id']} rejected")
+    return reviewed
+
+@admin_bp.route("/api/admin/withdrawals/bulk", methods=["POST"])
 @login_required
-def get_stats():
+def bulk_review_withdrawals():
     try:
-        # Get all users
-        users_response = supabase.table("users").select("*").execute()
-        users = users_response.data if users_response.data else []
-        
-        # Get all withdrawals
-        withdrawals_response = supabase.table("withdrawals").select("*").execute()
-        withdrawals = withdrawals_response.data if withdrawals_response.data else []
-        
-        # Calculate stats
-        total_users = len(users)
-        
-        # Active users in the last 24 hours
-        current_time = int(time.time())
-        active_users = sum(1 for user in users if user.get("last_energy_update") and current_time - user.get("last_energy_update") < 86400)
+        data = request.json or {}
+        action = data.get("action")
+        withdrawal_ids = data.get("ids") or []
         
-        # Total coins across all users
-        total_coins = sum(user.get("coins", 0) for user in users)
+        if action not in WITHDRAWAL_ACTIONS:
+            return jsonify({"success": False, "message": "action must be approve or reject"}), 400
+        if not isinstance(withdrawal_ids, list) or not all(isinstance(withdrawal_id, int) for withdrawal_id in withdrawal_ids):
+            return jsonify({"success": False, "message": "ids must be a list of withdrawal ids"}), 400
+        if not withdrawal_ids or len(withdrawal_ids) > WITHDRAWAL_BULK_MAX_IDS:
+            return jsonify({"success": False, "message": f"Send between 1 and {WITHDRAWAL_BULK_MAX_IDS} ids"}), 400
         
-        # Total withdrawals
-        total_withdrawals = len(withdrawals)
+        withdrawal_ids = list(dict.fromkeys(withdrawal_ids))
+        reviewed = _review_withdrawals(withdrawal_ids, action)
+        reviewed_ids = {withdrawal["id"] for withdrawal in reviewed}
+        skipped = [withdrawal_id for withdrawal_id in withdrawal_ids if withdrawal_id not in reviewed_ids]
         
-        # Pending withdrawals
-        pending_withdrawals = sum(1 for withdrawal in withdrawals if withdrawal.get("status") == "pending")
+        logger.info(f"Bulk {action}: {len(reviewed)} reviewed, {len(skipped)} skipped")
+        return jsonify({
+            "success": True,
+            "reviewed": len(reviewed),
+            "refunded": sum(int(withdrawal.get("amount") or 0) for withdrawal in reviewed) if action == "reject" else 0,
+            "skipped": skipped
+        })
+    except Exception as e:
+        logger.error(f"Error reviewing withdrawals: {str(e)}")
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@admin_bp.route("/api/admin/stats")
+@login_required
+def get_stats():
+    try:
+        # Counters are maintained by database triggers, so this reads one small table
+        stats = storage.stats.totals()
         
-        # Total withdrawn amount
-        total_withdrawn = sum(withdrawal.get("amount", 0) for withdrawal in withdrawals if withdrawal.get("status") == "completed")
+        # Users who tapped or upgraded in the last 24 hours (indexed range count).
+        # Opening the app writes nothing, so this is not a last-seen count.
+        current_time = int(time.time())
+        playing_users = storage.stats.count_playing_users(current_time - 86400)
         
-        logger.info(f"Stats: {total_users} users, {active_users} active, {total_coins} coins, {total_withdrawals} withdrawals")
+        logger.info(f"Stats: {stats['total_users']} users, {playing_users} playing, {stats['total_coins']} coins, {stats['total_withdrawals']} withdrawals")
         
         return jsonify({
-            "total_users": total_users,
-            "active_users": active_users,
-            "total_coins": total_coins,
-            "total_withdrawals": total_withdrawals,
-            "pending_withdrawals": pending_withdrawals,
-            "total_withdrawn": total_withdrawn
+            "total_users": stats["total_users"],
+            "playing_users": playing_users,
+            "total_coins": stats["total_coins"],
+            "total_withdrawals": stats["total_withdrawals"],
+            "pending_withdrawals": stats["pending_withdrawals"],
+            "completed_withdrawals": stats["completed_withdrawals"],
+            "total_withdrawn": stats["total_withdrawn"]
         })
     except Exception as e:
         logger.error(f"Error retrieving stats: {str(e)}")
         return jsonify({
             "total_users": 0,
-            "active_users": 0,
+            "playing_users": 0,
             "total_coins": 0,
             "total_withdrawals": 0,
             "pending_withdrawals": 0,
+            "completed_withdrawals": 0,
             "total_withdrawn": 0,
             "error": str(e)
         }), 500
 
+@admin_bp.route("/api/admin/stats/rebuild", methods=["POST"])
+@login_required
+def rebuild_stats():
+    try:
+        # Reconcile the counters with the base tables
+        stats = storage.stats.rebuild()
+        logger.info(f"Rebuilt stats counters: {stats}")
+        return jsonify({"success": True, "stats": stats})
+    except Exception as e:
+        logger.error(f"Error rebuilding stats: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@admin_bp.route("/api/admin/write_behind")
+@login_required
+def get_write_behind_metrics():
+    return jsonify(write_behind.metrics())
+
+@admin_bp.route("/api/admin/referral_credits")
+@login_required
+def get_referral_credit_metrics():
+    return jsonify(referral_credits.metrics())
+
+@admin_bp.route("/api/admin/ledger")
+@login_required
+def get_ledger_metrics():
+    return jsonify(ledger.metrics())
+
+@admin_bp.route("/api/admin/minigame_rewards")
+@login_required
+def get_minigame_reward_log_metrics():
+    return jsonify(minigame_reward_log.metrics())
+
+@admin_bp.route("/api/admin/rate_limits")
+@login_required
+def get_rate_limit_stats():
+    return jsonify(rate_limit_stats())
+
+@admin_bp.route("/api/admin/load_shedding")
+@login_required
+def get_load_shedding_stats():
+    return jsonify(admission.stats())
+
+@admin_bp.route("/api/admin/telegram")
+@login_required
+def get_telegram_outbox_metrics():
+    return jsonify(outbox_metrics())
+
+@admin_bp.route("/api/admin/updates")
+@login_required
+def get_update_dispatcher_metrics():
+    return jsonify(update_dispatcher.metrics())
+
+@admin_bp.route("/api/admin/users/<telegram_id>/ledger")
+@login_required
+def audit_user_ledger(telegram_id):
+    """
+    Compare a user's balance with their ledger_balances snapshot. Users who
+    had coins before the ledger existed show that opening balance as the difference.
+    """
+    try:
+        # Settle everything in flight so both sides describe the same moment,
+        # including credits written by other processes
+        write_behind.flush_user(telegram_id)
+        referral_credits.merge_user(telegram_id, force=True)
+        ledger.flush()
+        
+        user = storage.users.get(telegram_id)
+        if not user:
+            return jsonify({"success": False, "message": "User not found"}), 404
+        
+        snapshot = storage.transactions.balance(telegram_id) or {}
+        coins = int(user["coins"] or 0)
+        ledger_balance = int(snapshot.get("balance") or 0)
+        return jsonify({
+            "success": True,
+            "telegram_id": str(telegram_id),
+            "coins": coins,
+            "ledger_balance": ledger_balance,
+            "ledger_entries": int(snapshot.get("entries") or 0),
+            "last_transaction_id": snapshot.get("last_transaction_id"),
+            "difference": coins - ledger_balance
+        })
+    except Exception as e:
+        logger.error(f"Error auditing ledger for {telegram_id}: {str(e)}")
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@admin_bp.route("/api/admin/cache")
+@login_required
+def get_cache_stats():
+    return jsonify(user_cache.stats())
+
 @admin_bp.route("/api/admin/approve_withdrawal/<int:withdrawal_id>", methods=["POST"])
 @login_required
 def approve_withdrawal(withdrawal_id):
     try:
-        # Update withdrawal status to completed
-        response = supabase.table("withdrawals").update({"status": "completed"}).eq("id", withdrawal_id).execute()
-        
-        if response.data and len(response.data) > 0:
+        # Mark the withdrawal completed if it is still pending
+        if _review_withdrawals([withdrawal_id], "approve"):
             return jsonify({"success": True, "message": "Withdrawal approved"})
-        else:
-            return jsonify({"success": False, "message": "Withdrawal not found"}), 404
+        
+        if storage.withdrawals.get(withdrawal_id):
+            return jsonify({"success": False, "message": "Withdrawal is not pending"}), 409
+        return jsonify({"success": False, "message": "Withdrawal not found"}), 404
     except Exception as e:
         logger.error(f"Error approving withdrawal: {str(e)}")
         return jsonify({"success": False, "message": str(e)}), 500
@@ -160,42 +384,96 @@ def approve_withdrawal(withdrawal_id):
 @login_required
 def reject_withdrawal(withdrawal_id):
     try:
-        # Get withdrawal details
-        withdrawal_response = supabase.table("withdrawals").select("*").eq("id", withdrawal_id).execute()
+        # Reject and refund in one atomic call, only if still pending
+        if _review_withdrawals([withdrawal_id], "reject"):
+            return jsonify({"success": True, "message": "Withdrawal rejected and coins refunded"})
         
-        if not withdrawal_response.data or len(withdrawal_response.data) == 0:
-            return jsonify({"success": False, "message": "Withdrawal not found"}), 404
-        
-        withdrawal = withdrawal_response.data[0]
-        user_id = withdrawal.get("user_id")
-        amount = withdrawal.get("amount")
-        
-        # Update withdrawal status to rejected
-        update_response = supabase.table("withdrawals").update({"status": "rejected"}).eq("id", withdrawal_id).execute()
-        
-        if not update_response.data or len(update_response.data) == 0:
-            return jsonify({"success": False, "message": "Failed to update withdrawal status"}), 500
-        
-        # Refund coins to user
-        user_response = supabase.table("users").select("*").eq("telegram_id", user_id).execute()
-        
-        if not user_response.data or len(user_response.data) == 0:
-            return jsonify({"success": False, "message": "User not found"}), 404
-        
-        user = user_response.data[0]
-        current_coins = user.get("coins", 0)
-        
-        # Update user coins
-        user_update_response = supabase.table("users").update({"coins": current_coins + amount}).eq("telegram_id", user_id).execute()
-        
-        if not user_update_response.data or len(user_update_response.data) == 0:
-            return jsonify({"success": False, "message": "Failed to refund coins to user"}), 500
-        
-        return jsonify({"success": True, "message": "Withdrawal rejected and coins refunded"})
+        if storage.withdrawals.get(withdrawal_id):
+            return jsonify({"success": False, "message": "Withdrawal is not pending"}), 409
+        return jsonify({"success": False, "message": "Withdrawal not found"}), 404
     except Exception as e:
         logger.error(f"Error rejecting withdrawal: {str(e)}")
         return jsonify({"success": False, "message": str(e)}), 500
 
+@admin_bp.route("/api/admin/broadcasts", methods=["POST"])
+@login_required
+def create_broadcast():
+    """
+    Start sending a message to every user. Body: text, and optionally
+    parse_mode, reply_markup, rate (messages per second) and paid
+    (Telegram paid broadcast, for rates above the free limit).
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        text = data.get("text")
+        parse_mode = data.get("parse_mode", "HTML")
+        reply_markup = data.get("reply_markup")
+        rate = data.get("rate")
+        paid = data.get("paid", False)
+
+        if not isinstance(text, str) or not text.strip() or len(text) > 4096:
+            return jsonify({"success": False, "message": "text must be 1 to 4096 characters"}), 400
+        if parse_mode is not None and parse_mode not in PARSE_MODES:
+            return jsonify({"success": False, "message": f"parse_mode must be one of {', '.join(PARSE_MODES)}"}), 400
+        if reply_markup is not None and not isinstance(reply_markup, dict):
+            return jsonify({"success": False, "message": "reply_markup must be an object"}), 400
+        if rate is not None and (isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0):
+            return jsonify({"success": False, "message": "rate must be a positive number"}), 400
+        if not isinstance(paid, bool):
+            return jsonify({"success": False, "message": "paid must be true or false"}), 400
+
+        row = broadcasts.create(text, parse_mode, reply_markup, paid, rate)
+        return jsonify({"success": True, "broadcast": broadcast_to_dict(row)}), 201
+    except Exception as e:
+        logger.error(f"Error creating broadcast: {str(e)}")
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@admin_bp.route("/api/admin/broadcasts")
+@login_required
+def list_broadcasts():
+    try:
+        status = request.args.get("status")
+        if status is not None and status not in BROADCAST_STATUSES:
+            return jsonify({"error": f"status must be one of {', '.join(BROADCAST_STATUSES)}"}), 400
+        rows = storage.broadcasts.list(statuses=[status] if status else None)
+        return jsonify({"broadcasts": [broadcast_to_dict(row) for row in rows]})
+    except Exception as e:
+        logger.error(f"Error listing broadcasts: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@admin_bp.route("/api/admin/broadcasts/<int:broadcast_id>")
+@login_required
+def get_broadcast(broadcast_id):
+    try:
+        row = storage.broadcasts.get(broadcast_id)
+        if not row:
+            return jsonify({"error": "Broadcast not found"}), 404
+        return jsonify(broadcast_to_dict(row))
+    except Exception as e:
+        logger.error(f"Error getting broadcast: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@admin_bp.route("/api/admin/broadcasts/<int:broadcast_id>/<action>", methods=["POST"])
+@login_required
+def control_broadcast(broadcast_id, action):
+    """
+    Pause, resume or cancel a broadcast
+    """
+    try:
+        controls = {"pause": broadcasts.pause, "resume": broadcasts.resume, "cancel": broadcasts.cancel}
+        if action not in controls:
+            return jsonify({"success": False, "message": "Action must be pause, resume or cancel"}), 404
+        row = controls[action](broadcast_id)
+        if not row:
+            current = storage.broadcasts.get(broadcast_id)
+            if not current:
+                return jsonify({"success": False, "message": "Broadcast not found"}), 404
+            return jsonify({"success": False, "message": f"Cannot {action} a {current['status']} broadcast"}), 409
+        return jsonify({"success": True, "broadcast": broadcast_to_dict(row)})
+    except Exception as e:
+        logger.error(f"Error controlling broadcast: {str(e)}")
+        return jsonify({"success": False, "message": str(e)}), 500
+
 @admin_bp.route("/api/admin/adjust_coins", methods=["POST"])
 @login_required
 def adjust_coins():
@@ -207,17 +485,23 @@ def adjust_coins():
 
         if not telegram_id or amount is None or action not in ["add", "subtract"]:
             return jsonify({"success": False, "message": "Missing data"}), 400
+        if isinstance(amount, bool) or not isinstance(amount, int) or amount <= 0:
+            return jsonify({"success": False, "message": "Amount must be a positive whole number"}), 400
 
-        user = User.get_by_telegram_id(telegram_id)
-        if not user:
-            return jsonify({"success": False, "message": "User not found"}), 404
-
+        # Write buffered taps and referral credits first so the adjustment applies to the exact balance
+        write_behind.flush_user(telegram_id)
+        referral_credits.merge_user(telegram_id)
+        
         if action == "add":
-            user.coins += amount
+            user, previous_coins = _change_coins(telegram_id, lambda coins: amount)
         elif action == "subtract":
-            user.coins = max(0, user.coins - amount) # Ensure coins don't go below zero
+            # Ensure coins don't go below zero
+            user, previous_coins = _change_coins(telegram_id, lambda coins: -min(amount, coins))
+        
+        if not user:
+            return jsonify({"success": False, "message": "User not found"}), 404
         
-        user.save()
+        ledger.record(telegram_id, "admin_adjustment", user.coins - previous_coins, f"Admin {action}")
         return jsonify({"success": True, "message": "Coins adjusted successfully", "new_coins": user.coins})
     except Exception as e:
         logger.error(f"Error adjusting coins: {str(e)}")
@@ -233,12 +517,17 @@ def reset_user_data():
         if not telegram_id:
             return jsonify({"success": False, "message": "Telegram ID is required"}), 400
 
-        user = User.get_by_telegram_id(telegram_id)
+        # Buffered taps and credits (from any process) would otherwise be added on top of the reset
+        write_behind.discard_user(telegram_id)
+        referral_credits.merge_user(telegram_id, force=True)
+        
+        # Set against the stored balance, so the ledger records exactly what moved;
+        # the returned user is the stored row, not a possibly stale cached copy
+        user, previous_coins = _change_coins(telegram_id, lambda coins: 2500 - coins) # New user bonus
         if not user:
             return jsonify({"success": False, "message": "User not found"}), 404
 
         # Reset user data to initial state (similar to new user creation)
-        user.coins = 2500 # New user bonus
         user.energy = 100
         user.max_energy = 100
         user.tap_power = 1
@@ -248,7 +537,9 @@ def reset_user_data():
         user.referral_earnings = 0
         user.upi_id = None # Clear UPI ID
         
-        user.save()
+        # Every reset column is written, even where it already matched
+        user.save(force=RESET_COLUMNS)
+        ledger.record(telegram_id, "admin_reset", user.coins - previous_coins, "Admin reset")
         return jsonify({"success": True, "message": "User data reset successfully"})
     except Exception as e:
         logger.error(f"Error resetting user data: {str(e)}")
@@ -264,10 +555,14 @@ def delete_user():
         if not telegram_id:
             return jsonify({"success": False, "message": "Telegram ID is required"}), 400
 
+        write_behind.discard_user(telegram_id)
+        
         # Delete user from database
-        response = supabase.table("users").delete().eq("telegram_id", telegram_id).execute()
+        deleted = storage.users.delete(telegram_id)
+        User.invalidate_cache(telegram_id)
+        leaderboards.forget(str(telegram_id))
         
-        if response.data and len(response.data) > 0:
+        if deleted:
             return jsonify({"success": True, "message": "User deleted successfully"})
         else:
             return jsonify({"success": False, "message": "User not found"}), 404
@@ -1,46 +1,71 @@
 from flask import Blueprint, request, jsonify
+from src.bot import bot, update_dispatcher
+from src.routes.admin import login_required
+from src.telegram_api import TelegramError
+import hmac
+import logging
 import os
-import requests
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 bot_bp = Blueprint('bot', __name__)
 
-# Initialize bot with token from environment variable
-BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
+# Telegram sends this back in X-Telegram-Bot-Api-Secret-Token on every webhook
+# call once set_webhook registered it (1-256 characters of A-Z, a-z, 0-9, _ and -)
+WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+if not WEBHOOK_SECRET:
+    logger.warning("TELEGRAM_WEBHOOK_SECRET is not set, webhook calls are not authenticated")
 
 @bot_bp.route('/webhook', methods=['POST'])
 def webhook():
-    """Handle incoming Telegram updates"""
+    """Queue an incoming Telegram update and acknowledge it at once"""
     try:
-        update = request.get_json()
-        
-        # For now, just acknowledge the webhook
-        # Bot functionality can be implemented later
-        print(f"Received webhook update: {update}")
-        
+        if WEBHOOK_SECRET:
+            token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+                return jsonify({'status': 'error', 'message': 'Invalid secret token'}), 403
+
+        update = request.get_json(silent=True)
+        if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+            return jsonify({'status': 'error', 'message': 'Invalid update'}), 400
+
+        # Duplicates (Telegram redelivering) are acknowledged without handling again
+        result = update_dispatcher.submit(update)
+        if result == 'full':
+            # Telegram retries later
+            return jsonify({'status': 'error', 'message': 'Busy'}), 503
         return jsonify({'status': 'ok'})
-    
+
     except Exception as e:
-        print(f"Error processing update: {e}")
+        logger.error(f"Error queueing update: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @bot_bp.route('/set_webhook', methods=['POST'])
+@login_required
 def set_webhook():
     """Set the webhook URL for the bot"""
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     webhook_url = data.get('url')
-    
+
     if not webhook_url:
         return jsonify({'error': 'URL is required'}), 400
-    
-    # Set webhook
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/setWebhook"
-    response = requests.post(url, data={'url': webhook_url} )
-    
-    return jsonify(response.json())
+
+    params = {'url': webhook_url, 'allowed_updates': '["message", "callback_query"]'}
+    if WEBHOOK_SECRET:
+        params['secret_token'] = WEBHOOK_SECRET
+    if data.get('drop_pending_updates'):
+        params['drop_pending_updates'] = 'true'
+    try:
+        return jsonify({'ok': True, 'result': bot.api.call('setWebhook', params)})
+    except TelegramError as e:
+        return jsonify({'ok': False, 'description': str(e)}), 502
 
 @bot_bp.route('/bot_info', methods=['GET'])
 def bot_info():
     """Get bot information"""
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/getMe"
-    response = requests.get(url )
-    return jsonify(response.json())
+    try:
+        return jsonify({'ok': True, 'result': bot.api.call('getMe')})
+    except TelegramError as e:
+        return jsonify({'ok': False, 'description': str(e)}), 502
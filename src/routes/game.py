@@ -1,10 +1,13 @@
 from flask import Blueprint, request, jsonify
-from src.models.user import User, Transaction
+from src.models.transaction import Transaction
+from src.models.user import User, leaderboards, write_behind
+from src.rate_limit import rate_limited
 from datetime import datetime
 
 game_bp = Blueprint("game", __name__)
 
 @game_bp.route("/tap", methods=["POST"])
+@rate_limited("tap")
 def handle_tap():
     """Handle tap action"""
     try:
@@ -12,35 +15,23 @@ def handle_tap():
         telegram_id = data.get("telegram_id")
         taps = data.get("taps", 1)
 
-        user = User.get_by_telegram_id(telegram_id)
+        # Spend energy and credit coins atomically; the taps are recorded in the ledger
+        if write_behind.enabled:
+            user, accepted_taps = User.tap_buffered(telegram_id, taps)
+        else:
+            user, accepted_taps = User.tap_atomic(telegram_id, taps)
         if not user:
             return jsonify({"error": "User not found"}), 404
 
-        user.update_energy()
-
-        # Check if user has enough energy
-        if user.energy < taps:
+        # Check if user had enough energy
+        if accepted_taps < 1:
             return jsonify({"error": "Not enough energy"}), 400
 
-        # Process tap
-        success = user.tap(taps)
-        if success:
-            # Log transaction
-            transaction = Transaction(
-                user_id=user.id,
-                transaction_type="tap",
-                amount=taps * user.tap_power,
-                description=f"Earned from {taps} taps"
-            )
-            transaction.save()
-
-            return jsonify({
-                "success": True,
-                "coins_earned": taps * user.tap_power,
-                "user": user.to_dict()
-            })
-        else:
-            return jsonify({"error": "Failed to process tap"}), 500
+        return jsonify({
+            "success": True,
+            "coins_earned": accepted_taps * user.tap_power,
+            "user": user.to_dict()
+        })
 
     except Exception as e:
         print(f"Tap error: {e}")
@@ -57,8 +48,8 @@ def update_energy():
         if not user:
             return jsonify({"error": "User not found"}), 404
 
-        user.update_energy()
-        user.save() # Save energy update
+        # Energy is derived on read, so there is nothing to save
+        user.settle_energy()
 
         return jsonify({
             "success": True,
@@ -73,15 +64,15 @@ def update_energy():
 def get_leaderboard():
     """Get top users leaderboard"""
     try:
-        # Get all users and sort by total_earned
-        all_users = User.get_all_users()
-        top_users = sorted(all_users, key=lambda x: x.get("total_earned", 0), reverse=True)[:10]
+        # Maintained incrementally, so the top 10 is read without scanning users
+        top_users = leaderboards.board("all").top(10)
+        users = User.get_many([telegram_id for _, telegram_id, _ in top_users])
 
         return jsonify([{
-            "rank": idx + 1,
-            "name": user.get("first_name") or user.get("username") or f"User{user.get("telegram_id")}",
-            "total_earned": user.get("total_earned", 0)
-        } for idx, user in enumerate(top_users)])
+            "rank": rank,
+            "name": (users[telegram_id].first_name or users[telegram_id].username) if telegram_id in users else f"User{telegram_id}",
+            "coins": coins
+        } for rank, telegram_id, coins in top_users])
 
     except Exception as e:
         print(f"Leaderboard error: {e}")
@@ -95,8 +86,8 @@ def get_user_stats(telegram_id):
         if not user:
             return jsonify({"error": "User not found"}), 404
 
-        # Get recent transactions
-        recent_transactions = Transaction.get_by_user_id(user.id)
+        # Get recent transactions (the newest page of the ledger)
+        recent_transactions = Transaction.get_by_user_id(user.telegram_id)
 
         transactions_data = []
         for tx in recent_transactions:
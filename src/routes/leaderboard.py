@@ -0,0 +1,81 @@
+from flask import Blueprint, request, jsonify
+from src.models.leaderboard import Leaderboards
+from src.models.user import User, leaderboards
+
+leaderboard_bp = Blueprint('leaderboard', __name__)
+
+# Largest page and neighbourhood a client can ask for
+MAX_LEADERBOARD_LIMIT = 100
+MAX_LEADERBOARD_RADIUS = 25
+
+def _entries(ranked):
+    """
+    Leaderboard entries with display names, from [(rank, telegram_id, score)]
+    """
+    users = User.get_many([telegram_id for _, telegram_id, _ in ranked])
+    entries = []
+    for rank, telegram_id, score in ranked:
+        user = users.get(telegram_id)
+        name = (user.first_name or user.username) if user else None
+        entries.append({
+            'rank': rank,
+            'telegram_id': telegram_id,
+            'name': name or f"User{telegram_id}",
+            'score': score
+        })
+    return entries
+
+def _window():
+    window = request.args.get('window', 'all')
+    if window not in Leaderboards.WINDOWS:
+        raise ValueError(f"window must be one of {', '.join(Leaderboards.WINDOWS)}")
+    return window
+
+@leaderboard_bp.route('/api/leaderboard', methods=['GET'])
+def get_leaderboard():
+    """
+    Top users: by balance for window=all, by coins earned for daily/weekly
+    """
+    try:
+        try:
+            window = _window()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        limit = max(1, min(request.args.get('limit', 10, type=int), MAX_LEADERBOARD_LIMIT))
+        offset = max(0, request.args.get('offset', 0, type=int))
+
+        board = leaderboards.board(window)
+        return jsonify({
+            'window': window,
+            'total': len(board),
+            # Ranks cover only the users seen so far until the load from storage finishes
+            'loading': leaderboards.loading,
+            'entries': _entries(board.top(limit, offset))
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@leaderboard_bp.route('/api/leaderboard/rank/<telegram_id>', methods=['GET'])
+def get_rank(telegram_id):
+    """
+    A user's rank and the users ranked around them
+    """
+    try:
+        try:
+            window = _window()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        radius = max(0, min(request.args.get('radius', 5, type=int), MAX_LEADERBOARD_RADIUS))
+
+        board = leaderboards.board(window)
+        telegram_id = str(telegram_id)
+        return jsonify({
+            'window': window,
+            'total': len(board),
+            'loading': leaderboards.loading,
+            'rank': board.rank(telegram_id),
+            'score': board.score(telegram_id) or 0,
+            'around': _entries(board.around(telegram_id, radius))
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
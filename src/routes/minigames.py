@@ -1,9 +1,14 @@
 from flask import Blueprint, request, jsonify
-from src.models.user import User
+from src.models.minigame_rewards import minigame_reward_log
+from src.models.transaction import ledger
+from src.models.user import User, leaderboards
+from src.rate_limit import rate_limited
+import time
 
 minigames_bp = Blueprint('minigames', __name__)
 
 @minigames_bp.route('/api/minigame_reward', methods=['POST'])
+@rate_limited('minigame_reward')
 def minigame_reward():
     """
     Award coins for completing minigames
@@ -17,37 +22,35 @@ def minigame_reward():
         if not telegram_id or not amount or not game_name:
             return jsonify({'error': 'Missing required parameters'}), 400
         
-        # Get user from database
-        user = User.get_by_telegram_id(telegram_id)
+        # Add coins to user in one atomic update
+        user = User.apply_delta(telegram_id, coins=amount)
         if not user:
             # Create user if not exists
             user = User(
                 telegram_id=telegram_id,
                 username="user_" + str(telegram_id),
                 first_name="User",
-                coins=0,
+                coins=amount,
                 energy=100,
                 max_energy=100,
                 tap_power=1,
                 energy_regen_rate=1,
                 last_energy_update=None
             )
+            
+            # Save user
+            user.save()
         
-        # Add coins to user
-        user.coins += amount
-        
-        # Save user
-        user.save()
-        
-        # Log minigame reward
-        from src.config.database import supabase
+        # Log minigame reward (written in the background, in batches)
         minigame_log = {
             'telegram_id': telegram_id,
             'game_name': game_name,
             'amount': amount,
             'timestamp': int(time.time())
         }
-        supabase.table('minigame_rewards').insert(minigame_log).execute()
+        minigame_reward_log.put(minigame_log)
+        ledger.record(telegram_id, "minigame", amount, f"Reward from {game_name}")
+        leaderboards.earned(telegram_id, amount)
         
         return jsonify({
             'success': True,
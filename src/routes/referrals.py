@@ -1,9 +1,28 @@
 from flask import Blueprint, request, jsonify
-from src.models.user import User
+from src.models.user import REFERRAL_CODE_BONUS, User, referral_stats_cache
+from src.storage import storage
+from src.storage.base import decode_cursor, encode_cursor
+import os
 import time
 
 referral_bp = Blueprint('referral', __name__)
 
+# Referral list page size (default and upper bound)
+REFERRALS_PAGE_SIZE = int(os.environ.get('REFERRALS_PAGE_SIZE', 20))
+REFERRALS_MAX_PAGE_SIZE = 100
+
+def _referral_page(referrer_id, after_id=None, limit=REFERRALS_PAGE_SIZE):
+    """
+    One page of a referrer's referrals and the cursor for the next one
+    """
+    # Fetch one extra row to know whether there is a next page
+    referrals = storage.referred_users.page(referrer_id, after_id, limit + 1)
+    next_cursor = None
+    if len(referrals) > limit:
+        referrals = referrals[:limit]
+        next_cursor = encode_cursor([referrals[-1]['id']])
+    return referrals, next_cursor
+
 @referral_bp.route('/api/referral/<referral_code>', methods=['POST'])
 def use_referral(referral_code):
     """
@@ -25,85 +44,32 @@ def use_referral(referral_code):
         if str(telegram_id) == str(referrer_id):
             return jsonify({'error': 'Cannot refer yourself'}), 400
         
-        # Get referrer from database
-        referrer = User.get_by_telegram_id(referrer_id)
-        if not referrer:
+        # Created with the referral bonus if the user does not exist yet
+        new_user = User(
+            telegram_id=telegram_id,
+            username=username,
+            first_name=first_name,
+            coins=0,
+            energy=100,
+            max_energy=100,
+            tap_power=1,
+            energy_regen_rate=1,
+            last_energy_update=int(time.time())
+        )
+        
+        # Credit both users and record the referral in one atomic, idempotent step
+        status, user, _ = User.apply_referral(referrer_id, telegram_id, *REFERRAL_CODE_BONUS, new_user=new_user)
+        
+        if status == 'invalid_referrer':
             return jsonify({'error': 'Invalid referral code'}), 400
+        if status == 'already_referred':
+            return jsonify({'error': 'Already used a referral code'}), 400
         
-        # Get user from database
-        user = User.get_by_telegram_id(telegram_id)
-        if not user:
-            # Create a new user if not found
-            user = User(
-                telegram_id=telegram_id,
-                username=username,
-                first_name=first_name,
-                coins=500,  # Bonus coins for using referral
-                energy=100,
-                max_energy=100,
-                tap_power=1,
-                energy_regen_rate=1,
-                last_energy_update=int(time.time()),
-                referred_by=referrer_id
-            )
-            user.save()
-            
-            # Add referral bonus to referrer
-            referrer.coins += 500
-            referrer.referral_count = (referrer.referral_count or 0) + 1
-            referrer.referral_earnings = (referrer.referral_earnings or 0) + 500
-            referrer.save()
-            
-            # Add to referred_users table
-            from src.config.database import supabase
-            referred_user = {
-                'referrer_id': referrer_id,
-                'user_id': telegram_id,
-                'username': username,
-                'name': first_name,
-                'joined_date': int(time.time()),
-                'earnings_from_referral': 500
-            }
-            supabase.table('referred_users').insert(referred_user).execute()
-            
-            return jsonify({
-                'success': True,
-                'message': 'Referral code used successfully',
-                'user': user.to_dict()
-            })
-        else:
-            # User already exists
-            if user.referred_by:
-                return jsonify({'error': 'Already used a referral code'}), 400
-            
-            # Update user with referral
-            user.referred_by = referrer_id
-            user.coins += 500  # Bonus coins for using referral
-            user.save()
-            
-            # Add referral bonus to referrer
-            referrer.coins += 500
-            referrer.referral_count = (referrer.referral_count or 0) + 1
-            referrer.referral_earnings = (referrer.referral_earnings or 0) + 500
-            referrer.save()
-            
-            # Add to referred_users table
-            from src.config.database import supabase
-            referred_user = {
-                'referrer_id': referrer_id,
-                'user_id': telegram_id,
-                'username': username,
-                'name': first_name,
-                'joined_date': int(time.time()),
-                'earnings_from_referral': 500
-            }
-            supabase.table('referred_users').insert(referred_user).execute()
-            
-            return jsonify({
-                'success': True,
-                'message': 'Referral code used successfully',
-                'user': user.to_dict()
-            })
+        return jsonify({
+            'success': True,
+            'message': 'Referral code used successfully' if status == 'applied' else 'Referral code already applied',
+            'user': user.to_dict()
+        })
         
     except Exception as e:
         print(f"Error in use_referral: {str(e)}")
@@ -115,33 +81,63 @@ def referral_stats(telegram_id):
     Get referral stats for a user
     """
     try:
+        telegram_id = str(telegram_id)
+        cached = referral_stats_cache.get(telegram_id)
+        if cached is not None:
+            return jsonify(cached)
+        
         # Get user from database
         user = User.get_by_telegram_id(telegram_id)
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        # Get referred users from database
-        from src.config.database import supabase
-        response = supabase.table('referred_users').select('*').eq('referrer_id', telegram_id).execute()
-        
-        referred_users = response.data
-        
-        # Calculate stats
-        total_referrals = len(referred_users)
-        total_earnings = sum(user.get('earnings_from_referral', 0) for user in referred_users)
+        # Totals are kept on the referrer's row as referrals happen; only the
+        # first page of referred users is read
+        total_referrals = user.referral_count
+        total_earnings = user.referral_earnings
+        referrals, next_cursor = _referral_page(telegram_id)
         
         # Active referrals in last week (placeholder - would need last_active in user model)
         active_this_week = total_referrals  # For now, assume all are active
         
-        return jsonify({
+        stats = {
             'success': True,
             'total_referrals': total_referrals,
             'total_earnings': total_earnings,
             'active_this_week': active_this_week,
-            'referrals': referred_users
-        })
+            'referrals': referrals,
+            'next_cursor': next_cursor
+        }
+        referral_stats_cache.set(telegram_id, stats)
+        return jsonify(stats)
         
     except Exception as e:
         print(f"Error in referral_stats: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+
+@referral_bp.route('/api/referrals/<telegram_id>', methods=['GET'])
+def list_referrals(telegram_id):
+    """
+    Page through a user's referrals, newest first
+    """
+    try:
+        limit = max(1, min(request.args.get('limit', REFERRALS_PAGE_SIZE, type=int), REFERRALS_MAX_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        try:
+            after_id = decode_cursor(cursor, 1)[0] if cursor else None
+            if after_id is not None and not isinstance(after_id, int):
+                raise ValueError('Invalid cursor')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        referrals, next_cursor = _referral_page(telegram_id, after_id, limit)
+        return jsonify({
+            'success': True,
+            'referrals': referrals,
+            'next_cursor': next_cursor
+        })
+        
+    except Exception as e:
+        print(f"Error in list_referrals: {str(e)}")
+        return jsonify({'error': str(e)}), 500
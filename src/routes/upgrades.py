@@ -1,5 +1,7 @@
 from flask import Blueprint, request, jsonify
-from src.models.user import User
+from src.models.transaction import ledger
+from src.models.user import User, referral_credits, write_behind
+from src.rate_limit import rate_limited
 import logging
 
 # Set up logging
@@ -9,6 +11,7 @@ logger = logging.getLogger(__name__)
 upgrades_bp = Blueprint("upgrades", __name__)
 
 @upgrades_bp.route("/api/upgrade", methods=["POST"])
+@rate_limited("upgrade")
 def upgrade():
     try:
         # Get upgrade data from request
@@ -19,6 +22,10 @@ def upgrade():
         if not telegram_id or not upgrade_type:
             return jsonify({"error": "Telegram ID and upgrade type are required"}), 400
         
+        # Write buffered taps and referral credits first so the balance is exact
+        write_behind.flush_user(telegram_id)
+        referral_credits.merge_user(telegram_id)
+        
         # Get user from database
         user = User.get_by_telegram_id(telegram_id)
         
@@ -32,13 +39,16 @@ def upgrade():
         if upgrade_type == "tap_power":
             current_level = user.tap_power
             cost = 100 * (current_level + 1)
+            delta = {"tap_power": 1}
         elif upgrade_type == "max_energy":
             # Assuming max_energy increases by 100 per level, so level is max_energy / 100
             current_level = user.max_energy // 100 
             cost = 200 * (current_level + 1)
+            delta = {"max_energy": 100}
         elif upgrade_type == "energy_regen_rate":
             current_level = user.energy_regen_rate
             cost = 300 * (current_level + 1)
+            delta = {"energy_regen_rate": 1}
         else:
             return jsonify({"error": "Invalid upgrade type"}), 400
         
@@ -54,25 +64,32 @@ def upgrade():
                 "cost": cost
             })
         
-        # Apply upgrade
-        user.coins -= cost
-        
-        if upgrade_type == "tap_power":
-            user.tap_power += 1
-        elif upgrade_type == "max_energy":
-            user.max_energy += 100
-        elif upgrade_type == "energy_regen_rate":
-            user.energy_regen_rate += 1
+        # Apply upgrade atomically, priced against the level read above
+        upgraded_user = User.apply_delta(
+            telegram_id,
+            coins=-cost,
+            min_coins=cost,
+            expect={upgrade_type: getattr(user, upgrade_type)},
+            **delta
+        )
         
-        # Save updated user
-        user.save()
+        if not upgraded_user:
+            # Balance or level changed since it was read
+            return jsonify({
+                "success": False,
+                "message": "Not enough coins or upgrade already applied, please refresh",
+                "coins": int(user.coins),
+                "cost": cost
+            })
+        user = upgraded_user
+        ledger.record(telegram_id, "upgrade", -cost, f"Upgraded {upgrade_type}")
         
         # Return updated user data
         return jsonify({
             "success": True,
             "message": "Upgrade successful",
             "coins": int(user.coins),
-            "energy": float(user.energy),
+            "energy": float(user.current_energy()),
             "max_energy": int(user.max_energy),
             "tap_power": int(user.tap_power),
             "energy_regen_rate": float(user.energy_regen_rate)
@@ -1,5 +1,8 @@
 from flask import Blueprint, request, jsonify
-from src.models.user import User
+from src.models.transaction import Transaction, ledger
+from src.models.user import REFERRAL_SIGNUP_BONUS, User, write_behind
+from src.rate_limit import rate_limited
+from src.storage.base import decode_cursor, encode_cursor
 import logging
 import time
 import json
@@ -10,6 +13,16 @@ logger = logging.getLogger(__name__)
 
 user_bp = Blueprint("user", __name__)
 
+# Fastest plausible human tapping rate; anything above is dropped
+MAX_TAPS_PER_SECOND = 20
+# Longest client window a single batch may cover
+MAX_BATCH_WINDOW_SECONDS = 30
+# Hard cap on taps applied from one batch
+MAX_TAPS_PER_BATCH = 500
+# Transaction history page size
+TRANSACTIONS_PAGE_SIZE = 20
+TRANSACTIONS_MAX_PAGE_SIZE = 100
+
 @user_bp.route("/api/user/<telegram_id>", methods=["GET"])
 def get_user(telegram_id):
     try:
@@ -36,37 +49,24 @@ def get_user(telegram_id):
                 tap_power=1,
                 energy_regen_rate=1,
                 last_energy_update=int(time.time()),
-                referred_by=referred_by,
                 referral_count=0,
                 referral_earnings=0
             )
             
-            # Save user to database
-            user.save()
+            # If user was referred, create them and credit the referrer in one atomic step
+            referred_user = None
+            if referred_by and str(referred_by) != str(telegram_id):
+                _, referred_user, _ = User.apply_referral(referred_by, telegram_id, *REFERRAL_SIGNUP_BONUS, new_user=user)
             
-            # If user was referred, update referrer's stats
-            if referred_by and referred_by != telegram_id:
-                referrer = User.get_by_telegram_id(referred_by)
-                if referrer:
-                    referrer.referral_count += 1
-                    referrer.referral_earnings += 100  # Bonus for referring a user
-                    referrer.coins += 100
-                    referrer.save()
-        else:
-            logger.info(f"User found: {telegram_id}. Updating energy.")
-            # Update energy based on regeneration rate
-            current_time = int(time.time())
-            if user.last_energy_update:
-                time_diff = current_time - user.last_energy_update
-                # Energy regenerates per 30 seconds (0.5 minutes)
-                energy_regen = (time_diff / 30) * user.energy_regen_rate  
-                
-                user.energy = min(user.max_energy, user.energy + energy_regen)
-                user.energy = float(user.energy) # Ensure energy is float
-                user.last_energy_update = current_time
-                
-                # Save updated energy
+            if referred_user:
+                user = referred_user
+            else:
+                # No valid referrer: save user to database
                 user.save()
+            ledger.record(telegram_id, "welcome", 2500, "Welcome bonus")
+        else:
+            # Include taps not yet flushed by the write-behind buffer
+            user.with_pending()
         
         # Return user data
         return jsonify({
@@ -74,7 +74,7 @@ def get_user(telegram_id):
             "username": user.username,
             "first_name": user.first_name,
             "coins": int(user.coins), # Ensure coins are integer
-            "energy": float(user.energy),
+            "energy": float(user.current_energy()), # Derived on read, never written here
             "max_energy": int(user.max_energy),
             "tap_power": int(user.tap_power),
             "energy_regen_rate": float(user.energy_regen_rate),
@@ -87,6 +87,7 @@ def get_user(telegram_id):
         return jsonify({"error": str(e)}), 500
 
 @user_bp.route("/api/tap", methods=["POST"])
+@rate_limited("tap")
 def tap():
     try:
         # Get user data from request
@@ -96,24 +97,17 @@ def tap():
         if not telegram_id:
             return jsonify({"error": "Telegram ID is required"}), 400
         
-        # Get user from database
-        user = User.get_by_telegram_id(telegram_id)
+        # Spend one energy and credit coins in a single atomic update
+        if write_behind.enabled:
+            user, accepted_taps = User.tap_buffered(telegram_id, 1)
+        else:
+            user, accepted_taps = User.tap_atomic(telegram_id, 1)
         
         if not user:
             return jsonify({"error": "User not found"}), 404
         
-        # Update energy based on regeneration rate
-        current_time = int(time.time())
-        if user.last_energy_update:
-            time_diff = current_time - user.last_energy_update
-            # Energy regenerates per 30 seconds (0.5 minutes)
-            energy_regen = (time_diff / 30) * user.energy_regen_rate  
-            
-            user.energy = min(user.max_energy, user.energy + energy_regen)
-            user.energy = float(user.energy) # Ensure energy is float
-        
-        # Check if user has enough energy
-        if user.energy < 1:
+        # Check if user had enough energy
+        if accepted_taps < 1:
             return jsonify({
                 "success": False,
                 "message": "Not enough energy",
@@ -124,14 +118,6 @@ def tap():
                 "energy_regen_rate": float(user.energy_regen_rate)
             })
         
-        # Deduct energy and add coins
-        user.energy -= 1
-        user.coins += user.tap_power
-        user.last_energy_update = current_time
-        
-        # Save updated user
-        user.save()
-        
         # Return updated user data
         return jsonify({
             "success": True,
@@ -146,6 +132,61 @@ def tap():
         logger.error(f"Error in tap: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@user_bp.route("/api/tap/batch", methods=["POST"])
+@rate_limited("tap_batch")
+def tap_batch():
+    """
+    Apply a batch of taps collected by the client over a time window
+    """
+    try:
+        # Get batch data from request
+        data = request.json or {}
+        telegram_id = data.get("telegram_id")
+        
+        if not telegram_id:
+            return jsonify({"error": "Telegram ID is required"}), 400
+        
+        try:
+            taps = int(data.get("taps", 0))
+            # Client window in milliseconds; only its length is trusted
+            started_at = int(data.get("started_at", 0))
+            ended_at = int(data.get("ended_at", 0))
+        except (TypeError, ValueError):
+            return jsonify({"error": "Taps and time window must be numbers"}), 400
+        
+        if taps < 1:
+            return jsonify({"error": "At least one tap is required"}), 400
+        
+        # Cap the batch by how many taps fit in the reported window
+        window_seconds = min(max((ended_at - started_at) / 1000, 1), MAX_BATCH_WINDOW_SECONDS)
+        allowed_taps = min(int(window_seconds * MAX_TAPS_PER_SECOND), MAX_TAPS_PER_BATCH)
+        requested_taps = min(taps, allowed_taps)
+        
+        # Accept as many taps as the server-side energy allows, in one atomic update
+        if write_behind.enabled:
+            user, accepted_taps = User.tap_buffered(telegram_id, requested_taps)
+        else:
+            user, accepted_taps = User.tap_atomic(telegram_id, requested_taps)
+        
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        
+        # Return updated user data
+        return jsonify({
+            "success": accepted_taps > 0,
+            "message": "Taps applied" if accepted_taps > 0 else "Not enough energy",
+            "accepted": accepted_taps,
+            "rejected": taps - accepted_taps,
+            "coins": int(user.coins),
+            "energy": float(user.energy),
+            "max_energy": int(user.max_energy),
+            "tap_power": int(user.tap_power),
+            "energy_regen_rate": float(user.energy_regen_rate)
+        })
+    except Exception as e:
+        logger.error(f"Error in tap_batch: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @user_bp.route("/api/update_upi", methods=["POST"])
 def update_upi():
     try:
@@ -180,3 +221,37 @@ def update_upi():
 
 
 
+
+@user_bp.route("/api/transactions/<telegram_id>", methods=["GET"])
+def get_transactions(telegram_id):
+    """
+    Page through a user's ledger entries, newest first, with the running
+    ledger balance. Entries appear once the ledger's batch is written.
+    """
+    try:
+        limit = request.args.get("limit", TRANSACTIONS_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, TRANSACTIONS_MAX_PAGE_SIZE))
+        cursor = request.args.get("cursor")
+        try:
+            after_id = decode_cursor(cursor, 1)[0] if cursor else None
+            if after_id is not None and not isinstance(after_id, int):
+                raise ValueError("Invalid cursor")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Fetch one extra row to know whether there is a next page
+        transactions = Transaction.get_by_user_id(telegram_id, after_id, limit + 1)
+        next_cursor = None
+        if len(transactions) > limit:
+            transactions = transactions[:limit]
+            next_cursor = encode_cursor([transactions[-1].id])
+        
+        snapshot = Transaction.balance(telegram_id) or {}
+        return jsonify({
+            "transactions": [transaction.to_dict() for transaction in transactions],
+            "ledger_balance": int(snapshot.get("balance") or 0),
+            "next_cursor": next_cursor
+        })
+    except Exception as e:
+        logger.error(f"Error in get_transactions: {str(e)}")
+        return jsonify({"error": str(e)}), 500
@@ -1,7 +1,10 @@
 from flask import Blueprint, request, jsonify
-from src.models.user import User
-from src.config.database import supabase
+from src.models.user import User, referral_credits, write_behind
+from src.storage import storage
+from src.storage.base import CREATED_AT_PATTERN, decode_cursor, encode_cursor
 import logging
+import os
+import re
 import time
 
 # Set up logging
@@ -10,6 +13,12 @@ logger = logging.getLogger(__name__)
 
 withdraw_bp = Blueprint("withdraw", __name__)
 
+# Client-generated key (e.g. a UUID) identifying one withdrawal attempt across retries
+IDEMPOTENCY_KEY_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Withdrawal history page size
+WITHDRAWAL_HISTORY_PAGE_SIZE = int(os.environ.get("WITHDRAWAL_HISTORY_PAGE_SIZE", 20))
+WITHDRAWAL_HISTORY_MAX_PAGE_SIZE = 100
+
 @withdraw_bp.route("/api/withdraw", methods=["POST"])
 def withdraw():
     try:
@@ -18,10 +27,14 @@ def withdraw():
         telegram_id = data.get("telegram_id")
         amount = data.get("amount")
         upi_id = data.get("upi_id")
+        idempotency_key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
         
         if not telegram_id or amount is None or not upi_id:
             return jsonify({"error": "Telegram ID, amount, and UPI ID are required"}), 400
         
+        if idempotency_key is not None and not IDEMPOTENCY_KEY_PATTERN.match(str(idempotency_key)):
+            return jsonify({"error": "Idempotency key must be 1-64 letters, digits, '-' or '_'"}), 400
+        
         # Convert amount to float first, then to integer for calculations
         try:
             amount = float(amount)
@@ -35,96 +48,51 @@ def withdraw():
         if amount_int < 1000:
             return jsonify({"error": "Minimum withdrawal amount is 1,000 coins"}), 400
         
-        # Get user from database
-        user = User.get_by_telegram_id(telegram_id)
+        # Calculate fee (2%)
+        fee = int(amount_int * 0.02)
+        final_amount = amount_int - fee
+        
+        # Convert coins to INR (1000 coins = ₹10)
+        inr_amount = (final_amount / 1000) * 10
         
-        if not user:
+        # Write buffered taps and referral credits first so the balance is exact
+        write_behind.flush_user(telegram_id)
+        referral_credits.merge_user(telegram_id)
+        
+        # Debit and record in one step; a retry with the same key gets the first result back
+        status, withdrawal, user = User.withdraw(telegram_id, amount_int, {
+            "final_amount": final_amount,
+            "fee": fee,
+            "inr_amount": inr_amount,
+            "upi_id": upi_id,
+            "status": "pending",
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S")
+        }, idempotency_key)
+        
+        if status == "user_not_found":
             return jsonify({"error": "User not found"}), 404
         
-        # Check if user has enough coins
-        if user.coins < amount_int:
+        if status == "insufficient_funds":
             return jsonify({
                 "success": False,
                 "message": "Not enough coins",
                 "coins": user.coins
             })
         
-        # Calculate fee (2%)
-        fee = int(amount_int * 0.02)
-        final_amount = amount_int - fee
+        if status == "replayed":
+            logger.info(f"Replayed withdrawal {withdrawal.get('id')} for user {telegram_id}")
         
-        # Convert coins to INR (1000 coins = ₹10)
-        inr_amount = (final_amount / 1000) * 10
-        
-        # Update user coins
-        user.coins -= amount_int
-        user.save()
-        
-        # Create withdrawal record
-        try:
-            withdrawal_data = {
-                "user_id": telegram_id,
-                "amount": amount_int,
-                "final_amount": final_amount,
-                "fee": fee,
-                "inr_amount": inr_amount,
-                "upi_id": upi_id,
-                "status": "pending",
-                "created_at": time.strftime("%Y-%m-%d %H:%M:%S")
-            }
-            
-            # Insert withdrawal record
-            response = supabase.table("withdrawals").insert(withdrawal_data).execute()
-            
-            if not response.data:
-                logger.warning(f"Failed to insert full withdrawal record. Trying without fee: {withdrawal_data}")
-                # If the insert fails due to missing 'fee' column, try without it
-                withdrawal_data_alt = {
-                    "user_id": telegram_id,
-                    "amount": amount_int,
-                    "final_amount": final_amount,
-                    "inr_amount": inr_amount,
-                    "upi_id": upi_id,
-                    "status": "pending",
-                    "created_at": time.strftime("%Y-%m-%d %H:%M:%S")
-                }
-                response = supabase.table("withdrawals").insert(withdrawal_data_alt).execute()
-
-        except Exception as e:
-            logger.error(f"Error creating withdrawal record: {str(e)}")
-            # If that also fails, try with minimal fields
-            try:
-                withdrawal_data_min = {
-                    "user_id": telegram_id,
-                    "amount": amount_int,
-                    "upi_id": upi_id,
-                    "status": "pending",
-                    "created_at": time.strftime("%Y-%m-%d %H:%M:%S")
-                }
-                response = supabase.table("withdrawals").insert(withdrawal_data_min).execute()
-            except Exception as e2:
-                logger.error(f"Error creating minimal withdrawal record: {str(e2)}")
-                # Return success even if withdrawal record creation fails
-                # The coins have been deducted, so the withdrawal is technically processed
-                return jsonify({
-                    "success": True,
-                    "message": "Withdrawal processed successfully, but record creation failed. Please contact support.",
-                    "coins": user.coins,
-                    "amount": amount_int,
-                    "fee": fee,
-                    "final_amount": final_amount,
-                    "inr_amount": inr_amount
-                })
-        
-        # Return success message
+        # Return the stored withdrawal, which on a replay is the original request's
         return jsonify({
             "success": True,
             "message": "Withdrawal processed successfully",
+            "withdrawal_id": withdrawal.get("id"),
+            "replayed": status == "replayed",
             "coins": user.coins,
-            "amount": amount_int,
-            "fee": fee,
-            "final_amount": final_amount,
-            "inr_amount": inr_amount
+            "amount": withdrawal.get("amount"),
+            "fee": withdrawal.get("fee"),
+            "final_amount": withdrawal.get("final_amount"),
+            "inr_amount": withdrawal.get("inr_amount")
         })
     except Exception as e:
         logger.error(f"Error in withdraw: {str(e)}")
@@ -132,24 +100,36 @@ def withdraw():
 
 @withdraw_bp.route("/api/withdrawal_history/<telegram_id>", methods=["GET"])
 def withdrawal_history(telegram_id):
+    """
+    Page through a user's withdrawals, newest first. Responses carry an ETag,
+    so a client polling with If-None-Match gets an empty 304 until the page changes.
+    """
     try:
-        # Get user from database
-        user = User.get_by_telegram_id(telegram_id)
+        limit = request.args.get("limit", WITHDRAWAL_HISTORY_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, WITHDRAWAL_HISTORY_MAX_PAGE_SIZE))
         
-        if not user:
-            return jsonify({"error": "User not found"}), 404
+        # Cursor is (created_at, id) of the previous page's last row
+        cursor = request.args.get("cursor")
+        try:
+            after = decode_cursor(cursor, 2) if cursor else None
+            if after is not None and not (isinstance(after[0], str) and CREATED_AT_PATTERN.match(after[0])
+                                          and isinstance(after[1], int)):
+                raise ValueError("Invalid cursor")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        # Get withdrawal history from database
-        response = supabase.table("withdrawals").select("*").eq("user_id", telegram_id).order("created_at", desc=True).execute()
+        # Fetch one extra row to know whether there is a next page
+        withdrawals = storage.withdrawals.page(after=after, limit=limit + 1, descending=True, user_id=telegram_id)
+        next_cursor = None
+        if len(withdrawals) > limit:
+            withdrawals = withdrawals[:limit]
+            next_cursor = encode_cursor([withdrawals[-1]["created_at"], withdrawals[-1]["id"]])
         
-        if response.data:
-            withdrawals = response.data
-            return jsonify({"withdrawals": withdrawals})
-        else:
-            return jsonify({"withdrawals": []})
+        response = jsonify({"withdrawals": withdrawals, "next_cursor": next_cursor})
+        # Let clients cache the page but revalidate it on every poll
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.add_etag()
+        return response.make_conditional(request)
     except Exception as e:
         logger.error(f"Error in withdrawal_history: {str(e)}")
         return jsonify({"error": str(e)}), 500
-
-
-
@@ -0,0 +1,15 @@
+from src.config.database import SQLITE_PATH, STORAGE_BACKEND, supabase
+
+def create_storage(backend=STORAGE_BACKEND):
+    """
+    Create the storage backend selected by STORAGE_BACKEND
+    """
+    if backend == "supabase":
+        from src.storage.supabase_backend import SupabaseStorage
+        return SupabaseStorage(supabase)
+    if backend == "sqlite":
+        from src.storage.sqlite_backend import SQLiteStorage
+        return SQLiteStorage(SQLITE_PATH)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+storage = create_storage()
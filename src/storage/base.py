@@ -0,0 +1,498 @@
+import base64
+import json
+import re
+import time
+
+# Columns of the users table, in schema order
+USER_COLUMNS = (
+    "id", "telegram_id", "username", "first_name", "coins", "energy", "max_energy",
+    "tap_power", "energy_regen_rate", "last_energy_update", "referred_by",
+    "referral_count", "referral_earnings", "upi_id"
+)
+
+# Sort keys accepted by UserRepository.page and the users column each maps to.
+# Users ids are serial, so id order is creation order. last_energy_update only
+# moves when energy is spent or upgraded (reads never write it), so it tracks
+# when a user last played, not when they last opened the app.
+USER_SORT_COLUMNS = {
+    "created": "id",
+    "coins": "coins",
+    "last_played": "last_energy_update"
+}
+
+# withdrawals.created_at as stored (SQLite text or Postgres timestamptz), for
+# validating the created_at of a pagination cursor
+CREATED_AT_PATTERN = re.compile(r"^[0-9T:. +\-]{1,40}$")
+
+def encode_cursor(values):
+    """
+    Opaque pagination cursor for a list of sort key values
+    """
+    return base64.urlsafe_b64encode(json.dumps(list(values), separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor, size):
+    """
+    Sort key values from encode_cursor(); raises ValueError if the cursor is malformed
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+def energy_at(energy, last_energy_update, max_energy, energy_regen_rate, current_time):
+    """
+    Closed-form energy at current_time from a stored (energy, last_energy_update) pair
+    """
+    energy = float(energy or 0)
+    if last_energy_update:
+        # Energy regenerates per 30 seconds (0.5 minutes)
+        time_diff = max(current_time - int(last_energy_update), 0)
+        energy = min(float(max_energy or 0), energy + (time_diff / 30) * float(energy_regen_rate or 0))
+    return energy
+
+def regenerated_energy(row, current_time):
+    """
+    Energy a users row holds at current_time, including regeneration.
+    Stored energy is the value as of last_energy_update; the current value
+    is derived on read, so reads never have to write it back.
+    """
+    return energy_at(row.get("energy"), row.get("last_energy_update"), row.get("max_energy"),
+                     row.get("energy_regen_rate"), current_time)
+
+def tap_changes(row, taps, current_time):
+    """
+    Spend up to `taps` energy from a users row and credit tap_power coins per tap.
+    Returns (changes, accepted, energy); changes is empty when nothing was accepted.
+    """
+    energy = regenerated_energy(row, current_time)
+    accepted = max(0, min(int(taps), int(energy)))
+    if accepted == 0:
+        return {}, 0, energy
+    return {
+        "coins": int(row.get("coins") or 0) + accepted * int(row.get("tap_power") or 1),
+        "energy": energy - accepted,
+        "last_energy_update": current_time
+    }, accepted, energy - accepted
+
+def delta_changes(row, coins=0, min_coins=None, clamp_coins=False, tap_power=0, max_energy=0,
+                  energy_regen_rate=0, expect=None, current_time=None):
+    """
+    Changes for UserRepository.apply_delta, or None when a guard fails
+    """
+    current_time = int(current_time or time.time())
+    if min_coins is not None and int(row.get("coins") or 0) < min_coins:
+        return None
+    for field, value in (expect or {}).items():
+        if float(row.get(field) or 0) != float(value):
+            return None
+    new_coins = int(row.get("coins") or 0) + int(coins)
+    changes = {"coins": max(0, new_coins) if clamp_coins else new_coins}
+    if tap_power:
+        changes["tap_power"] = int(row.get("tap_power") or 0) + int(tap_power)
+    if max_energy or energy_regen_rate:
+        # Settle regenerated energy before capacity or rate changes
+        changes["energy"] = regenerated_energy(row, current_time)
+        changes["last_energy_update"] = current_time
+    if max_energy:
+        changes["max_energy"] = int(row.get("max_energy") or 0) + int(max_energy)
+    if energy_regen_rate:
+        changes["energy_regen_rate"] = float(row.get("energy_regen_rate") or 0) + float(energy_regen_rate)
+    return changes
+
+def tap_delta_changes(row, delta, current_time):
+    """
+    Changes applying one write-behind {"coins", "energy"} delta to a users row
+    """
+    return {
+        "coins": int(row.get("coins") or 0) + int(delta["coins"]),
+        "energy": max(0.0, regenerated_energy(row, current_time) - delta["energy"]),
+        "last_energy_update": current_time
+    }
+
+def new_user_row(new_user, telegram_id, current_time):
+    """
+    Insertable users row for a new user from a dict of column values.
+    referred_by is left unset; only a credited referral sets it.
+    """
+    row = {column: new_user[column] for column in USER_COLUMNS if column in new_user and column not in ("id", "referred_by")}
+    row["telegram_id"] = str(telegram_id)
+    row["last_energy_update"] = row.get("last_energy_update") or int(current_time)
+    return row
+
+def referral_credit(referrer_id, referrer_bonus, current_time):
+    """
+    referral_credits row crediting one referral to referrer_id
+    """
+    return {
+        "referrer_id": str(referrer_id),
+        "coins": int(referrer_bonus),
+        "referral_count": 1,
+        "referral_earnings": int(referrer_bonus),
+        "created_at": int(current_time)
+    }
+
+def credit_totals(credits):
+    """
+    Summed referral credits per referrer_id
+    """
+    totals = {}
+    for credit in credits:
+        total = totals.setdefault(str(credit["referrer_id"]), {"coins": 0, "referral_count": 0, "referral_earnings": 0})
+        for field in total:
+            total[field] += int(credit.get(field) or 0)
+    return totals
+
+def referral_record(referrer_id, user, referrer_bonus, current_time):
+    """
+    referred_users row for a referral of the users row `user`
+    """
+    return {
+        "referrer_id": str(referrer_id),
+        "user_id": str(user["telegram_id"]),
+        "username": user.get("username"),
+        "name": user.get("first_name"),
+        "joined_date": int(current_time),
+        "earnings_from_referral": int(referrer_bonus)
+    }
+
+class UserRepository:
+    """
+    Storage for the users table. Rows are plain dicts keyed by column name.
+    """
+
+    def get(self, telegram_id):
+        """
+        Row for a Telegram ID, or None
+        """
+        raise NotImplementedError
+
+    def upsert(self, telegram_id, fields):
+        """
+        Insert a user, or update only the given columns of the existing row
+        with the same telegram_id. Returns the stored row.
+        """
+        raise NotImplementedError
+
+    def get_many(self, telegram_ids):
+        """
+        Rows for many Telegram IDs (missing ones are skipped), fetched in chunks
+        """
+        raise NotImplementedError
+
+    def delete(self, telegram_id):
+        """
+        Delete a user, returning True if a row was removed
+        """
+        raise NotImplementedError
+
+    def list(self, columns="*"):
+        """
+        Every user row
+        """
+        raise NotImplementedError
+
+    def page(self, columns, sort="created", after=None, prefix=None, limit=50):
+        """
+        One page of users ordered by the USER_SORT_COLUMNS column for `sort`,
+        descending (nulls first), then id descending. `after` is the
+        (sort value, id) of the previous page's last row; `prefix` matches
+        the start of username (case-insensitive) or telegram_id.
+        """
+        raise NotImplementedError
+
+    def id_page(self, after_id=None, limit=1000):
+        """
+        One page of (id, telegram_id) rows in id order, for walking every
+        user. `after_id` is the id of the previous page's last row.
+        """
+        raise NotImplementedError
+
+    def tap(self, telegram_id, taps, current_time):
+        """
+        Atomically spend up to `taps` energy and credit coins.
+        Returns (row, accepted), or (None, 0) if the user does not exist.
+        """
+        raise NotImplementedError
+
+    def apply_delta(self, telegram_id, **delta):
+        """
+        Atomically apply delta_changes() to a user. Returns the updated row,
+        or None if the user is missing or a guard failed.
+        """
+        raise NotImplementedError
+
+    def apply_tap_deltas(self, deltas, current_time):
+        """
+        Apply write-behind tap deltas in bulk. Returns (updated_rows, failed_deltas).
+        """
+        raise NotImplementedError
+
+    def apply_referral(self, referrer_id, telegram_id, new_user, referee_bonus, referrer_bonus, current_time):
+        """
+        Credit a referral of telegram_id by referrer_id once: create the
+        referee from new_user if missing, record the referred_users row
+        (unique per referee), set referred_by and add the referee bonus.
+        The referrer's bonus is written as a referral_credits row, merged
+        later by merge_referral_credits(), so the referrer's row is not touched.
+        Returns (status, user_row, referrer_row) where status is "applied",
+        "duplicate" (already credited to this referrer), "already_referred"
+        or "invalid_referrer" (with no rows).
+        """
+        raise NotImplementedError
+
+    def merge_referral_credits(self, referrer_id=None, limit=None):
+        """
+        Atomically move up to `limit` pending referral credits (only
+        referrer_id's when given) into users, one update per referrer.
+        Returns (updated_user_rows, merged_credit_count).
+        """
+        raise NotImplementedError
+
+def refund_totals(withdrawals):
+    """
+    Total amount per user_id across withdrawal rows, for batched refunds
+    """
+    totals = {}
+    for withdrawal in withdrawals:
+        user_id = str(withdrawal["user_id"])
+        totals[user_id] = totals.get(user_id, 0) + int(withdrawal.get("amount") or 0)
+    return totals
+
+class WithdrawalRepository:
+    """
+    Storage for the withdrawals table
+    """
+
+    def insert(self, row):
+        """
+        Insert a withdrawal record, returning the stored row
+        """
+        raise NotImplementedError
+
+    def create(self, telegram_id, amount, row, idempotency_key=None):
+        """
+        Atomically debit `amount` coins from the user and insert the withdrawal
+        `row`. A repeated idempotency_key returns the stored withdrawal without
+        debiting again. Returns (status, withdrawal_row, user_row); status is
+        created, replayed, insufficient_funds or user_not_found.
+        """
+        raise NotImplementedError
+
+    def get(self, withdrawal_id):
+        """
+        Withdrawal by id, or None
+        """
+        raise NotImplementedError
+
+    def update_status(self, withdrawal_id, status):
+        """
+        Set a withdrawal's status, returning the updated row or None
+        """
+        raise NotImplementedError
+
+    def list_by_user(self, telegram_id):
+        """
+        A user's withdrawals, newest first
+        """
+        raise NotImplementedError
+
+    def list(self):
+        """
+        Every withdrawal, newest first
+        """
+        raise NotImplementedError
+
+    def page(self, status=None, after=None, limit=50, descending=False, exclude_status=None, user_id=None):
+        """
+        One page of withdrawals ordered by (created_at, id), optionally limited
+        to one status or excluding one, and to one user. `after` is the
+        (created_at, id) of the previous page's last row.
+        """
+        raise NotImplementedError
+
+    def review(self, withdrawal_ids, status, refund=False):
+        """
+        Atomically move the pending withdrawals among withdrawal_ids to status,
+        crediting the amounts back with one update per user when refund is set.
+        Withdrawals that are not pending are left alone. Returns the reviewed rows.
+        """
+        raise NotImplementedError
+
+class ReferredUserRepository:
+    """
+    Storage for the referred_users table
+    """
+
+    def insert(self, row):
+        """
+        Record a referred user
+        """
+        raise NotImplementedError
+
+    def list_by_referrer(self, referrer_id):
+        """
+        Users referred by referrer_id
+        """
+        raise NotImplementedError
+
+    def page(self, referrer_id, after_id=None, limit=50):
+        """
+        One page of users referred by referrer_id, newest first. `after_id`
+        is the id of the previous page's last row.
+        """
+        raise NotImplementedError
+
+class MinigameRewardRepository:
+    """
+    Storage for the minigame_rewards table
+    """
+
+    def insert(self, row):
+        """
+        Record a minigame reward
+        """
+        raise NotImplementedError
+
+    def insert_many(self, rows):
+        """
+        Record many minigame rewards in one multi-row insert
+        """
+        raise NotImplementedError
+
+# Columns of a transactions (ledger) row written by TransactionRepository.append
+TRANSACTION_COLUMNS = ("user_id", "type", "amount", "description", "created_at")
+
+def ledger_totals(rows):
+    """
+    Per-user {"balance", "entries", "last_transaction_id", "updated_at"} for
+    inserted transactions rows, used to advance ledger_balances
+    """
+    totals = {}
+    for row in rows:
+        total = totals.setdefault(str(row["user_id"]), {
+            "balance": 0, "entries": 0, "last_transaction_id": 0, "updated_at": 0
+        })
+        total["balance"] += int(row["amount"])
+        total["entries"] += 1
+        total["last_transaction_id"] = max(total["last_transaction_id"], int(row["id"]))
+        total["updated_at"] = max(total["updated_at"], int(row["created_at"]))
+    return totals
+
+class TransactionRepository:
+    """
+    Storage for the append-only transactions ledger and the per-user
+    ledger_balances snapshots kept alongside it
+    """
+
+    def append(self, rows):
+        """
+        Insert many transactions rows and advance each user's ledger_balances
+        row, all in one step. Returns the number of rows written.
+        """
+        raise NotImplementedError
+
+    def page(self, user_id, after_id=None, limit=50):
+        """
+        One page of a user's transactions, newest first. `after_id` is the
+        id of the previous page's last row.
+        """
+        raise NotImplementedError
+
+    def balance(self, user_id):
+        """
+        A user's ledger_balances row (balance, entries, last_transaction_id,
+        updated_at), or None if nothing was recorded for them
+        """
+        raise NotImplementedError
+
+class BroadcastRepository:
+    """
+    Storage for the broadcasts table: admin messages sent to every user,
+    with the progress checkpoint a restarted sender resumes from
+    """
+
+    def insert(self, row):
+        """
+        Create a broadcast, returning the stored row
+        """
+        raise NotImplementedError
+
+    def get(self, broadcast_id):
+        """
+        Row for a broadcast id, or None
+        """
+        raise NotImplementedError
+
+    def update(self, broadcast_id, fields, status=None, owner=None):
+        """
+        Update a broadcast's columns, only if its status is still `status`
+        and its lease is still held by `owner` when given. Returns the updated
+        row, or None if nothing matched.
+        """
+        raise NotImplementedError
+
+    def claim(self, broadcast_id, owner, lease_until, current_time):
+        """
+        Take the sending lease of a running broadcast whose lease is free or
+        expired. Returns the row if this owner now holds it, else None.
+        """
+        raise NotImplementedError
+
+    def list(self, statuses=None, limit=20):
+        """
+        The newest broadcasts, optionally only those in `statuses`
+        """
+        raise NotImplementedError
+
+class StatsRepository:
+    """
+    Admin dashboard counters, kept up to date by database triggers
+    """
+
+    def totals(self):
+        """
+        Current counters: total_users, total_coins, total_withdrawals,
+        pending_withdrawals, completed_withdrawals, total_withdrawn
+        """
+        raise NotImplementedError
+
+    def count_playing_users(self, since):
+        """
+        Users who tapped or upgraded at or after `since`, i.e. whose
+        last_energy_update is in range (indexed range count)
+        """
+        raise NotImplementedError
+
+    def rebuild(self):
+        """
+        Recompute the counters from the users and withdrawals tables
+        """
+        raise NotImplementedError
+
+# Counter columns of the app_stats table
+STATS_COUNTERS = (
+    "total_users", "total_coins", "total_withdrawals", "pending_withdrawals",
+    "completed_withdrawals", "total_withdrawn"
+)
+
+def sum_stats_rows(rows):
+    """
+    Sum app_stats shard rows into one totals dict
+    """
+    return {counter: sum(int(row.get(counter) or 0) for row in rows) for counter in STATS_COUNTERS}
+
+class Storage:
+    """
+    A storage backend: one repository per table
+    """
+    name = None
+    users = None
+    withdrawals = None
+    referred_users = None
+    minigame_rewards = None
+    transactions = None
+    broadcasts = None
+    stats = None
@@ -0,0 +1,712 @@
+from contextlib import contextmanager
+import logging
+import os
+import sqlite3
+import threading
+from src.storage.base import (
+    TRANSACTION_COLUMNS, USER_COLUMNS, USER_SORT_COLUMNS, BroadcastRepository, MinigameRewardRepository, ReferredUserRepository, StatsRepository, Storage,
+    TransactionRepository, UserRepository, WithdrawalRepository, credit_totals, delta_changes, ledger_totals, new_user_row, referral_credit,
+    referral_record, refund_totals, sum_stats_rows, tap_changes, tap_delta_changes
+)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Bound parameters per IN (...) query, below SQLite's variable limit
+IN_CHUNK_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id TEXT NOT NULL UNIQUE,
+    username TEXT,
+    first_name TEXT,
+    coins INTEGER NOT NULL DEFAULT 0,
+    energy REAL NOT NULL DEFAULT 100,
+    max_energy INTEGER NOT NULL DEFAULT 100,
+    tap_power INTEGER NOT NULL DEFAULT 1,
+    energy_regen_rate REAL NOT NULL DEFAULT 1,
+    last_energy_update INTEGER,
+    referred_by TEXT,
+    referral_count INTEGER NOT NULL DEFAULT 0,
+    referral_earnings INTEGER NOT NULL DEFAULT 0,
+    upi_id TEXT
+);
+
+CREATE TABLE IF NOT EXISTS withdrawals (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    final_amount INTEGER,
+    fee INTEGER,
+    inr_amount REAL,
+    upi_id TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at TEXT NOT NULL,
+    idempotency_key TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_user_created ON withdrawals (user_id, created_at);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_withdrawals_user_idempotency_key ON withdrawals (user_id, idempotency_key);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_status_created ON withdrawals (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_created ON withdrawals (created_at);
+
+CREATE TABLE IF NOT EXISTS referred_users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    referrer_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    username TEXT,
+    name TEXT,
+    joined_date INTEGER,
+    earnings_from_referral INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_referred_users_referrer ON referred_users (referrer_id);
+-- A user can be referred once (duplicates in older databases are removed
+-- once by SQLiteStorage._dedupe_referred_users)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_referred_users_user ON referred_users (user_id);
+
+-- Append-only referrer bonuses, merged into users in batches
+CREATE TABLE IF NOT EXISTS referral_credits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    referrer_id TEXT NOT NULL,
+    coins INTEGER NOT NULL DEFAULT 0,
+    referral_count INTEGER NOT NULL DEFAULT 0,
+    referral_earnings INTEGER NOT NULL DEFAULT 0,
+    created_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_referral_credits_referrer ON referral_credits (referrer_id);
+
+CREATE TABLE IF NOT EXISTS minigame_rewards (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id TEXT NOT NULL,
+    game_name TEXT,
+    amount INTEGER NOT NULL,
+    timestamp INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_minigame_rewards_telegram_id ON minigame_rewards (telegram_id);
+
+-- Append-only ledger of coin movements, written in batches
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    description TEXT,
+    created_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id, id);
+CREATE TRIGGER IF NOT EXISTS transactions_no_update BEFORE UPDATE ON transactions BEGIN
+    SELECT RAISE(ABORT, 'transactions are append-only');
+END;
+CREATE TRIGGER IF NOT EXISTS transactions_no_delete BEFORE DELETE ON transactions BEGIN
+    SELECT RAISE(ABORT, 'transactions are append-only');
+END;
+
+-- Running ledger total per user, advanced with every batch, so balance
+-- audits never sum the ledger
+CREATE TABLE IF NOT EXISTS ledger_balances (
+    user_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL DEFAULT 0,
+    entries INTEGER NOT NULL DEFAULT 0,
+    last_transaction_id INTEGER,
+    updated_at INTEGER NOT NULL
+);
+
+-- Admin broadcasts; last_user_id is the users.id every recipient up to has
+-- been handled, and owner/lease_until the process currently sending
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    parse_mode TEXT,
+    reply_markup TEXT,
+    paid INTEGER NOT NULL DEFAULT 0,
+    rate REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    total INTEGER NOT NULL DEFAULT 0,
+    last_user_id INTEGER NOT NULL DEFAULT 0,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    owner TEXT,
+    lease_until INTEGER,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL,
+    finished_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status);
+
+-- Admin listing: keyset sorts (the rowid is implicitly the trailing key)
+-- and case-insensitive username prefix search
+CREATE INDEX IF NOT EXISTS idx_users_last_energy_update ON users (last_energy_update);
+CREATE INDEX IF NOT EXISTS idx_users_coins ON users (coins);
+CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE);
+
+-- Admin dashboard counters, maintained by the triggers below. SQLite has a
+-- single writer, so one row (shard 0) is enough.
+CREATE TABLE IF NOT EXISTS app_stats (
+    shard INTEGER PRIMARY KEY,
+    total_users INTEGER NOT NULL DEFAULT 0,
+    total_coins INTEGER NOT NULL DEFAULT 0,
+    total_withdrawals INTEGER NOT NULL DEFAULT 0,
+    pending_withdrawals INTEGER NOT NULL DEFAULT 0,
+    completed_withdrawals INTEGER NOT NULL DEFAULT 0,
+    total_withdrawn INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS app_stats_users_insert AFTER INSERT ON users BEGIN
+    UPDATE app_stats SET total_users = total_users + 1, total_coins = total_coins + NEW.coins WHERE shard = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS app_stats_users_update AFTER UPDATE OF coins ON users BEGIN
+    UPDATE app_stats SET total_coins = total_coins + NEW.coins - OLD.coins WHERE shard = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS app_stats_users_delete AFTER DELETE ON users BEGIN
+    UPDATE app_stats SET total_users = total_users - 1, total_coins = total_coins - OLD.coins WHERE shard = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS app_stats_withdrawals_insert AFTER INSERT ON withdrawals BEGIN
+    UPDATE app_stats
+       SET total_withdrawals = total_withdrawals + 1,
+           pending_withdrawals = pending_withdrawals + (NEW.status = 'pending'),
+           completed_withdrawals = completed_withdrawals + (NEW.status = 'completed'),
+           total_withdrawn = total_withdrawn + CASE WHEN NEW.status = 'completed' THEN NEW.amount ELSE 0 END
+     WHERE shard = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS app_stats_withdrawals_update AFTER UPDATE OF status, amount ON withdrawals BEGIN
+    UPDATE app_stats
+       SET pending_withdrawals = pending_withdrawals + (NEW.status = 'pending') - (OLD.status = 'pending'),
+           completed_withdrawals = completed_withdrawals + (NEW.status = 'completed') - (OLD.status = 'completed'),
+           total_withdrawn = total_withdrawn
+               + CASE WHEN NEW.status = 'completed' THEN NEW.amount ELSE 0 END
+               - CASE WHEN OLD.status = 'completed' THEN OLD.amount ELSE 0 END
+     WHERE shard = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS app_stats_withdrawals_delete AFTER DELETE ON withdrawals BEGIN
+    UPDATE app_stats
+       SET total_withdrawals = total_withdrawals - 1,
+           pending_withdrawals = pending_withdrawals - (OLD.status = 'pending'),
+           completed_withdrawals = completed_withdrawals - (OLD.status = 'completed'),
+           total_withdrawn = total_withdrawn - CASE WHEN OLD.status = 'completed' THEN OLD.amount ELSE 0 END
+     WHERE shard = 0;
+END;
+"""
+
+# Columns added after their table was first released, created on startup in
+# databases from before them (CREATE TABLE IF NOT EXISTS leaves those alone)
+ADDED_COLUMNS = {
+    "withdrawals": {"idempotency_key": "TEXT"}
+}
+
+REBUILD_STATS = """
+DELETE FROM app_stats;
+INSERT INTO app_stats (shard, total_users, total_coins, total_withdrawals, pending_withdrawals, completed_withdrawals, total_withdrawn)
+SELECT 0,
+       (SELECT COUNT(*) FROM users),
+       (SELECT COALESCE(SUM(coins), 0) FROM users),
+       COUNT(*),
+       COALESCE(SUM(status = 'pending'), 0),
+       COALESCE(SUM(status = 'completed'), 0),
+       COALESCE(SUM(CASE WHEN status = 'completed' THEN amount ELSE 0 END), 0)
+  FROM withdrawals;
+"""
+
+class SQLiteStorage(Storage):
+    """
+    Embedded storage for small deployments and load tests. Uses WAL mode so
+    readers never block the writer, one connection per thread and
+    parameterised statements (cached and reused by sqlite3). Multi-step
+    mutations run inside BEGIN IMMEDIATE transactions, which gives them the
+    same all-or-nothing semantics as the Supabase functions.
+    """
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._add_columns()
+        self._dedupe_referred_users()
+        self.connection().executescript(SCHEMA)
+        logger.info(f"SQLite storage ready at {path}")
+
+        self.users = SQLiteUserRepository(self)
+        self.withdrawals = SQLiteWithdrawalRepository(self)
+        self.referred_users = SQLiteReferredUserRepository(self)
+        self.minigame_rewards = SQLiteMinigameRewardRepository(self)
+        self.transactions = SQLiteTransactionRepository(self)
+        self.broadcasts = SQLiteBroadcastRepository(self)
+        self.stats = SQLiteStatsRepository(self)
+
+        # A new counters table starts from the rows already stored
+        if self.query_one("SELECT shard FROM app_stats") is None:
+            self.stats.rebuild()
+
+    def _add_columns(self):
+        connection = self.connection()
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row["name"] for row in connection.execute(f"PRAGMA table_info({table})").fetchall()}
+            # An empty result means the table is new and SCHEMA creates it whole
+            for column, definition in columns.items():
+                if existing and column not in existing:
+                    connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def _dedupe_referred_users(self):
+        """
+        One-off migration for databases from before the unique index on
+        referred_users.user_id: keeps the first record of each referred user
+        and logs how many duplicates it removed. Does nothing once the index
+        exists, so later startups never delete referral rows.
+        """
+        connection = self.connection()
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'referred_users'").fetchone() is None:
+            return
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_referred_users_user'").fetchone():
+            return
+        with self.transaction() as connection:
+            removed = connection.execute(
+                "DELETE FROM referred_users WHERE id NOT IN (SELECT MIN(id) FROM referred_users GROUP BY user_id)"
+            ).rowcount
+            connection.execute("CREATE UNIQUE INDEX idx_referred_users_user ON referred_users (user_id)")
+        if removed:
+            logger.warning(f"Removed {removed} duplicate referred_users rows before adding idx_referred_users_user")
+
+    def connection(self):
+        """
+        This thread's connection, opened on first use
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode; transactions are opened explicitly
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, cached_statements=256)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=30000")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction that takes the database write lock up front
+        """
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def query(self, sql, params=()):
+        return [dict(row) for row in self.connection().execute(sql, params).fetchall()]
+
+    def query_one(self, sql, params=()):
+        row = self.connection().execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+def _insert(connection, table, row):
+    columns = list(row)
+    cursor = connection.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+        [row[column] for column in columns]
+    )
+    return dict(connection.execute(f"SELECT * FROM {table} WHERE id = ?", (cursor.lastrowid,)).fetchone())
+
+def _update_user(connection, user_id, changes):
+    assignments = ", ".join(f"{column} = ?" for column in changes)
+    connection.execute(f"UPDATE users SET {assignments} WHERE id = ?", [*changes.values(), user_id])
+    return dict(connection.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone())
+
+def _user_for_update(connection, telegram_id):
+    row = connection.execute("SELECT * FROM users WHERE telegram_id = ?", (str(telegram_id),)).fetchone()
+    return dict(row) if row else None
+
+class SQLiteUserRepository(UserRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get(self, telegram_id):
+        return self.storage.query_one("SELECT * FROM users WHERE telegram_id = ?", (str(telegram_id),))
+
+    def get_many(self, telegram_ids):
+        telegram_ids = [str(telegram_id) for telegram_id in telegram_ids]
+        rows = []
+        for start in range(0, len(telegram_ids), IN_CHUNK_SIZE):
+            chunk = telegram_ids[start:start + IN_CHUNK_SIZE]
+            rows.extend(self.storage.query(
+                f"SELECT * FROM users WHERE telegram_id IN ({', '.join('?' for _ in chunk)})", chunk
+            ))
+        return rows
+
+    def upsert(self, telegram_id, fields):
+        row = {column: fields[column] for column in USER_COLUMNS if column in fields and column != "id"}
+        row["telegram_id"] = str(telegram_id)
+        columns = list(row)
+        updates = [column for column in columns if column != "telegram_id"] or ["telegram_id"]
+        with self.storage.transaction() as connection:
+            connection.execute(
+                f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+                f"ON CONFLICT (telegram_id) DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in updates)}",
+                [row[column] for column in columns]
+            )
+            return _user_for_update(connection, telegram_id)
+
+    def delete(self, telegram_id):
+        with self.storage.transaction() as connection:
+            cursor = connection.execute("DELETE FROM users WHERE telegram_id = ?", (str(telegram_id),))
+            return cursor.rowcount > 0
+
+    def list(self, columns="*"):
+        return self.storage.query(f"SELECT {columns} FROM users")
+
+    def page(self, columns, sort="created", after=None, prefix=None, limit=50):
+        column = USER_SORT_COLUMNS[sort]
+        conditions = []
+        params = []
+        if prefix:
+            # Prefix ranges instead of LIKE so both indexes are used
+            upper = prefix + "\uffff"
+            conditions.append(
+                "(username >= ? COLLATE NOCASE AND username < ? COLLATE NOCASE OR telegram_id >= ? AND telegram_id < ?)"
+            )
+            params += [prefix, upper, prefix, upper]
+        if after is not None:
+            value, last_id = after
+            if value is None:
+                conditions.append(f"({column} IS NULL AND id < ? OR {column} IS NOT NULL)")
+                params.append(last_id)
+            else:
+                conditions.append(f"({column} < ? OR {column} = ? AND id < ?)")
+                params += [value, value, last_id]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self.storage.query(
+            f"SELECT {columns} FROM users {where} ORDER BY {column} DESC NULLS FIRST, id DESC LIMIT ?",
+            params + [int(limit)]
+        )
+
+    def id_page(self, after_id=None, limit=1000):
+        return self.storage.query(
+            "SELECT id, telegram_id FROM users WHERE id > ? ORDER BY id LIMIT ?", (int(after_id or 0), int(limit))
+        )
+
+    def tap(self, telegram_id, taps, current_time):
+        with self.storage.transaction() as connection:
+            row = _user_for_update(connection, telegram_id)
+            if row is None:
+                return None, 0
+            changes, accepted, energy = tap_changes(row, taps, current_time)
+            if not accepted:
+                # Nothing written, report the regenerated energy
+                return dict(row, energy=energy, last_energy_update=int(current_time)), 0
+            return _update_user(connection, row["id"], changes), accepted
+
+    def apply_delta(self, telegram_id, current_time=None, **delta):
+        with self.storage.transaction() as connection:
+            row = _user_for_update(connection, telegram_id)
+            if row is None:
+                return None
+            changes = delta_changes(row, current_time=current_time, **delta)
+            if changes is None:
+                return None
+            return _update_user(connection, row["id"], changes)
+
+    def apply_tap_deltas(self, deltas, current_time):
+        rows = []
+        with self.storage.transaction() as connection:
+            for delta in deltas:
+                row = _user_for_update(connection, delta["telegram_id"])
+                if row is not None:
+                    rows.append(_update_user(connection, row["id"], tap_delta_changes(row, delta, current_time)))
+        return rows, []
+
+    def apply_referral(self, referrer_id, telegram_id, new_user, referee_bonus, referrer_bonus, current_time):
+        referrer_id = str(referrer_id)
+        with self.storage.transaction() as connection:
+            referrer = _user_for_update(connection, referrer_id)
+            if referrer is None:
+                return "invalid_referrer", None, None
+            user = _user_for_update(connection, telegram_id)
+            if user is None:
+                user = _insert(connection, "users", new_user_row(new_user, telegram_id, current_time))
+            if user["referred_by"]:
+                status = "duplicate" if str(user["referred_by"]) == referrer_id else "already_referred"
+                return status, user, referrer
+
+            record = referral_record(referrer_id, user, referrer_bonus, current_time)
+            cursor = connection.execute(
+                f"INSERT OR IGNORE INTO referred_users ({', '.join(record)}) VALUES ({', '.join('?' for _ in record)})",
+                list(record.values())
+            )
+            if cursor.rowcount == 0:
+                return "duplicate", user, referrer
+
+            user = _update_user(connection, user["id"], {
+                "referred_by": referrer_id,
+                "coins": int(user["coins"] or 0) + int(referee_bonus)
+            })
+            _insert(connection, "referral_credits", referral_credit(referrer_id, referrer_bonus, current_time))
+            return "applied", user, referrer
+
+    def merge_referral_credits(self, referrer_id=None, limit=None):
+        conditions = "WHERE referrer_id = ?" if referrer_id is not None else ""
+        params = [str(referrer_id)] if referrer_id is not None else []
+        with self.storage.transaction() as connection:
+            credits = [dict(row) for row in connection.execute(
+                f"SELECT * FROM referral_credits {conditions} ORDER BY id LIMIT ?", params + [-1 if limit is None else int(limit)]
+            ).fetchall()]
+            if not credits:
+                return [], 0
+            connection.executemany("DELETE FROM referral_credits WHERE id = ?", [(credit["id"],) for credit in credits])
+            rows = []
+            for telegram_id, total in credit_totals(credits).items():
+                cursor = connection.execute(
+                    "UPDATE users SET coins = coins + ?, referral_count = referral_count + ?, "
+                    "referral_earnings = referral_earnings + ? WHERE telegram_id = ?",
+                    (total["coins"], total["referral_count"], total["referral_earnings"], telegram_id)
+                )
+                if cursor.rowcount:
+                    rows.append(_user_for_update(connection, telegram_id))
+            return rows, len(credits)
+
+class SQLiteWithdrawalRepository(WithdrawalRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def insert(self, row):
+        with self.storage.transaction() as connection:
+            return _insert(connection, "withdrawals", row)
+
+    def create(self, telegram_id, amount, row, idempotency_key=None):
+        telegram_id = str(telegram_id)
+        with self.storage.transaction() as connection:
+            user = _user_for_update(connection, telegram_id)
+            if user is None:
+                return "user_not_found", None, None
+            if idempotency_key is not None:
+                withdrawal = connection.execute(
+                    "SELECT * FROM withdrawals WHERE user_id = ? AND idempotency_key = ?", (telegram_id, idempotency_key)
+                ).fetchone()
+                if withdrawal is not None:
+                    return "replayed", dict(withdrawal), user
+            if int(user["coins"] or 0) < int(amount):
+                return "insufficient_funds", None, user
+
+            user = _update_user(connection, user["id"], {"coins": int(user["coins"] or 0) - int(amount)})
+            withdrawal = _insert(connection, "withdrawals", dict(
+                row, user_id=telegram_id, amount=int(amount), idempotency_key=idempotency_key
+            ))
+            return "created", withdrawal, user
+
+    def get(self, withdrawal_id):
+        return self.storage.query_one("SELECT * FROM withdrawals WHERE id = ?", (withdrawal_id,))
+
+    def update_status(self, withdrawal_id, status):
+        with self.storage.transaction() as connection:
+            cursor = connection.execute("UPDATE withdrawals SET status = ? WHERE id = ?", (status, withdrawal_id))
+            if cursor.rowcount == 0:
+                return None
+            return dict(connection.execute("SELECT * FROM withdrawals WHERE id = ?", (withdrawal_id,)).fetchone())
+
+    def list_by_user(self, telegram_id):
+        return self.storage.query(
+            "SELECT * FROM withdrawals WHERE user_id = ? ORDER BY created_at DESC, id DESC", (str(telegram_id),)
+        )
+
+    def list(self):
+        return self.storage.query("SELECT * FROM withdrawals ORDER BY created_at DESC, id DESC")
+
+    def page(self, status=None, after=None, limit=50, descending=False, exclude_status=None, user_id=None):
+        conditions = []
+        params = []
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(str(user_id))
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if exclude_status:
+            conditions.append("status != ?")
+            params.append(exclude_status)
+        operator = "<" if descending else ">"
+        if after is not None:
+            created_at, last_id = after
+            conditions.append(f"(created_at {operator} ? OR created_at = ? AND id {operator} ?)")
+            params += [created_at, created_at, last_id]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        direction = "DESC" if descending else "ASC"
+        return self.storage.query(
+            f"SELECT * FROM withdrawals {where} ORDER BY created_at {direction}, id {direction} LIMIT ?",
+            params + [int(limit)]
+        )
+
+    def review(self, withdrawal_ids, status, refund=False):
+        withdrawal_ids = [int(withdrawal_id) for withdrawal_id in withdrawal_ids]
+        rows = []
+        with self.storage.transaction() as connection:
+            for start in range(0, len(withdrawal_ids), IN_CHUNK_SIZE):
+                chunk = withdrawal_ids[start:start + IN_CHUNK_SIZE]
+                placeholders = ", ".join("?" for _ in chunk)
+                pending = [dict(row) for row in connection.execute(
+                    f"SELECT * FROM withdrawals WHERE id IN ({placeholders}) AND status = 'pending'", chunk
+                ).fetchall()]
+                if pending:
+                    connection.executemany(
+                        "UPDATE withdrawals SET status = ? WHERE id = ?", [(status, row["id"]) for row in pending]
+                    )
+                rows.extend(dict(row, status=status) for row in pending)
+            if refund:
+                connection.executemany(
+                    "UPDATE users SET coins = coins + ? WHERE telegram_id = ?",
+                    [(amount, user_id) for user_id, amount in refund_totals(rows).items()]
+                )
+        return rows
+
+class SQLiteReferredUserRepository(ReferredUserRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def insert(self, row):
+        with self.storage.transaction() as connection:
+            return _insert(connection, "referred_users", row)
+
+    def list_by_referrer(self, referrer_id):
+        return self.storage.query("SELECT * FROM referred_users WHERE referrer_id = ?", (str(referrer_id),))
+
+    def page(self, referrer_id, after_id=None, limit=50):
+        if after_id is None:
+            return self.storage.query(
+                "SELECT * FROM referred_users WHERE referrer_id = ? ORDER BY id DESC LIMIT ?", (str(referrer_id), int(limit))
+            )
+        return self.storage.query(
+            "SELECT * FROM referred_users WHERE referrer_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (str(referrer_id), int(after_id), int(limit))
+        )
+
+class SQLiteMinigameRewardRepository(MinigameRewardRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def insert(self, row):
+        with self.storage.transaction() as connection:
+            return _insert(connection, "minigame_rewards", row)
+
+    def insert_many(self, rows):
+        if not rows:
+            return
+        with self.storage.transaction() as connection:
+            connection.executemany(
+                "INSERT INTO minigame_rewards (telegram_id, game_name, amount, timestamp) VALUES (?, ?, ?, ?)",
+                [(str(row["telegram_id"]), row.get("game_name"), int(row["amount"]), row.get("timestamp")) for row in rows]
+            )
+
+class SQLiteTransactionRepository(TransactionRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def append(self, rows):
+        if not rows:
+            return 0
+        with self.storage.transaction() as connection:
+            inserted = []
+            for row in rows:
+                values = [row.get(column) for column in TRANSACTION_COLUMNS]
+                cursor = connection.execute(
+                    f"INSERT INTO transactions ({', '.join(TRANSACTION_COLUMNS)}) VALUES ({', '.join('?' for _ in values)})", values
+                )
+                inserted.append(dict(row, id=cursor.lastrowid))
+            connection.executemany(
+                "INSERT INTO ledger_balances (user_id, balance, entries, last_transaction_id, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET balance = balance + excluded.balance, entries = entries + excluded.entries, "
+                "last_transaction_id = MAX(last_transaction_id, excluded.last_transaction_id), "
+                "updated_at = MAX(updated_at, excluded.updated_at)",
+                [(user_id, total["balance"], total["entries"], total["last_transaction_id"], total["updated_at"])
+                 for user_id, total in ledger_totals(inserted).items()]
+            )
+        return len(inserted)
+
+    def page(self, user_id, after_id=None, limit=50):
+        if after_id is None:
+            return self.storage.query(
+                "SELECT * FROM transactions WHERE user_id = ? ORDER BY id DESC LIMIT ?", (str(user_id), int(limit))
+            )
+        return self.storage.query(
+            "SELECT * FROM transactions WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (str(user_id), int(after_id), int(limit))
+        )
+
+    def balance(self, user_id):
+        return self.storage.query_one("SELECT * FROM ledger_balances WHERE user_id = ?", (str(user_id),))
+
+class SQLiteBroadcastRepository(BroadcastRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def insert(self, row):
+        with self.storage.transaction() as connection:
+            return _insert(connection, "broadcasts", row)
+
+    def get(self, broadcast_id):
+        return self.storage.query_one("SELECT * FROM broadcasts WHERE id = ?", (int(broadcast_id),))
+
+    def update(self, broadcast_id, fields, status=None, owner=None):
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        params = [*fields.values(), int(broadcast_id)]
+        condition = ""
+        if status is not None:
+            condition += " AND status = ?"
+            params.append(status)
+        if owner is not None:
+            condition += " AND owner = ?"
+            params.append(owner)
+        with self.storage.transaction() as connection:
+            cursor = connection.execute(f"UPDATE broadcasts SET {assignments} WHERE id = ?{condition}", params)
+            if cursor.rowcount == 0:
+                return None
+            return dict(connection.execute("SELECT * FROM broadcasts WHERE id = ?", (int(broadcast_id),)).fetchone())
+
+    def claim(self, broadcast_id, owner, lease_until, current_time):
+        with self.storage.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE broadcasts SET owner = ?, lease_until = ? "
+                "WHERE id = ? AND status = 'running' AND (owner IS NULL OR owner = ? OR lease_until < ?)",
+                (owner, int(lease_until), int(broadcast_id), owner, int(current_time))
+            )
+            if cursor.rowcount == 0:
+                return None
+            return dict(connection.execute("SELECT * FROM broadcasts WHERE id = ?", (int(broadcast_id),)).fetchone())
+
+    def list(self, statuses=None, limit=20):
+        if statuses:
+            return self.storage.query(
+                f"SELECT * FROM broadcasts WHERE status IN ({', '.join('?' for _ in statuses)}) ORDER BY id DESC LIMIT ?",
+                [*statuses, int(limit)]
+            )
+        return self.storage.query("SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (int(limit),))
+
+class SQLiteStatsRepository(StatsRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def totals(self):
+        return sum_stats_rows(self.storage.query("SELECT * FROM app_stats"))
+
+    def count_playing_users(self, since):
+        row = self.storage.query_one("SELECT COUNT(*) AS count FROM users WHERE last_energy_update >= ?", (int(since),))
+        return row["count"]
+
+    def rebuild(self):
+        with self.storage.transaction() as connection:
+            for statement in REBUILD_STATS.strip().split(";"):
+                if statement.strip():
+                    connection.execute(statement)
+        return self.totals()
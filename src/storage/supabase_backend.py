@@ -0,0 +1,605 @@
+import logging
+import time
+from src.storage.base import (
+    TRANSACTION_COLUMNS, USER_SORT_COLUMNS, BroadcastRepository, MinigameRewardRepository, ReferredUserRepository, StatsRepository, Storage,
+    TransactionRepository, UserRepository, WithdrawalRepository, credit_totals, delta_changes, ledger_totals, new_user_row, referral_credit,
+    referral_record, refund_totals, sum_stats_rows, tap_changes, tap_delta_changes
+)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# How often a compare-and-swap mutation is retried before giving up
+CAS_MAX_ATTEMPTS = 5
+# IDs per `in` filter; keeps the PostgREST query string well under URL limits
+IN_CHUNK_SIZE = 200
+
+def _duplicate_key(error):
+    """
+    Whether an insert failed on a unique index
+    """
+    return "23505" in str(error) or "duplicate key" in str(error)
+
+class SupabaseStorage(Storage):
+    """
+    Storage backed by Supabase (PostgREST). Multi-step mutations use the
+    functions in src/database/supabase.sql and fall back to compare-and-swap
+    updates when they are not installed.
+    """
+    name = "supabase"
+
+    def __init__(self, client):
+        self.client = client
+        # Functions the database reported as not installed; each falls back on its own
+        self._missing_rpcs = set()
+        self.users = SupabaseUserRepository(self)
+        self.withdrawals = SupabaseWithdrawalRepository(self)
+        self.referred_users = SupabaseReferredUserRepository(self)
+        self.minigame_rewards = SupabaseMinigameRewardRepository(self)
+        self.transactions = SupabaseTransactionRepository(self)
+        self.broadcasts = SupabaseBroadcastRepository(self)
+        self.stats = SupabaseStatsRepository(self)
+
+    def table(self, name):
+        return self.client.table(name)
+
+    def rpc(self, name, params):
+        """
+        Call a database function, returning None when it is not installed
+        """
+        if name in self._missing_rpcs:
+            return None
+        try:
+            return self.client.rpc(name, params).execute()
+        except Exception as e:
+            message = str(e)
+            if "PGRST202" in message or "Could not find the function" in message:
+                logger.warning(f"RPC {name} not installed, using compare-and-swap fallback. See src/database/supabase.sql")
+                self._missing_rpcs.add(name)
+                return None
+            raise
+
+class SupabaseUserRepository(UserRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get(self, telegram_id):
+        response = self.storage.table("users").select("*").eq("telegram_id", str(telegram_id)).execute()
+        return response.data[0] if response.data else None
+
+    def get_many(self, telegram_ids):
+        telegram_ids = [str(telegram_id) for telegram_id in telegram_ids]
+        rows = []
+        for start in range(0, len(telegram_ids), IN_CHUNK_SIZE):
+            chunk = telegram_ids[start:start + IN_CHUNK_SIZE]
+            response = self.storage.table("users").select("*").in_("telegram_id", chunk).execute()
+            rows.extend(response.data or [])
+        return rows
+
+    def upsert(self, telegram_id, fields):
+        row = dict(fields, telegram_id=str(telegram_id))
+        row.pop("id", None)
+        # Only the columns in the payload are updated on conflict
+        response = self.storage.table("users").upsert(row, on_conflict="telegram_id").execute()
+        return response.data[0] if response.data else None
+
+    def delete(self, telegram_id):
+        response = self.storage.table("users").delete().eq("telegram_id", str(telegram_id)).execute()
+        return bool(response.data)
+
+    def list(self, columns="*"):
+        response = self.storage.table("users").select(columns).execute()
+        return response.data or []
+
+    def page(self, columns, sort="created", after=None, prefix=None, limit=50):
+        column = USER_SORT_COLUMNS[sort]
+        keyset = None
+        if after is not None:
+            value, last_id = after
+            if value is None:
+                keyset = f"and({column}.is.null,id.lt.{int(last_id)}),{column}.not.is.null"
+            else:
+                keyset = f"{column}.lt.{value},and({column}.eq.{value},id.lt.{int(last_id)})"
+
+        query = self.storage.table("users").select(columns)
+        if prefix:
+            # Callers restrict prefix to [A-Za-z0-9_]; escape the LIKE wildcard
+            pattern = prefix.replace("_", "\\_")
+            search = [f"username.ilike.{pattern}*", f"telegram_id.like.{pattern}*"]
+            if keyset:
+                query = query.or_(",".join(f"and({term},or({keyset}))" for term in search))
+            else:
+                query = query.or_(",".join(search))
+        elif keyset:
+            query = query.or_(keyset)
+
+        # Postgres sorts nulls first in descending order, matching the keyset filter
+        query = query.order(column, desc=True)
+        if column != "id":
+            query = query.order("id", desc=True)
+        response = query.limit(int(limit)).execute()
+        return response.data or []
+
+    def id_page(self, after_id=None, limit=1000):
+        response = self.storage.table("users").select("id, telegram_id").gt("id", int(after_id or 0)).order("id").limit(int(limit)).execute()
+        return response.data or []
+
+    def tap(self, telegram_id, taps, current_time):
+        response = self.storage.rpc("user_tap", {
+            "p_telegram_id": str(telegram_id),
+            "p_taps": int(taps),
+            "p_now": int(current_time)
+        })
+        if response is not None:
+            row = response.data[0] if isinstance(response.data, list) else response.data
+            if not row:
+                return None, 0
+            accepted = int(row.pop("accepted", 0))
+            return row, accepted
+
+        def mutate(row):
+            changes, accepted, energy = tap_changes(row, taps, current_time)
+            return changes, {"accepted": accepted, "energy": energy}
+
+        row, extra = self._compare_and_swap(telegram_id, mutate)
+        if row is None:
+            return None, 0
+        if not extra["accepted"]:
+            # Nothing written, report the regenerated energy
+            row = dict(row, energy=extra["energy"], last_energy_update=int(current_time))
+        return row, extra["accepted"]
+
+    def apply_delta(self, telegram_id, coins=0, min_coins=None, clamp_coins=False, tap_power=0,
+                    max_energy=0, energy_regen_rate=0, expect=None, current_time=None):
+        expect = expect or {}
+        current_time = int(current_time or time.time())
+        response = self.storage.rpc("user_apply_delta", {
+            "p_telegram_id": str(telegram_id),
+            "p_coins": int(coins),
+            "p_min_coins": None if min_coins is None else int(min_coins),
+            "p_clamp_coins": bool(clamp_coins),
+            "p_tap_power": int(tap_power),
+            "p_max_energy": int(max_energy),
+            "p_energy_regen_rate": float(energy_regen_rate),
+            "p_expect": expect,
+            "p_now": int(current_time)
+        })
+        if response is not None:
+            return response.data[0] if response.data else None
+
+        def mutate(row):
+            changes = delta_changes(row, coins, min_coins, clamp_coins, tap_power, max_energy,
+                                    energy_regen_rate, expect, current_time)
+            return None if changes is None else (changes, {})
+
+        row, _ = self._compare_and_swap(telegram_id, mutate, guard_fields=expect.keys())
+        return row
+
+    def apply_tap_deltas(self, deltas, current_time):
+        response = self.storage.rpc("user_apply_tap_deltas", {"p_deltas": deltas, "p_now": int(current_time)})
+        if response is not None:
+            return response.data or [], []
+
+        rows = []
+        failed = []
+        for delta in deltas:
+            try:
+                row, _ = self._compare_and_swap(
+                    delta["telegram_id"], lambda row, delta=delta: (tap_delta_changes(row, delta, current_time), {})
+                )
+                if row is not None:
+                    rows.append(row)
+            except Exception as e:
+                logger.error(f"Error applying tap delta for {delta['telegram_id']}: {str(e)}")
+                failed.append(delta)
+        return rows, failed
+
+    def apply_referral(self, referrer_id, telegram_id, new_user, referee_bonus, referrer_bonus, current_time):
+        referrer_id = str(referrer_id)
+        response = self.storage.rpc("apply_referral", {
+            "p_referrer_id": referrer_id,
+            "p_telegram_id": str(telegram_id),
+            "p_new_user": new_user_row(new_user, telegram_id, current_time),
+            "p_referee_bonus": int(referee_bonus),
+            "p_referrer_bonus": int(referrer_bonus),
+            "p_now": int(current_time)
+        })
+        if response is not None:
+            result = response.data[0] if isinstance(response.data, list) else response.data
+            return result["status"], result.get("user"), result.get("referrer")
+
+        # Fallback: the referred_users insert is the claim (unique per referee),
+        # so only one caller goes on to credit the bonuses
+        referrer = self.get(referrer_id)
+        if referrer is None:
+            return "invalid_referrer", None, None
+        user = self.get(telegram_id)
+        if user is None:
+            try:
+                self.storage.table("users").insert(new_user_row(new_user, telegram_id, current_time)).execute()
+            except Exception as e:
+                logger.info(f"User {telegram_id} created concurrently: {str(e)}")
+            user = self.get(telegram_id)
+        if user.get("referred_by"):
+            status = "duplicate" if str(user["referred_by"]) == referrer_id else "already_referred"
+            return status, user, referrer
+
+        try:
+            self.storage.table("referred_users").insert(referral_record(referrer_id, user, referrer_bonus, current_time)).execute()
+        except Exception as e:
+            if _duplicate_key(e):
+                return "duplicate", user, referrer
+            raise
+
+        def credit_referee(row):
+            if row.get("referred_by"):
+                return None
+            return {"referred_by": referrer_id, "coins": int(row.get("coins") or 0) + int(referee_bonus)}, {}
+
+        credited, _ = self._compare_and_swap(telegram_id, credit_referee, guard_fields=("referred_by",))
+        if credited is None:
+            return "duplicate", self.get(telegram_id), referrer
+        self.storage.table("referral_credits").insert(referral_credit(referrer_id, referrer_bonus, current_time)).execute()
+        return "applied", credited, referrer
+
+    def merge_referral_credits(self, referrer_id=None, limit=None):
+        response = self.storage.rpc("merge_referral_credits", {
+            "p_referrer_id": None if referrer_id is None else str(referrer_id),
+            "p_limit": limit
+        })
+        if response is not None:
+            result = response.data[0] if isinstance(response.data, list) else response.data
+            return result.get("users") or [], int(result.get("merged") or 0)
+
+        # Fallback: delete a batch first (the rows a delete returns belong to
+        # this merge alone), then credit each referrer; failed credits are
+        # written back as one combined row
+        query = self.storage.table("referral_credits").select("id")
+        if referrer_id is not None:
+            query = query.eq("referrer_id", str(referrer_id))
+        query = query.order("id")
+        if limit is not None:
+            query = query.limit(int(limit))
+        credit_ids = [credit["id"] for credit in query.execute().data or []]
+        credits = []
+        for start in range(0, len(credit_ids), IN_CHUNK_SIZE):
+            chunk = credit_ids[start:start + IN_CHUNK_SIZE]
+            credits.extend(self.storage.table("referral_credits").delete().in_("id", chunk).execute().data or [])
+
+        rows = []
+        for telegram_id, total in credit_totals(credits).items():
+            def credit(row, total=total):
+                return {field: int(row.get(field) or 0) + amount for field, amount in total.items()}, {}
+            try:
+                row, _ = self._compare_and_swap(telegram_id, credit)
+                if row is not None:
+                    rows.append(row)
+            except Exception as e:
+                logger.error(f"Error merging referral credits for {telegram_id}: {str(e)}")
+                self.storage.table("referral_credits").insert(dict(total, referrer_id=telegram_id, created_at=int(time.time()))).execute()
+        return rows, len(credits)
+
+    def _compare_and_swap(self, telegram_id, mutate, guard_fields=()):
+        """
+        Fallback for the mutation RPCs: read the row, compute the change and
+        update only if the fields involved still hold the values that were read.
+        `mutate(row)` returns (changes, extra) or None when a guard fails.
+        """
+        for attempt in range(CAS_MAX_ATTEMPTS):
+            row = self.get(telegram_id)
+            if row is None:
+                return None, None
+
+            result = mutate(row)
+            if result is None:
+                return None, None
+            changes, extra = result
+            if not changes:
+                return row, extra
+
+            query = self.storage.table("users").update(changes).eq("id", row["id"])
+            for field in set(changes) | set(guard_fields):
+                if row.get(field) is None:
+                    query = query.is_(field, "null")
+                else:
+                    query = query.eq(field, row[field])
+            update_response = query.execute()
+            if update_response.data:
+                return update_response.data[0], extra
+            logger.info(f"Concurrent update on user {telegram_id}, retrying ({attempt + 1}/{CAS_MAX_ATTEMPTS})")
+
+        raise RuntimeError(f"Could not update user {telegram_id} due to concurrent updates")
+
+class SupabaseWithdrawalRepository(WithdrawalRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def insert(self, row):
+        # Older tables lack the fee/final_amount/inr_amount columns, so retry
+        # with fewer fields before giving up
+        attempts = [
+            row,
+            {key: value for key, value in row.items() if key != "fee"},
+            {key: value for key, value in row.items() if key in ("user_id", "amount", "upi_id", "status", "created_at")}
+        ]
+        error = None
+        for withdrawal_data in attempts:
+            try:
+                response = self.storage.table("withdrawals").insert(withdrawal_data).execute()
+                if response.data:
+                    return response.data[0]
+                logger.warning(f"Withdrawal insert returned no data, retrying with fewer fields: {withdrawal_data}")
+            except Exception as e:
+                # Fewer fields would drop the idempotency key, not fix the conflict
+                if _duplicate_key(e):
+                    raise
+                logger.error(f"Error creating withdrawal record: {str(e)}")
+                error = e
+        raise RuntimeError(f"Could not create withdrawal record: {error}")
+
+    def create(self, telegram_id, amount, row, idempotency_key=None):
+        telegram_id = str(telegram_id)
+        response = self.storage.rpc("create_withdrawal", {
+            "p_telegram_id": telegram_id,
+            "p_amount": int(amount),
+            "p_row": row,
+            "p_idempotency_key": idempotency_key
+        })
+        if response is not None:
+            result = response.data[0] if isinstance(response.data, list) else response.data
+            return result["status"], result.get("withdrawal"), result.get("user")
+
+        # Fallback: debit with a conditional update, then insert the record;
+        # a failed insert (including losing a race on the idempotency key) is
+        # refunded, so coins never leave without a withdrawal row
+        if idempotency_key is not None:
+            replayed = self._by_idempotency_key(telegram_id, idempotency_key)
+            if replayed is not None:
+                return "replayed", replayed, self.storage.users.get(telegram_id)
+        user = self.storage.users.apply_delta(telegram_id, coins=-int(amount), min_coins=int(amount))
+        if user is None:
+            user = self.storage.users.get(telegram_id)
+            return ("insufficient_funds" if user else "user_not_found"), None, user
+        record = dict(row, user_id=telegram_id, amount=int(amount))
+        if idempotency_key is not None:
+            record["idempotency_key"] = idempotency_key
+        try:
+            withdrawal = self.insert(record)
+        except Exception as e:
+            user = self.storage.users.apply_delta(telegram_id, coins=int(amount))
+            if idempotency_key is not None and _duplicate_key(e):
+                return "replayed", self._by_idempotency_key(telegram_id, idempotency_key), user
+            raise
+        return "created", withdrawal, user
+
+    def _by_idempotency_key(self, telegram_id, idempotency_key):
+        response = self.storage.table("withdrawals").select("*").eq("user_id", telegram_id).eq("idempotency_key", idempotency_key).execute()
+        return response.data[0] if response.data else None
+
+    def get(self, withdrawal_id):
+        response = self.storage.table("withdrawals").select("*").eq("id", withdrawal_id).execute()
+        return response.data[0] if response.data else None
+
+    def update_status(self, withdrawal_id, status):
+        response = self.storage.table("withdrawals").update({"status": status}).eq("id", withdrawal_id).execute()
+        return response.data[0] if response.data else None
+
+    def list_by_user(self, telegram_id):
+        response = self.storage.table("withdrawals").select("*").eq("user_id", str(telegram_id)).order("created_at", desc=True).execute()
+        return response.data or []
+
+    def list(self):
+        response = self.storage.table("withdrawals").select("*").order("created_at", desc=True).execute()
+        return response.data or []
+
+    def page(self, status=None, after=None, limit=50, descending=False, exclude_status=None, user_id=None):
+        query = self.storage.table("withdrawals").select("*")
+        if user_id is not None:
+            query = query.eq("user_id", str(user_id))
+        if status:
+            query = query.eq("status", status)
+        if exclude_status:
+            query = query.neq("status", exclude_status)
+        if after is not None:
+            created_at, last_id = after
+            operator = "lt" if descending else "gt"
+            query = query.or_(
+                f'created_at.{operator}."{created_at}",and(created_at.eq."{created_at}",id.{operator}.{int(last_id)})'
+            )
+        response = query.order("created_at", desc=descending).order("id", desc=descending).limit(int(limit)).execute()
+        return response.data or []
+
+    def review(self, withdrawal_ids, status, refund=False):
+        withdrawal_ids = [int(withdrawal_id) for withdrawal_id in withdrawal_ids]
+        response = self.storage.rpc("review_withdrawals", {
+            "p_ids": withdrawal_ids,
+            "p_status": status,
+            "p_refund": bool(refund)
+        })
+        if response is not None:
+            return response.data or []
+
+        # Fallback: each chunk is one conditional update, so a withdrawal is
+        # only ever reviewed once; refunds follow as one credit per user
+        rows = []
+        for start in range(0, len(withdrawal_ids), IN_CHUNK_SIZE):
+            chunk = withdrawal_ids[start:start + IN_CHUNK_SIZE]
+            update_response = self.storage.table("withdrawals").update({"status": status}).in_("id", chunk).eq("status", "pending").execute()
+            rows.extend(update_response.data or [])
+        if refund:
+            for user_id, amount in refund_totals(rows).items():
+                try:
+                    self.storage.users.apply_delta(user_id, coins=amount)
+                except Exception as e:
+                    logger.error(f"Error refunding {amount} coins to {user_id}: {str(e)}")
+        return rows
+
+class SupabaseReferredUserRepository(ReferredUserRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def insert(self, row):
+        response = self.storage.table("referred_users").insert(row).execute()
+        return response.data[0] if response.data else None
+
+    def list_by_referrer(self, referrer_id):
+        response = self.storage.table("referred_users").select("*").eq("referrer_id", str(referrer_id)).execute()
+        return response.data or []
+
+    def page(self, referrer_id, after_id=None, limit=50):
+        query = self.storage.table("referred_users").select("*").eq("referrer_id", str(referrer_id))
+        if after_id is not None:
+            query = query.lt("id", int(after_id))
+        response = query.order("id", desc=True).limit(int(limit)).execute()
+        return response.data or []
+
+class SupabaseMinigameRewardRepository(MinigameRewardRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def insert(self, row):
+        response = self.storage.table("minigame_rewards").insert(row).execute()
+        return response.data[0] if response.data else None
+
+    def insert_many(self, rows):
+        if rows:
+            self.storage.table("minigame_rewards").insert(rows).execute()
+
+class SupabaseTransactionRepository(TransactionRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def append(self, rows):
+        if not rows:
+            return 0
+        rows = [{column: row.get(column) for column in TRANSACTION_COLUMNS} for row in rows]
+        response = self.storage.rpc("append_transactions", {"p_rows": rows})
+        if response is not None:
+            return int(response.data or 0)
+
+        # Fallback: one multi-row insert, then each user's balance row is
+        # advanced with a compare-and-swap on its entry count
+        inserted = self.storage.table("transactions").insert(rows).execute().data or []
+        for user_id, total in ledger_totals(inserted).items():
+            try:
+                self._advance_balance(user_id, total)
+            except Exception as e:
+                # The entries are stored; the snapshot can be rebuilt from them
+                logger.error(f"Error updating ledger balance for {user_id}: {str(e)}")
+        return len(inserted)
+
+    def _advance_balance(self, user_id, total):
+        for attempt in range(CAS_MAX_ATTEMPTS):
+            current = self.balance(user_id)
+            if current is None:
+                try:
+                    self.storage.table("ledger_balances").insert(dict(total, user_id=user_id)).execute()
+                    return
+                except Exception as e:
+                    if not _duplicate_key(e):
+                        raise
+                    continue
+            update_response = self.storage.table("ledger_balances").update({
+                "balance": int(current["balance"]) + total["balance"],
+                "entries": int(current["entries"]) + total["entries"],
+                "last_transaction_id": max(int(current["last_transaction_id"] or 0), total["last_transaction_id"]),
+                "updated_at": max(int(current["updated_at"]), total["updated_at"])
+            }).eq("user_id", user_id).eq("entries", current["entries"]).execute()
+            if update_response.data:
+                return
+            logger.info(f"Concurrent ledger update for {user_id}, retrying ({attempt + 1}/{CAS_MAX_ATTEMPTS})")
+        raise RuntimeError(f"Could not update ledger balance for {user_id} due to concurrent updates")
+
+    def page(self, user_id, after_id=None, limit=50):
+        query = self.storage.table("transactions").select("*").eq("user_id", str(user_id))
+        if after_id is not None:
+            query = query.lt("id", int(after_id))
+        response = query.order("id", desc=True).limit(int(limit)).execute()
+        return response.data or []
+
+    def balance(self, user_id):
+        response = self.storage.table("ledger_balances").select("*").eq("user_id", str(user_id)).execute()
+        return response.data[0] if response.data else None
+
+class SupabaseBroadcastRepository(BroadcastRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def insert(self, row):
+        response = self.storage.table("broadcasts").insert(row).execute()
+        return response.data[0] if response.data else None
+
+    def get(self, broadcast_id):
+        response = self.storage.table("broadcasts").select("*").eq("id", int(broadcast_id)).execute()
+        return response.data[0] if response.data else None
+
+    def update(self, broadcast_id, fields, status=None, owner=None):
+        query = self.storage.table("broadcasts").update(fields).eq("id", int(broadcast_id))
+        if status is not None:
+            query = query.eq("status", status)
+        if owner is not None:
+            query = query.eq("owner", owner)
+        response = query.execute()
+        return response.data[0] if response.data else None
+
+    def claim(self, broadcast_id, owner, lease_until, current_time):
+        response = self.storage.table("broadcasts").update({
+            "owner": owner,
+            "lease_until": int(lease_until)
+        }).eq("id", int(broadcast_id)).eq("status", "running").or_(
+            f"owner.is.null,owner.eq.{owner},lease_until.lt.{int(current_time)}"
+        ).execute()
+        return response.data[0] if response.data else None
+
+    def list(self, statuses=None, limit=20):
+        query = self.storage.table("broadcasts").select("*")
+        if statuses:
+            query = query.in_("status", list(statuses))
+        response = query.order("id", desc=True).limit(int(limit)).execute()
+        return response.data or []
+
+class SupabaseStatsRepository(StatsRepository):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def totals(self):
+        try:
+            response = self.storage.table("app_stats").select("*").execute()
+        except Exception as e:
+            if "app_stats" not in str(e):
+                raise
+            logger.warning("app_stats table not installed, scanning users and withdrawals. See src/database/supabase.sql")
+            return self._scan()
+        return sum_stats_rows(response.data or [])
+
+    def count_playing_users(self, since):
+        response = self.storage.table("users").select("id", count="exact", head=True).gte("last_energy_update", int(since)).execute()
+        return response.count or 0
+
+    def rebuild(self):
+        self.storage.client.rpc("rebuild_app_stats", {}).execute()
+        return self.totals()
+
+    def _scan(self):
+        """
+        Counters computed from the base tables, for databases without app_stats
+        """
+        users = self.storage.table("users").select("coins").execute().data or []
+        withdrawals = self.storage.table("withdrawals").select("amount, status").execute().data or []
+        completed = [withdrawal for withdrawal in withdrawals if withdrawal.get("status") == "completed"]
+        return {
+            "total_users": len(users),
+            "total_coins": sum(user.get("coins") or 0 for user in users),
+            "total_withdrawals": len(withdrawals),
+            "pending_withdrawals": sum(1 for withdrawal in withdrawals if withdrawal.get("status") == "pending"),
+            "completed_withdrawals": len(completed),
+            "total_withdrawn": sum(withdrawal.get("amount") or 0 for withdrawal in completed)
+        }
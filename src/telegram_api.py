@@ -0,0 +1,398 @@
+from requests.adapters import HTTPAdapter
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import requests
+import threading
+import time
+from collections import deque
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+# Seconds to wait for Telegram to answer a call
+TELEGRAM_TIMEOUT = float(os.environ.get("TELEGRAM_TIMEOUT", 10))
+# Attempts per call on 429s, 5xx responses and connection errors
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", 3))
+# Threads sending queued messages
+TELEGRAM_SEND_WORKERS = int(os.environ.get("TELEGRAM_SEND_WORKERS", 8))
+# Telegram allows about 30 messages per second overall, one per second to a
+# private chat and 20 per minute to a group
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_INTERVAL = float(os.environ.get("TELEGRAM_CHAT_INTERVAL", 1))
+TELEGRAM_GROUP_INTERVAL = float(os.environ.get("TELEGRAM_GROUP_INTERVAL", 3))
+# Messages waiting to be sent beyond which enqueue() refuses more
+TELEGRAM_MAX_QUEUE = int(os.environ.get("TELEGRAM_MAX_QUEUE", 100000))
+
+class TelegramError(Exception):
+    """
+    A Bot API call that Telegram rejected or that could not be completed
+    """
+
+    def __init__(self, description, error_code=None, retry_after=None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.retry_after = retry_after
+
+class TelegramAPI:
+    """
+    Bot API client over one keep-alive session, so calls reuse pooled
+    connections instead of opening a TLS connection each. Calls time out, and
+    are retried on 429s (after Telegram's retry_after), 5xx responses and
+    connection errors.
+    """
+
+    def __init__(self, token, api_url=TELEGRAM_API_URL, timeout=TELEGRAM_TIMEOUT,
+                 max_retries=TELEGRAM_MAX_RETRIES, pool_size=TELEGRAM_SEND_WORKERS):
+        self.base_url = f"{api_url}/bot{token}"
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def call_once(self, method, data=None, files=None, timeout=None):
+        """
+        Make one Bot API call and return its result. Raises TelegramError with
+        retry_after set when Telegram asks us to slow down.
+        """
+        response = self.session.post(f"{self.base_url}/{method}", data=data, files=files, timeout=timeout or self.timeout)
+        try:
+            body = response.json()
+        except ValueError:
+            raise TelegramError(f"{method} returned HTTP {response.status_code}", response.status_code)
+        if not body.get("ok"):
+            retry_after = (body.get("parameters") or {}).get("retry_after")
+            raise TelegramError(body.get("description", f"{method} failed"), body.get("error_code", response.status_code), retry_after)
+        return body.get("result")
+
+    def call(self, method, data=None, files=None, timeout=None):
+        """
+        Make a Bot API call, retrying transient failures
+        """
+        for attempt in range(self.max_retries):
+            last_attempt = attempt + 1 == self.max_retries
+            try:
+                return self.call_once(method, data, files, timeout)
+            except TelegramError as e:
+                if last_attempt or not _retryable(e):
+                    raise
+                time.sleep(e.retry_after or 2 ** attempt)
+            except requests.RequestException as e:
+                if last_attempt:
+                    raise TelegramError(f"{method} failed: {str(e)}")
+                time.sleep(2 ** attempt)
+
+def _retryable(error):
+    return error.retry_after is not None or (error.error_code or 0) >= 500
+
+class OutboundMessage:
+    """
+    A queued Bot API call. wait() blocks until it has been sent.
+    """
+
+    def __init__(self, method, data, files=None, chat_id=None, bulk=False, global_pace=True):
+        self.method = method
+        self.data = data
+        self.files = files
+        self.chat_id = chat_id
+        self.bulk = bulk
+        self.global_pace = global_pace
+        self.lane = chat_id
+        self.queued_at = time.time()
+        self.attempts = 0
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        The call's result once sent; raises the error if it failed
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"{self.method} not sent within {timeout} seconds")
+        if self.error:
+            raise self.error
+        return self.result
+
+class OutboundQueue:
+    """
+    Sends Bot API calls from worker threads, off the request path, within
+    Telegram's rate limits: a global pace of `global_rate` calls per second,
+    and one message per `chat_interval` seconds to each chat (`group_interval`
+    for groups). Messages to a chat go out in the order they were queued.
+    A 429 holds every send, not just the chat's, for Telegram's retry_after:
+    its flood limits are per bot, and the response does not say which one
+    was hit.
+
+    Bulk messages (broadcasts) share the global pace and flood waits but only
+    go out when no other message can, so replies are never held behind them.
+    """
+
+    def __init__(self, api, workers=TELEGRAM_SEND_WORKERS, global_rate=TELEGRAM_GLOBAL_RATE,
+                 chat_interval=TELEGRAM_CHAT_INTERVAL, group_interval=TELEGRAM_GROUP_INTERVAL,
+                 max_queue=TELEGRAM_MAX_QUEUE, max_retries=TELEGRAM_MAX_RETRIES):
+        self.api = api
+        self.workers = workers
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self._lanes = {}
+        # Chats with queued messages and nothing in flight, as (ready_at, seq, chat_id)
+        self._ready = []
+        # The same for bulk messages, which have lanes of their own
+        self._bulk_ready = []
+        self._seq = itertools.count()
+        self._next_send_at = 0.0
+        self._paused_until = 0.0
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._threads = []
+        self._stopped = False
+
+        # Metrics
+        self._in_flight = 0
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+        self._rate_limited = 0
+        self._send_time_total = 0.0
+        self._send_time_max = 0.0
+        self._wait_time_total = 0.0
+        self._last_error = None
+
+    def enqueue(self, method, data, files=None, chat_id=None, bulk=False, global_pace=True):
+        """
+        Queue a Bot API call. Calls with a chat_id are paced per chat; others
+        (such as answerCallbackQuery) only by the global rate. `bulk` calls
+        are sent after everything else; `global_pace=False` is for paid
+        broadcasts, which Telegram does not hold to the global rate.
+        """
+        message = OutboundMessage(method, data, files, chat_id, bulk, global_pace)
+        with self._changed:
+            if self._stopped:
+                raise TelegramError("Outbound queue is stopped")
+            if self._queued >= self.max_queue:
+                raise TelegramError(f"Outbound queue is full ({self._queued} messages)")
+            # Unpaced calls each get a lane of their own, so they never wait on each other
+            message.lane = chat_id if chat_id is not None else ("unpaced", next(self._seq))
+            if bulk:
+                message.lane = ("bulk", message.lane)
+            lane = self._lanes.get(message.lane)
+            if lane is None:
+                lane = self._lanes[message.lane] = {"messages": deque(), "busy": False, "ready_at": 0.0}
+            lane["messages"].append(message)
+            self._queued += 1
+            if len(lane["messages"]) == 1 and not lane["busy"]:
+                heapq.heappush(self._ready_heap(message), (lane["ready_at"], next(self._seq), message.lane))
+            self._changed.notify()
+        self._ensure_started()
+        return message
+
+    def _ready_heap(self, message):
+        return self._bulk_ready if message.bulk else self._ready
+
+    def _interval(self, chat_id):
+        if chat_id is None:
+            return 0.0
+        # Group and channel ids are negative, or @usernames for channels
+        return self.group_interval if str(chat_id).startswith(("-", "@")) else self.chat_interval
+
+    def _take(self):
+        """
+        Wait for the next message allowed out, and claim its chat
+        """
+        with self._changed:
+            while True:
+                if self._stopped and not self._queued:
+                    return None
+                now = time.time()
+                next_at = now + 1.0
+                # Bulk messages only when no other message can go now
+                for ready in (self._ready, self._bulk_ready):
+                    if not ready:
+                        continue
+                    ready_at, _, lane_key = ready[0]
+                    lane = self._lanes[lane_key]
+                    send_at = max(ready_at, self._paused_until)
+                    if lane["messages"][0].global_pace:
+                        send_at = max(send_at, self._next_send_at)
+                    if send_at <= now:
+                        heapq.heappop(ready)
+                        lane["busy"] = True
+                        self._queued -= 1
+                        self._in_flight += 1
+                        message = lane["messages"].popleft()
+                        if message.global_pace:
+                            self._next_send_at = max(now, self._next_send_at) + self.global_interval
+                        return message
+                    next_at = min(next_at, send_at)
+                self._changed.wait(next_at - now)
+
+    def _done(self, message, retry_after=None):
+        """
+        Release the message's chat; a rate-limited message goes back to the
+        front of its chat's queue
+        """
+        with self._changed:
+            self._in_flight -= 1
+            lane = self._lanes[message.lane]
+            lane["busy"] = False
+            now = time.time()
+            lane["ready_at"] = now + self._interval(message.chat_id)
+            if retry_after is not None:
+                lane["messages"].appendleft(message)
+                self._queued += 1
+                lane["ready_at"] = now + retry_after
+            if lane["messages"]:
+                heapq.heappush(self._ready_heap(message), (lane["ready_at"], next(self._seq), message.lane))
+            elif lane["ready_at"] <= now:
+                del self._lanes[message.lane]
+            else:
+                # Keep the chat's pacing until it has passed; idle chats are pruned once there are many
+                self._prune(now)
+            self._changed.notify_all()
+
+    def _prune(self, now):
+        if len(self._lanes) < 10000:
+            return
+        for lane_key in [lane_key for lane_key, lane in self._lanes.items()
+                         if not lane["messages"] and not lane["busy"] and lane["ready_at"] <= now]:
+            del self._lanes[lane_key]
+
+    def _send(self, message):
+        message.attempts += 1
+        started = time.time()
+        try:
+            result = self.api.call_once(message.method, message.data, message.files)
+        except TelegramError as e:
+            if e.retry_after is not None:
+                self._rate_limited += 1
+                if message.attempts < self.max_retries:
+                    self._retries += 1
+                    with self._lock:
+                        self._paused_until = max(self._paused_until, time.time() + e.retry_after)
+                    logger.warning(f"Telegram rate limited {message.method}, retrying in {e.retry_after}s")
+                    return e.retry_after
+            elif _retryable(e) and message.attempts < self.max_retries:
+                self._retries += 1
+                return 2 ** (message.attempts - 1)
+            self._fail(message, e)
+            return None
+        except requests.RequestException as e:
+            if message.attempts < self.max_retries:
+                self._retries += 1
+                return 2 ** (message.attempts - 1)
+            self._fail(message, TelegramError(f"{message.method} failed: {str(e)}"))
+            return None
+        finally:
+            elapsed = time.time() - started
+            self._send_time_total += elapsed
+            self._send_time_max = max(self._send_time_max, elapsed)
+
+        self._sent += 1
+        self._wait_time_total += started - message.queued_at
+        message.finish(result)
+        return None
+
+    def _fail(self, message, error):
+        self._failed += 1
+        self._last_error = str(error)
+        # Bulk senders report their own failures (many are users who blocked the bot)
+        if not message.bulk:
+            logger.error(f"Error sending {message.method} to {message.chat_id}: {str(error)}")
+        message.finish(error=error)
+
+    def _run(self):
+        while True:
+            message = self._take()
+            if message is None:
+                return
+            retry_after = None
+            try:
+                retry_after = self._send(message)
+            except Exception as e:
+                self._fail(message, e)
+            finally:
+                self._done(message, retry_after)
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads or self._stopped:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"telegram-sender-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        atexit.register(self.stop)
+
+    def stop(self, timeout=10):
+        """
+        Send what is queued, up to `timeout` seconds, and stop the workers
+        """
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.time()))
+        if self._queued:
+            logger.error(f"{self._queued} Telegram messages not sent on shutdown")
+
+    def metrics(self):
+        """
+        Queue depth, throughput and send latency
+        """
+        with self._lock:
+            queued = self._queued
+            in_flight = self._in_flight
+            chats = len(self._lanes)
+        attempts = self._sent + self._failed + self._retries
+        return {
+            "queued": queued,
+            "in_flight": in_flight,
+            "chats": chats,
+            "workers": self.workers,
+            "sent": self._sent,
+            "failed": self._failed,
+            "retries": self._retries,
+            "rate_limited": self._rate_limited,
+            "paused_for_seconds": round(max(0.0, self._paused_until - time.time()), 1),
+            "avg_send_seconds": round(self._send_time_total / attempts, 4) if attempts else 0,
+            "max_send_seconds": round(self._send_time_max, 4),
+            "avg_queue_wait_seconds": round(self._wait_time_total / self._sent, 4) if self._sent else 0,
+            "last_error": self._last_error
+        }
+
+# One client and queue per bot token, shared by every TelegramBot
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+def outbox_for(token):
+    """
+    The shared outbound queue for a bot token
+    """
+    with _outboxes_lock:
+        if token not in _outboxes:
+            _outboxes[token] = OutboundQueue(TelegramAPI(token))
+        return _outboxes[token]
+
+def outbox_metrics():
+    with _outboxes_lock:
+        outboxes = list(_outboxes.values())
+    return [outbox.metrics() for outbox in outboxes]
@@ -0,0 +1,167 @@
+from src.bot import bot, update_dispatcher
+from src.telegram_api import TelegramError
+import json
+import logging
+import os
+import requests
+import signal
+import threading
+import time
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds Telegram holds a getUpdates call open waiting for updates
+TELEGRAM_POLL_TIMEOUT = int(os.environ.get("TELEGRAM_POLL_TIMEOUT", 25))
+# Updates fetched per call; Telegram returns at most 100
+TELEGRAM_POLL_LIMIT = min(int(os.environ.get("TELEGRAM_POLL_LIMIT", 100)), 100)
+# File the next offset is kept in, so a restart neither skips nor replays updates
+TELEGRAM_OFFSET_PATH = os.environ.get(
+    "TELEGRAM_OFFSET_PATH",
+    os.path.join(os.path.dirname(__file__), "database", "telegram_offset.json")
+)
+# Remove a registered webhook before polling (Telegram refuses getUpdates while one is set)
+TELEGRAM_DELETE_WEBHOOK = os.environ.get("TELEGRAM_DELETE_WEBHOOK", "false").lower() == "true"
+# Longest wait between attempts after errors
+TELEGRAM_POLL_MAX_BACKOFF = float(os.environ.get("TELEGRAM_POLL_MAX_BACKOFF", 30))
+
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+class OffsetFile:
+    """
+    The next update_id to ask Telegram for, kept in a JSON file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as offset_file:
+                return int(json.load(offset_file)["offset"])
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Ignoring unreadable offset file {self.path}: {str(e)}")
+            return None
+
+    def save(self, offset):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Written aside and renamed, so a crash never leaves a partial file
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as offset_file:
+            json.dump({"offset": offset, "updated_at": int(time.time())}, offset_file)
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(temporary_path, self.path)
+
+class UpdatePoller:
+    """
+    Long-polls getUpdates and feeds the updates to the same dispatcher and
+    handlers as the webhook, for local runs, staging and webhook outages.
+    Each batch of up to `limit` updates is handled concurrently (in order
+    per chat) and the offset is saved once the whole batch is done; the next
+    getUpdates call confirms it to Telegram. After a crash the unfinished
+    batch is fetched again, so updates are handled at least once.
+    """
+
+    def __init__(self, api, dispatcher, offsets, limit=TELEGRAM_POLL_LIMIT, timeout=TELEGRAM_POLL_TIMEOUT,
+                 max_backoff=TELEGRAM_POLL_MAX_BACKOFF):
+        self.api = api
+        self.dispatcher = dispatcher
+        self.offsets = offsets
+        self.limit = limit
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.offset = offsets.load()
+        self._stopped = threading.Event()
+
+        # Metrics
+        self.polls = 0
+        self.updates = 0
+        self.errors = 0
+
+    def poll_once(self):
+        """
+        Fetch one batch, handle it and save the offset. Returns the number of updates.
+        """
+        params = {"limit": self.limit, "timeout": self.timeout, "allowed_updates": json.dumps(ALLOWED_UPDATES)}
+        if self.offset is not None:
+            params["offset"] = self.offset
+        # The HTTP timeout has to outlast Telegram holding the call open
+        updates = self.api.call_once("getUpdates", params, timeout=self.timeout + 10) or []
+        self.polls += 1
+        if not updates:
+            return 0
+
+        for update in updates:
+            while self.dispatcher.submit(update) == "full":
+                self.dispatcher.drain(1)
+        self.dispatcher.drain()
+
+        self.offset = max(update["update_id"] for update in updates) + 1
+        self.offsets.save(self.offset)
+        self.updates += len(updates)
+        return len(updates)
+
+    def run(self):
+        """
+        Poll until stop() is called, backing off after errors
+        """
+        logger.info(f"Polling for updates from offset {self.offset}")
+        backoff = 1.0
+        while not self._stopped.is_set():
+            try:
+                self.poll_once()
+                backoff = 1.0
+            except TelegramError as e:
+                self.errors += 1
+                if e.error_code == 409:
+                    logger.error(f"getUpdates conflict, is a webhook set or another poller running? {str(e)}")
+                else:
+                    logger.error(f"Error polling for updates: {str(e)}")
+                self._stopped.wait(e.retry_after or backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            except requests.RequestException as e:
+                self.errors += 1
+                logger.error(f"Error polling for updates: {str(e)}")
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            except Exception as e:
+                # Anything else (saving the offset, a malformed update) must not end the loop
+                self.errors += 1
+                logger.exception(f"Unexpected error polling for updates: {str(e)}")
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        logger.info(f"Stopped polling at offset {self.offset}")
+
+    def stop(self, *args):
+        self._stopped.set()
+
+    def metrics(self):
+        return {
+            "offset": self.offset,
+            "polls": self.polls,
+            "updates": self.updates,
+            "errors": self.errors,
+            "dispatcher": self.dispatcher.metrics()
+        }
+
+def main():
+    """
+    Run the bot with long polling: python -m src.telegram_polling
+    (set TELEGRAM_API_URL to use a local Bot API server)
+    """
+    if TELEGRAM_DELETE_WEBHOOK:
+        bot.api.call("deleteWebhook")
+        logger.info("Deleted webhook")
+    poller = UpdatePoller(bot.api, update_dispatcher, OffsetFile(TELEGRAM_OFFSET_PATH))
+    signal.signal(signal.SIGINT, poller.stop)
+    signal.signal(signal.SIGTERM, poller.stop)
+    poller.run()
+    update_dispatcher.stop()
+    bot.outbox.stop()
+
+if __name__ == "__main__":
+    main()
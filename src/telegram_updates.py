@@ -0,0 +1,220 @@
+from collections import OrderedDict, deque
+import atexit
+import logging
+import os
+import threading
+import time
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Threads running update handlers
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 8))
+# Updates waiting for a worker beyond which new ones are refused (Telegram redelivers them)
+UPDATE_MAX_QUEUE = int(os.environ.get("UPDATE_MAX_QUEUE", 10000))
+# Recent update_ids remembered to drop redeliveries
+UPDATE_RECENT_IDS = int(os.environ.get("UPDATE_RECENT_IDS", 10000))
+
+def update_chat_id(update):
+    """
+    The chat an update belongs to, which orders its handling. Updates
+    without a chat fall back to the sender, then to their own id.
+    """
+    for kind in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if kind in update:
+            return update[kind].get("chat", {}).get("id")
+    callback_query = update.get("callback_query")
+    if callback_query:
+        message = callback_query.get("message") or {}
+        if message.get("chat"):
+            return message["chat"]["id"]
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return ("update", update.get("update_id"))
+
+class RecentIds:
+    """
+    Bounded set of the most recently added ids
+    """
+
+    def __init__(self, size=UPDATE_RECENT_IDS):
+        self.size = size
+        self._ids = OrderedDict()
+
+    def __contains__(self, value):
+        return value in self._ids
+
+    def add(self, value):
+        self._ids[value] = None
+        self._ids.move_to_end(value)
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+
+class UpdateDispatcher:
+    """
+    Runs `handler(update)` for incoming Telegram updates on a pool of worker
+    threads, so the webhook (or poller) that received them can return at
+    once. Updates for one chat are handled one at a time, in the order they
+    arrived; different chats are handled in parallel. Updates whose
+    update_id was seen recently are dropped, so redeliveries are handled once.
+    """
+
+    def __init__(self, handler, workers=UPDATE_WORKERS, max_queue=UPDATE_MAX_QUEUE, recent_ids=UPDATE_RECENT_IDS):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self._recent = RecentIds(recent_ids)
+        # Updates per chat; a chat is in _ready while it has updates and no worker
+        self._lanes = {}
+        self._ready = deque()
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._threads = []
+        self._stopped = False
+
+        # Metrics
+        self._in_flight = 0
+        self._received = 0
+        self._duplicates = 0
+        self._rejected = 0
+        self._handled = 0
+        self._failed = 0
+        self._handle_time_total = 0.0
+        self._handle_time_max = 0.0
+        self._last_error = None
+
+    def submit(self, update):
+        """
+        Queue an update for its chat. Returns "queued", "duplicate", or
+        "full" when the queue has no room (the update is not marked seen).
+        """
+        update_id = update.get("update_id")
+        chat_id = update_chat_id(update)
+        with self._changed:
+            self._received += 1
+            if update_id is not None and update_id in self._recent:
+                self._duplicates += 1
+                return "duplicate"
+            if self._stopped or self._queued >= self.max_queue:
+                self._rejected += 1
+                return "full"
+            if update_id is not None:
+                self._recent.add(update_id)
+            lane = self._lanes.get(chat_id)
+            if lane is None:
+                lane = self._lanes[chat_id] = {"updates": deque(), "busy": False}
+            lane["updates"].append(update)
+            self._queued += 1
+            if not lane["busy"] and len(lane["updates"]) == 1:
+                self._ready.append(chat_id)
+                self._changed.notify_all()
+        self._ensure_started()
+        return "queued"
+
+    def _take(self):
+        with self._changed:
+            while not self._ready:
+                if self._stopped:
+                    return None, None
+                self._changed.wait()
+            chat_id = self._ready.popleft()
+            lane = self._lanes[chat_id]
+            lane["busy"] = True
+            self._queued -= 1
+            self._in_flight += 1
+            return chat_id, lane["updates"].popleft()
+
+    def _release(self, chat_id):
+        with self._changed:
+            self._in_flight -= 1
+            lane = self._lanes[chat_id]
+            lane["busy"] = False
+            if lane["updates"]:
+                self._ready.append(chat_id)
+                self._changed.notify_all()
+            else:
+                del self._lanes[chat_id]
+            if not self._queued and not self._in_flight:
+                # Wake drain()
+                self._changed.notify_all()
+
+    def _run(self):
+        while True:
+            chat_id, update = self._take()
+            if update is None:
+                return
+            started = time.time()
+            try:
+                self.handler(update)
+                self._handled += 1
+            except Exception as e:
+                self._failed += 1
+                self._last_error = str(e)
+                logger.error(f"Error handling update {update.get('update_id')}: {str(e)}")
+            finally:
+                elapsed = time.time() - started
+                self._handle_time_total += elapsed
+                self._handle_time_max = max(self._handle_time_max, elapsed)
+                self._release(chat_id)
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads or self._stopped:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"update-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        atexit.register(self.stop)
+
+    def drain(self, timeout=None):
+        """
+        Wait until every queued update has been handled. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._changed:
+            while self._queued or self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining if remaining is not None else 1.0)
+        return True
+
+    def stop(self, timeout=10):
+        """
+        Handle what is queued, up to `timeout` seconds, and stop the workers
+        """
+        self.drain(timeout)
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join(1)
+        if self._queued:
+            logger.error(f"{self._queued} Telegram updates not handled on shutdown")
+
+    def metrics(self):
+        with self._lock:
+            queued = self._queued
+            in_flight = self._in_flight
+            chats = len(self._lanes)
+        finished = self._handled + self._failed
+        return {
+            "queued": queued,
+            "in_flight": in_flight,
+            "chats": chats,
+            "workers": self.workers,
+            "received": self._received,
+            "duplicates": self._duplicates,
+            "rejected": self._rejected,
+            "handled": self._handled,
+            "failed": self._failed,
+            "avg_handle_seconds": round(self._handle_time_total / finished, 4) if finished else 0,
+            "max_handle_seconds": round(self._handle_time_max, 4),
+            "last_error": self._last_error
+        }
@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+# Point the app at a throwaway SQLite database (and keep its other files out
+# of src/database) before anything from src is imported
+_data_dir = tempfile.mkdtemp(prefix="alphawulf-tests-")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(_data_dir, "app.db")
+os.environ["MINIGAME_REWARDS_SPILL_PATH"] = os.path.join(_data_dir, "minigame_rewards.spill")
+os.environ["TELEGRAM_OFFSET_PATH"] = os.path.join(_data_dir, "telegram_offset.json")
+os.environ["BROADCAST_AUTO_RESUME"] = "false"
+os.environ["LOAD_SHEDDING_ENABLED"] = "false"
+os.environ["RATE_LIMIT_ENABLED"] = "false"
+
+import itertools
+import pytest
+import time
+from src.storage.sqlite_backend import SQLiteStorage
+
+_telegram_ids = itertools.count(int(time.time() * 1000))
+
+@pytest.fixture
+def sqlite_storage(tmp_path):
+    """
+    A fresh SQLite database per test
+    """
+    return SQLiteStorage(str(tmp_path / "test.db"))
+
+@pytest.fixture
+def new_telegram_id():
+    """
+    Telegram IDs not used by any other test, for tests on the shared app storage
+    """
+    return lambda: str(next(_telegram_ids))
+
+def make_user(storage, telegram_id, **fields):
+    """
+    Store a user with full energy and the given column overrides
+    """
+    row = {
+        "coins": 0,
+        "energy": 100,
+        "max_energy": 100,
+        "tap_power": 1,
+        "energy_regen_rate": 1,
+        "last_energy_update": int(time.time())
+    }
+    row.update(fields)
+    return storage.users.upsert(str(telegram_id), row)
+
+def wait_for(condition, timeout=5):
+    """
+    Poll until condition() holds, for work done by background threads
+    """
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
@@ -0,0 +1,71 @@
+import pytest
+from src.main import app
+from src.models.transaction import ledger
+from src.models.user import User
+from src.storage import storage
+from tests.conftest import make_user
+
+@pytest.fixture
+def admin_client():
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["admin_logged_in"] = True
+    return client
+
+def _ledger_amounts(telegram_id, transaction_type):
+    return [row["amount"] for row in storage.transactions.page(telegram_id) if row["type"] == transaction_type]
+
+def test_reset_writes_every_column_over_a_stale_cache(admin_client, new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=100, max_energy=100)
+    User.get_by_telegram_id(telegram_id)
+    storage.users.upsert(telegram_id, {"max_energy": 200})
+
+    response = admin_client.post("/api/admin/reset_user_data", json={"telegram_id": telegram_id})
+
+    assert response.get_json()["success"] is True
+    row = storage.users.get(telegram_id)
+    assert (row["coins"], row["max_energy"]) == (2500, 100)
+
+def test_reset_ledger_records_the_stored_balance_change(admin_client, new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=100)
+    User.get_by_telegram_id(telegram_id)
+    storage.users.apply_delta(telegram_id, coins=400)
+
+    admin_client.post("/api/admin/reset_user_data", json={"telegram_id": telegram_id})
+    ledger.flush()
+
+    assert _ledger_amounts(telegram_id, "admin_reset") == [2000]
+
+@pytest.mark.parametrize("amount", [0, -5, 1.5, "10", True])
+def test_adjust_coins_rejects_anything_but_a_positive_whole_number(admin_client, new_telegram_id, amount):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=100)
+
+    response = admin_client.post("/api/admin/adjust_coins", json={"telegram_id": telegram_id, "amount": amount, "action": "add"})
+
+    assert response.status_code == 400
+    assert storage.users.get(telegram_id)["coins"] == 100
+
+def test_subtract_records_what_was_actually_taken(admin_client, new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=30)
+
+    response = admin_client.post("/api/admin/adjust_coins", json={"telegram_id": telegram_id, "amount": 50, "action": "subtract"})
+    ledger.flush()
+
+    assert response.get_json()["new_coins"] == 0
+    assert _ledger_amounts(telegram_id, "admin_adjustment") == [-30]
+
+def test_stats_error_payload_has_the_success_shape(admin_client, monkeypatch):
+    success = admin_client.get("/api/admin/stats").get_json()
+
+    def unavailable():
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(storage.stats, "totals", unavailable)
+    response = admin_client.get("/api/admin/stats")
+
+    assert response.status_code == 500
+    assert set(response.get_json()) == set(success) | {"error"}
@@ -0,0 +1,126 @@
+import os
+import pytest
+from src.models.batch_writer import BatchWriter
+from tests.conftest import wait_for
+
+class Store:
+    """
+    write_fn that records batches and fails while `down` is set
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.down = False
+
+    def write(self, rows):
+        if self.down:
+            raise RuntimeError("database unavailable")
+        self.batches.append(list(rows))
+
+    @property
+    def rows(self):
+        return [row for batch in self.batches for row in batch]
+
+@pytest.fixture
+def make_writer():
+    writers = []
+
+    def make(store, **options):
+        options = dict({"flush_interval": 3600, "max_retries": 2, "retry_backoff": 0}, **options)
+        writer = BatchWriter(store.write, "test", **options)
+        writers.append((writer, store))
+        return writer
+
+    yield make
+    for writer, store in writers:
+        store.down = False
+        writer.stop()
+
+def test_rows_are_written_in_batches(make_writer):
+    store = Store()
+    writer = make_writer(store, batch_size=3)
+    for index in range(7):
+        writer.put({"n": index})
+
+    writer.flush()
+
+    assert [len(batch) for batch in store.batches] == [3, 3, 1]
+    assert [row["n"] for row in store.rows] == list(range(7))
+
+def test_failed_writes_spill_and_are_replayed_after_a_restart(make_writer, tmp_path):
+    spill_path = str(tmp_path / "test.spill")
+    store = Store()
+    store.down = True
+    writer = make_writer(store, batch_size=2, spill_path=spill_path)
+    for index in range(5):
+        writer.put({"n": index})
+
+    writer.flush()
+
+    assert store.rows == []
+    assert writer.metrics()["spilled"] == 5
+    with open(spill_path) as spill_file:
+        assert len(spill_file.readlines()) == 5
+
+    # A new process picks the spill file up and writes it back
+    recovered = Store()
+    restarted = make_writer(recovered, batch_size=2, spill_path=spill_path, flush_interval=0.01)
+    assert wait_for(lambda: restarted.metrics()["replayed"] == 5)
+    assert sorted(row["n"] for row in recovered.rows) == list(range(5))
+    assert not os.path.exists(spill_path)
+
+def test_without_a_spill_file_failed_rows_stay_queued(make_writer):
+    store = Store()
+    store.down = True
+    writer = make_writer(store)
+    writer.put({"n": 1})
+
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    assert writer.metrics()["queued"] == 1
+
+    store.down = False
+    writer.flush()
+    assert store.rows == [{"n": 1}]
+
+def test_full_queue_writes_from_the_caller(make_writer):
+    store = Store()
+    writer = make_writer(store, max_queue=2, block_timeout=0, batch_size=100)
+    for index in range(3):
+        writer.put({"n": index})
+
+    assert writer.metrics()["inline_flushes"] == 1
+    assert [row["n"] for row in store.rows] == [0, 1, 2]
+
+def test_pid_placeholder_gives_each_process_its_own_spill_file(make_writer, tmp_path):
+    store = Store()
+    store.down = True
+    writer = make_writer(store, spill_path=str(tmp_path / "test.{pid}.spill"))
+    writer.put({"n": 1})
+
+    writer.flush()
+
+    assert os.path.exists(tmp_path / f"test.{os.getpid()}.spill")
+
+def test_spill_files_of_exited_processes_are_claimed_once(make_writer, tmp_path, monkeypatch):
+    for dead_pid, rows in ((111, [{"n": 1}, {"n": 2}]), (222, [{"n": 3}])):
+        with open(tmp_path / f"test.{dead_pid}.spill", "w") as spill_file:
+            spill_file.writelines(f'{{"n":{row["n"]}}}\n' for row in rows)
+    with open(tmp_path / "test.333.spill", "w") as spill_file:
+        spill_file.write('{"n":4}\n')
+    live_pids = {333, os.getpid()}
+    monkeypatch.setattr("src.models.batch_writer._pid_alive", lambda pid: pid in live_pids)
+    spill_path = str(tmp_path / "test.{pid}.spill")
+
+    recovered = Store()
+    writer = make_writer(recovered, batch_size=10, spill_path=spill_path, flush_interval=0.01)
+    # A second process starting at the same time finds nothing left to claim
+    with monkeypatch.context() as patch:
+        patch.setattr(os, "getpid", lambda: 444)
+        other = make_writer(Store(), spill_path=spill_path)
+
+    assert wait_for(lambda: writer.metrics()["replayed"] == 3)
+    assert sorted(row["n"] for row in recovered.rows) == [1, 2, 3]
+    assert other.metrics()["spill_pending"] is False
+    # The live process keeps its own file
+    assert sorted(os.listdir(tmp_path)) == ["test.333.spill"]
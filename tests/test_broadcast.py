@@ -0,0 +1,128 @@
+import pytest
+import time
+from src.models.broadcast import Broadcasts, Pacer
+from src.telegram_api import OutboundQueue, TelegramError
+from src.storage import storage
+
+class FakeAPI:
+    """
+    Accepts every send; `on_send` runs inside the first one
+    """
+
+    def __init__(self, on_send=None):
+        self.sent = []
+        self.on_send = on_send
+
+    def call_once(self, method, data=None, files=None, timeout=None):
+        if self.on_send:
+            on_send, self.on_send = self.on_send, None
+            on_send()
+        self.sent.append(data["chat_id"])
+        return {"message_id": 1}
+
+@pytest.fixture
+def make_broadcasts():
+    outboxes = []
+
+    def make(api):
+        broadcasts = Broadcasts(token="test", concurrency=2, page_size=2)
+        broadcasts.outbox = OutboundQueue(api, workers=2, global_rate=1000, chat_interval=0, group_interval=0)
+        outboxes.append(broadcasts.outbox)
+        return broadcasts
+
+    yield make
+    for outbox in outboxes:
+        outbox.stop(timeout=2)
+
+def _broadcast():
+    now = int(time.time())
+    return storage.broadcasts.insert({
+        "text": "Howl!", "parse_mode": "HTML", "paid": False, "rate": 1000, "status": "running",
+        "total": 0, "created_at": now, "updated_at": now
+    })
+
+def _user_count():
+    return storage.query_one("SELECT COUNT(*) AS count FROM users")["count"]
+
+def test_broadcast_reaches_every_user_and_completes(make_broadcasts):
+    storage.users.upsert("broadcast-recipient", {"coins": 0})
+    api = FakeAPI()
+    row = _broadcast()
+
+    make_broadcasts(api)._send_all(row["id"])
+
+    row = storage.broadcasts.get(row["id"])
+    assert row["status"] == "completed"
+    assert row["delivered"] == len(api.sent) == _user_count()
+    assert (row["owner"], row["lease_until"]) == (None, None)
+
+def test_sender_does_not_take_a_live_lease(make_broadcasts):
+    api = FakeAPI()
+    row = _broadcast()
+    storage.broadcasts.claim(row["id"], "other", time.time() + 600, time.time())
+
+    make_broadcasts(api)._send_all(row["id"])
+
+    assert api.sent == []
+    assert storage.broadcasts.get(row["id"])["owner"] == "other"
+
+def test_sender_that_lost_its_lease_keeps_away_from_the_new_senders_progress(make_broadcasts):
+    row = _broadcast()
+
+    def take_over():
+        storage.broadcasts.update(row["id"], {"owner": "other", "lease_until": int(time.time()) + 600, "last_user_id": 0})
+
+    make_broadcasts(FakeAPI(on_send=take_over))._send_all(row["id"])
+
+    row = storage.broadcasts.get(row["id"])
+    assert (row["owner"], row["last_user_id"], row["delivered"]) == ("other", 0, 0)
+
+def test_paused_broadcast_is_not_checkpointed_or_leased(make_broadcasts):
+    row = _broadcast()
+    broadcasts = make_broadcasts(FakeAPI(on_send=lambda: broadcasts.pause(row["id"])))
+
+    broadcasts._send_all(row["id"])
+
+    paused = storage.broadcasts.get(row["id"])
+    assert paused["status"] == "paused"
+    assert paused["last_user_id"] == 0
+
+def test_checkpoints_require_the_current_owner(sqlite_storage):
+    now = int(time.time())
+    row = sqlite_storage.broadcasts.insert({
+        "text": "Howl!", "rate": 25, "status": "running", "created_at": now, "updated_at": now
+    })
+    sqlite_storage.broadcasts.claim(row["id"], "me", now + 60, now)
+
+    assert sqlite_storage.broadcasts.update(row["id"], {"last_user_id": 5}, status="running", owner="other") is None
+    assert sqlite_storage.broadcasts.update(row["id"], {"last_user_id": 5}, status="running", owner="me")["last_user_id"] == 5
+
+def test_recipient_still_rate_limited_is_counted_as_failed(make_broadcasts):
+
+    class FloodedAPI:
+        calls = 0
+
+        def call_once(self, method, data=None, files=None, timeout=None):
+            self.calls += 1
+            raise TelegramError("Too Many Requests", 429, retry_after=0)
+
+    api = FloodedAPI()
+    broadcasts = make_broadcasts(api)
+
+    assert broadcasts._deliver(Pacer(1000), {"text": "Howl!"}, "1") == "failed"
+    assert api.calls == broadcasts.outbox.max_retries
+
+def test_broadcasts_wait_for_the_bots_replies(make_broadcasts):
+    api = FakeAPI()
+    broadcasts = make_broadcasts(api)
+    outbox = broadcasts.outbox
+    outbox.global_interval = 0.2
+    # The first send holds the global pace, so both of the next wait for the same slot
+    outbox.enqueue("sendMessage", {"chat_id": "first"}, chat_id="first").wait(5)
+    bulk = outbox.enqueue("sendMessage", {"chat_id": "broadcast"}, chat_id="broadcast", bulk=True)
+    reply = outbox.enqueue("sendMessage", {"chat_id": "reply"}, chat_id="reply")
+
+    bulk.wait(5)
+    reply.wait(5)
+
+    assert api.sent == ["first", "reply", "broadcast"]
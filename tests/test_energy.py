@@ -0,0 +1,27 @@
+from flask import Flask
+from src.routes.user import user_bp
+from src.storage import storage
+from src.storage.base import energy_at
+from tests.conftest import make_user
+
+def test_energy_regenerates_one_unit_per_30_seconds_per_level():
+    assert energy_at(10, 1000, 100, 1, 1000 + 300) == 20
+    assert energy_at(10, 1000, 100, 2, 1000 + 300) == 30
+
+def test_energy_is_capped_at_max():
+    assert energy_at(90, 1000, 100, 1, 1000 + 3600) == 100
+
+def test_energy_ignores_clock_skew():
+    assert energy_at(50, 2000, 100, 1, 1000) == 50
+
+def test_reading_a_user_never_writes_energy(new_telegram_id):
+    telegram_id = new_telegram_id()
+    stored = make_user(storage, telegram_id, energy=10, last_energy_update=1000)
+    app = Flask(__name__)
+    app.register_blueprint(user_bp)
+
+    body = app.test_client().get(f"/api/user/{telegram_id}").get_json()
+
+    assert body["energy"] == 100
+    row = storage.users.get(telegram_id)
+    assert (row["energy"], row["last_energy_update"]) == (stored["energy"], stored["last_energy_update"])
@@ -0,0 +1,85 @@
+import random
+import threading
+from src.models.leaderboard import IndexableSkipList, Leaderboard, Leaderboards
+from tests.conftest import wait_for
+
+def test_skip_list_ranks_match_a_sorted_list():
+    skip_list = IndexableSkipList()
+    keys = random.Random(7).sample(range(10000), 500)
+    for key in keys:
+        skip_list.insert(key)
+    for key in keys[::3]:
+        assert skip_list.remove(key)
+    remaining = sorted(set(keys) - set(keys[::3]))
+
+    assert len(skip_list) == len(remaining)
+    assert [skip_list.rank(key) for key in remaining] == list(range(1, len(remaining) + 1))
+    assert skip_list.slice(1, len(remaining)) == remaining
+    assert skip_list.slice(100, 5) == remaining[99:104]
+    assert skip_list.rank(keys[0]) is None
+    assert not skip_list.remove(keys[0])
+
+def test_leaderboard_orders_by_score_then_member():
+    board = Leaderboard()
+    board.set("b", 10)
+    board.set("a", 10)
+    board.set("c", 30)
+    board.add("d", 5)
+    board.add("d", 15)
+
+    assert board.top(10) == [(1, "c", 30), (2, "d", 20), (3, "a", 10), (4, "b", 10)]
+    assert board.rank("a") == 3
+    assert board.around("d", 1) == [(1, "c", 30), (2, "d", 20), (3, "a", 10)]
+
+    board.remove("c")
+    assert board.rank("d") == 1
+    assert board.rank("c") is None
+
+def test_windows_count_only_coins_earned():
+    leaderboards = Leaderboards(lambda batch_size: iter(()), enabled=True, reload_interval=0)
+    leaderboards.observe("1", 100)
+    leaderboards.earned("1", 50)
+    leaderboards.observe("1", 150)
+    # Refunds and admin changes move the balance without counting as earned
+    leaderboards.observe("1", 400)
+    leaderboards.observe("2", 500)
+
+    assert leaderboards.board("all").top(2) == [(1, "2", 500), (2, "1", 400)]
+    assert leaderboards.board("daily").top(2) == [(1, "1", 50)]
+    assert leaderboards.board("weekly").score("1") == 50
+
+def test_board_does_not_wait_for_the_load():
+    release = threading.Event()
+
+    def load_rows(batch_size):
+        release.wait(5)
+        yield {"telegram_id": "1", "coins": 10}
+        yield {"telegram_id": "2", "coins": 20}
+
+    leaderboards = Leaderboards(load_rows, enabled=True, reload_interval=0)
+    leaderboards.observe("2", 30)
+
+    assert leaderboards.loading
+    assert leaderboards.board("all").top(10) == [(1, "2", 30)]
+    release.set()
+    assert wait_for(lambda: not leaderboards.loading)
+    assert leaderboards.board("all").top(10) == [(1, "2", 30), (2, "1", 10)]
+
+def test_reload_picks_up_other_workers_changes():
+    stored = {"1": 10, "2": 20}
+    loads = []
+
+    def load_rows(batch_size):
+        loads.append(True)
+        return [{"telegram_id": telegram_id, "coins": coins} for telegram_id, coins in stored.items()]
+
+    leaderboards = Leaderboards(load_rows, enabled=True, reload_interval=0.01)
+    leaderboards.board("all")
+    assert wait_for(lambda: not leaderboards.loading)
+    # Another worker credits user 1 and deletes user 2
+    stored = {"1": 50}
+    count = len(loads)
+
+    assert wait_for(lambda: len(loads) > count + 1)
+    assert leaderboards.board("all").top(10) == [(1, "1", 50)]
+    leaderboards._stop.set()
@@ -0,0 +1,45 @@
+import pytest
+import sqlite3
+from src.models.transaction import Ledger
+
+@pytest.fixture
+def ledger(sqlite_storage):
+    ledger = Ledger(sqlite_storage.transactions.append, enabled=True, flush_interval=3600)
+    yield ledger
+    ledger.stop()
+
+def test_entries_and_balances_are_written_together(sqlite_storage, ledger):
+    ledger.record("1", "welcome", 2500, "Welcome bonus", 1000)
+    ledger.record("1", "withdrawal", -1000, "Withdrawal #1", 1001)
+    ledger.record("2", "minigame", 50, None, 1002)
+    ledger.flush()
+
+    balance = sqlite_storage.transactions.balance("1")
+    assert (balance["balance"], balance["entries"], balance["updated_at"]) == (1500, 2, 1001)
+    assert [row["amount"] for row in sqlite_storage.transactions.page("1")] == [-1000, 2500]
+
+def test_taps_are_aggregated_per_user_per_batch(sqlite_storage, ledger):
+    for _ in range(5):
+        ledger.record_taps("1", 2, 4, 1000)
+    ledger.record_taps("2", 1, 1, 1000)
+    ledger.flush()
+
+    rows = sqlite_storage.transactions.page("1")
+    assert len(rows) == 1
+    assert (rows[0]["amount"], rows[0]["description"]) == (20, "Earned from 10 taps")
+    assert sqlite_storage.transactions.balance("2")["balance"] == 1
+
+def test_ledger_rows_are_append_only(sqlite_storage, ledger):
+    ledger.record("1", "welcome", 2500, None, 1000)
+    ledger.flush()
+
+    with pytest.raises(sqlite3.DatabaseError):
+        sqlite_storage.connection().execute("UPDATE transactions SET amount = 0")
+    with pytest.raises(sqlite3.DatabaseError):
+        sqlite_storage.connection().execute("DELETE FROM transactions")
+
+def test_unknown_types_and_zero_amounts(ledger):
+    with pytest.raises(ValueError):
+        ledger.record("1", "gift", 10)
+    ledger.record("1", "welcome", 0)
+    assert ledger.metrics()["queued"] == 0
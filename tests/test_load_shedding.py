@@ -0,0 +1,62 @@
+from flask import Flask
+import threading
+import time
+from src.load_shedding import AdmissionController, PriorityClass, endpoint_class
+
+def _controller(max_in_flight=2, game_limit=2, deadline=1.0):
+    return AdmissionController({
+        "critical": PriorityClass("critical", 0, max_in_flight, deadline, 5),
+        "game": PriorityClass("game", 2, game_limit, deadline, 1)
+    }, max_in_flight=max_in_flight)
+
+def test_requests_over_the_class_limit_are_shed_after_the_deadline():
+    controller = _controller(max_in_flight=10, game_limit=1, deadline=0.05)
+    assert controller.acquire("game")
+
+    started = time.monotonic()
+    assert not controller.acquire("game")
+    assert time.monotonic() - started >= 0.05
+    # Other classes still get in
+    assert controller.acquire("critical")
+    assert controller.stats()["classes"]["game"]["shed"] == 1
+
+def test_time_queued_upstream_counts_against_the_deadline():
+    controller = _controller(max_in_flight=1, deadline=1.0)
+    controller.acquire("game")
+
+    started = time.monotonic()
+    assert not controller.acquire("critical", queued_for=5.0)
+    assert time.monotonic() - started < 0.5
+
+def test_freed_slots_go_to_higher_priority_waiters_first():
+    controller = _controller(max_in_flight=1, game_limit=1, deadline=2.0)
+    controller.acquire("game")
+    admitted = []
+
+    def request(name):
+        if controller.acquire(name):
+            admitted.append(name)
+            controller.release(name)
+
+    game = threading.Thread(target=request, args=("game",))
+    game.start()
+    time.sleep(0.05)
+    critical = threading.Thread(target=request, args=("critical",))
+    critical.start()
+    time.sleep(0.05)
+    controller.release("game")
+    game.join()
+    critical.join()
+
+    assert admitted == ["critical", "game"]
+    assert controller.in_flight == 0
+
+def test_endpoints_map_to_classes():
+    app = Flask(__name__)
+    with app.test_request_context(method="POST"):
+        assert endpoint_class("withdraw.withdraw") == "critical"
+        assert endpoint_class("admin.get_stats") == "critical"
+        assert endpoint_class("user.tap_batch") == "game"
+        assert endpoint_class("static") is None
+    with app.test_request_context(method="GET"):
+        assert endpoint_class("leaderboard.get_leaderboard") == "read"
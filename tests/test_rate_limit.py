@@ -0,0 +1,66 @@
+from flask import Flask, jsonify
+import time
+from src import rate_limit
+from src.rate_limit import TokenBucketLimiter, client_ip, rate_limited
+
+def test_bucket_allows_a_burst_then_refills():
+    limiter = TokenBucketLimiter(capacity=3, refill_rate=100)
+
+    assert [limiter.allow("a")[0] for _ in range(4)] == [True, True, True, False]
+    time.sleep(0.02)
+    assert limiter.allow("a")[0]
+
+def test_rejections_say_when_to_retry():
+    limiter = TokenBucketLimiter(capacity=1, refill_rate=0.5)
+    limiter.allow("a")
+
+    assert limiter.allow("a") == (False, 2)
+    assert limiter.stats()["rejected"] == 1
+
+def test_buckets_are_independent_per_key():
+    limiter = TokenBucketLimiter(capacity=1, refill_rate=0)
+    limiter.allow("a")
+
+    assert limiter.allow("b")[0]
+    assert not limiter.allow("a")[0]
+
+def test_oldest_buckets_are_dropped_at_the_key_limit():
+    limiter = TokenBucketLimiter(capacity=1, refill_rate=0, max_keys=2)
+    for key in ("a", "b", "c"):
+        limiter.allow(key)
+
+    assert limiter.stats()["keys"] == 2
+    # "a" was dropped, so it starts from a full bucket again
+    assert limiter.allow("a")[0]
+
+def test_forwarded_for_is_ignored_without_proxy_hops():
+    app = Flask(__name__)
+    with app.test_request_context(headers={"X-Forwarded-For": "1.2.3.4"}, environ_base={"REMOTE_ADDR": "10.0.0.1"}):
+        assert client_ip() == "10.0.0.1"
+
+def test_forwarded_for_is_read_from_the_trusted_hop(monkeypatch):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_PROXY_HOPS", 1)
+    app = Flask(__name__)
+    # The client wrote the first entry itself; the proxy appended the real address
+    with app.test_request_context(headers={"X-Forwarded-For": "6.6.6.6, 1.2.3.4"}, environ_base={"REMOTE_ADDR": "10.0.0.1"}):
+        assert client_ip() == "1.2.3.4"
+
+def test_limited_route_answers_429_with_retry_after(monkeypatch):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(rate_limit, "limiters", {})
+    app = Flask(__name__)
+
+    @app.route("/reward", methods=["POST"])
+    @rate_limited("minigame_reward")
+    def reward():
+        return jsonify({"success": True})
+
+    client = app.test_client()
+    capacity = int(rate_limit.DEFAULT_RATE_LIMITS["minigame_reward"][0])
+    statuses = [client.post("/reward", json={"telegram_id": "1"}).status_code for _ in range(capacity + 1)]
+
+    assert statuses == [200] * capacity + [429]
+    limited = client.post("/reward", json={"telegram_id": "1"})
+    assert int(limited.headers["Retry-After"]) >= 1
+    # Another user behind the same address still has a bucket of their own
+    assert client.post("/reward", json={"telegram_id": "2"}).status_code == 200
@@ -0,0 +1,64 @@
+from flask import Flask
+import pytest
+from src.models.referral_credits import ReferralCreditMerger
+from src.models.user import User
+from src.routes.referrals import referral_bp
+from src.storage import storage
+from tests.conftest import make_user
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(referral_bp)
+    return app.test_client()
+
+def test_stats_come_from_the_referrer_aggregates(client, new_telegram_id):
+    referrer = new_telegram_id()
+    make_user(storage, referrer)
+    for _ in range(3):
+        User.apply_referral(referrer, new_telegram_id(), 0, 100)
+    User.merge_referral_credits(referrer)
+
+    body = client.get(f"/api/referral_stats/{referrer}").get_json()
+
+    assert (body["total_referrals"], body["total_earnings"]) == (3, 300)
+    assert len(body["referrals"]) == 3
+
+def test_referral_list_pages_newest_first(client, new_telegram_id):
+    referrer = new_telegram_id()
+    make_user(storage, referrer)
+    referees = [new_telegram_id() for _ in range(5)]
+    for referee in referees:
+        User.apply_referral(referrer, referee, 0, 100)
+
+    seen, cursor = [], None
+    while True:
+        query = f"?limit=2&cursor={cursor}" if cursor else "?limit=2"
+        body = client.get(f"/api/referrals/{referrer}{query}").get_json()
+        seen.extend(referral["user_id"] for referral in body["referrals"])
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+
+    assert seen == referees[::-1]
+
+def test_tampered_cursor_is_rejected(client, new_telegram_id):
+    assert client.get(f"/api/referrals/{new_telegram_id()}?cursor=abc").status_code == 400
+
+def test_merge_user_only_reaches_the_database_for_pending_referrers():
+    calls = []
+
+    def merge_fn(referrer_id, limit):
+        calls.append(referrer_id)
+        return [], 1
+
+    merger = ReferralCreditMerger(merge_fn, interval=3600)
+    merger.credited("1")
+
+    merger.merge_user("2")
+    merger.merge_user("1")
+    merger.merge_user("1")
+    merger.merge_user("2", force=True)
+    merger.stop()
+
+    assert calls[:2] == ["1", "2"]
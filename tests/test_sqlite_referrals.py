@@ -0,0 +1,113 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import sqlite3
+import time
+from src.storage.sqlite_backend import SQLiteStorage
+from tests.conftest import make_user
+
+def _refer(storage, referrer_id, telegram_id, referee_bonus=500, referrer_bonus=500):
+    return storage.users.apply_referral(
+        referrer_id, telegram_id, {"coins": 0}, referee_bonus, referrer_bonus, int(time.time())
+    )
+
+def test_referral_is_credited_once(sqlite_storage):
+    make_user(sqlite_storage, "1")
+
+    status, user, _ = _refer(sqlite_storage, "1", "2")
+    replayed, replayed_user, _ = _refer(sqlite_storage, "1", "2")
+
+    assert (status, replayed) == ("applied", "duplicate")
+    assert user["coins"] == replayed_user["coins"] == 500
+    assert user["referred_by"] == "1"
+    assert len(sqlite_storage.referred_users.list_by_referrer("1")) == 1
+
+def test_concurrent_referrals_of_one_user_credit_once(sqlite_storage):
+    make_user(sqlite_storage, "1")
+    make_user(sqlite_storage, "3")
+
+    with ThreadPoolExecutor(8) as pool:
+        statuses = list(pool.map(lambda index: _refer(sqlite_storage, "1" if index % 2 else "3", "2")[0], range(8)))
+
+    assert statuses.count("applied") == 1
+    assert sqlite_storage.users.get("2")["coins"] == 500
+    assert sqlite_storage.query_one("SELECT COUNT(*) AS count FROM referred_users")["count"] == 1
+    assert sqlite_storage.query_one("SELECT COUNT(*) AS count FROM referral_credits")["count"] == 1
+
+def test_second_referrer_is_refused(sqlite_storage):
+    make_user(sqlite_storage, "1")
+    make_user(sqlite_storage, "3")
+    _refer(sqlite_storage, "1", "2")
+
+    assert _refer(sqlite_storage, "3", "2")[0] == "already_referred"
+
+def test_unknown_referrer_creates_nothing(sqlite_storage):
+    assert _refer(sqlite_storage, "missing", "2") == ("invalid_referrer", None, None)
+    assert sqlite_storage.users.get("2") is None
+
+def test_duplicate_referrals_are_removed_once_on_upgrade(tmp_path, caplog):
+    path = str(tmp_path / "old.db")
+    # A database from before the unique index, holding a duplicate
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE referred_users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, referrer_id TEXT NOT NULL, user_id TEXT NOT NULL,
+            username TEXT, name TEXT, joined_date INTEGER, earnings_from_referral INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT INTO referred_users (referrer_id, user_id) VALUES ('1', '2'), ('1', '2'), ('1', '3');
+    """)
+    connection.close()
+
+    with caplog.at_level(logging.WARNING):
+        storage = SQLiteStorage(path)
+    assert "Removed 1 duplicate referred_users rows" in caplog.text
+    assert [row["id"] for row in storage.query("SELECT id FROM referred_users ORDER BY id")] == [1, 3]
+
+    # Later startups leave the table alone
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        SQLiteStorage(path)
+    assert "duplicate referred_users" not in caplog.text
+
+def test_credits_merge_into_one_update_per_referrer(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=10)
+    make_user(sqlite_storage, "5", coins=0)
+    for referee in ("2", "3", "4"):
+        _refer(sqlite_storage, "1", referee, referrer_bonus=100)
+    _refer(sqlite_storage, "5", "6", referrer_bonus=100)
+
+    # Referrers' rows are untouched until the merge
+    assert sqlite_storage.users.get("1")["coins"] == 10
+    rows, merged = sqlite_storage.users.merge_referral_credits()
+
+    assert merged == 4
+    assert sorted(row["telegram_id"] for row in rows) == ["1", "5"]
+    referrer = sqlite_storage.users.get("1")
+    assert (referrer["coins"], referrer["referral_count"], referrer["referral_earnings"]) == (310, 3, 300)
+    assert sqlite_storage.users.merge_referral_credits() == ([], 0)
+
+def test_merge_can_be_limited_to_one_referrer(sqlite_storage):
+    make_user(sqlite_storage, "1")
+    make_user(sqlite_storage, "5")
+    _refer(sqlite_storage, "1", "2", referrer_bonus=100)
+    _refer(sqlite_storage, "5", "6", referrer_bonus=100)
+
+    _, merged = sqlite_storage.users.merge_referral_credits("1")
+
+    assert merged == 1
+    assert sqlite_storage.users.get("1")["coins"] == 100
+    assert sqlite_storage.users.get("5")["coins"] == 0
+
+def test_merge_in_batches_never_double_counts(sqlite_storage):
+    make_user(sqlite_storage, "1")
+    for referee in range(10, 17):
+        _refer(sqlite_storage, "1", str(referee), referrer_bonus=10)
+
+    total = 0
+    while True:
+        _, merged = sqlite_storage.users.merge_referral_credits(limit=3)
+        total += merged
+        if merged < 3:
+            break
+
+    assert total == 7
+    assert sqlite_storage.users.get("1")["referral_earnings"] == 70
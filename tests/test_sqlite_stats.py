@@ -0,0 +1,37 @@
+import time
+from tests.conftest import make_user
+
+def _withdrawal(telegram_id, amount, status="pending"):
+    return {"user_id": telegram_id, "amount": amount, "status": status, "created_at": "2026-01-01T00:00:00"}
+
+def test_counters_follow_users_and_withdrawals(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=100)
+    make_user(sqlite_storage, "2", coins=50)
+    sqlite_storage.users.apply_delta("1", coins=25)
+    first = sqlite_storage.withdrawals.insert(_withdrawal("1", 40))
+    sqlite_storage.withdrawals.insert(_withdrawal("2", 10))
+    sqlite_storage.withdrawals.update_status(first["id"], "completed")
+    sqlite_storage.users.delete("2")
+
+    assert sqlite_storage.stats.totals() == {
+        "total_users": 1,
+        "total_coins": 125,
+        "total_withdrawals": 2,
+        "pending_withdrawals": 1,
+        "completed_withdrawals": 1,
+        "total_withdrawn": 40
+    }
+
+def test_rebuild_matches_the_maintained_counters(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=100)
+    sqlite_storage.withdrawals.insert(_withdrawal("1", 40, status="completed"))
+    maintained = sqlite_storage.stats.totals()
+
+    assert sqlite_storage.stats.rebuild() == maintained
+
+def test_playing_users_counts_recent_taps_only(sqlite_storage):
+    now = int(time.time())
+    make_user(sqlite_storage, "1", last_energy_update=now - 60)
+    make_user(sqlite_storage, "2", last_energy_update=now - 2 * 86400)
+
+    assert sqlite_storage.stats.count_playing_users(now - 86400) == 1
@@ -0,0 +1,39 @@
+import pytest
+import threading
+from src.storage import create_storage
+from src.storage.sqlite_backend import SQLiteStorage
+from tests.conftest import make_user
+
+def test_database_uses_wal(sqlite_storage):
+    assert sqlite_storage.query_one("PRAGMA journal_mode")["journal_mode"] == "wal"
+
+def test_transaction_rolls_back_on_error(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=100)
+
+    with pytest.raises(RuntimeError):
+        with sqlite_storage.transaction() as connection:
+            connection.execute("UPDATE users SET coins = 0 WHERE telegram_id = '1'")
+            raise RuntimeError("failed half way")
+
+    assert sqlite_storage.users.get("1")["coins"] == 100
+
+def test_reopening_keeps_data_and_counters(tmp_path):
+    path = str(tmp_path / "test.db")
+    make_user(SQLiteStorage(path), "1", coins=100)
+
+    reopened = SQLiteStorage(path)
+
+    assert reopened.users.get("1")["coins"] == 100
+    assert reopened.stats.totals()["total_users"] == 1
+
+def test_connections_are_per_thread(sqlite_storage):
+    connections = []
+    thread = threading.Thread(target=lambda: connections.append(sqlite_storage.connection()))
+    thread.start()
+    thread.join()
+
+    assert connections[0] is not sqlite_storage.connection()
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        create_storage("mongodb")
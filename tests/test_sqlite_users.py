@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import time
+from src.storage.base import USER_SORT_COLUMNS, decode_cursor, encode_cursor
+from tests.conftest import make_user
+
+def test_tap_spends_energy_and_credits_coins(sqlite_storage):
+    now = int(time.time())
+    make_user(sqlite_storage, "1", coins=5, tap_power=3, last_energy_update=now)
+
+    row, accepted = sqlite_storage.users.tap("1", 4, now)
+
+    assert accepted == 4
+    assert row["coins"] == 5 + 4 * 3
+    assert row["energy"] == 96
+
+def test_tap_never_overspends_under_concurrency(sqlite_storage):
+    now = int(time.time())
+    make_user(sqlite_storage, "1", energy=100, energy_regen_rate=0, last_energy_update=now)
+
+    with ThreadPoolExecutor(10) as pool:
+        accepted = list(pool.map(lambda _: sqlite_storage.users.tap("1", 20, now)[1], range(10)))
+
+    assert sum(accepted) == 100
+    row = sqlite_storage.users.get("1")
+    assert row["coins"] == 100
+    assert row["energy"] == 0
+
+def test_tap_without_energy_writes_nothing(sqlite_storage):
+    now = int(time.time())
+    make_user(sqlite_storage, "1", coins=7, energy=0, energy_regen_rate=0, last_energy_update=now - 60)
+
+    row, accepted = sqlite_storage.users.tap("1", 5, now)
+
+    assert accepted == 0
+    assert row["coins"] == 7
+    assert sqlite_storage.users.get("1")["last_energy_update"] == now - 60
+
+def test_tap_unknown_user(sqlite_storage):
+    assert sqlite_storage.users.tap("missing", 1, int(time.time())) == (None, 0)
+
+def test_apply_delta_min_coins_guards_the_debit(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=100)
+
+    assert sqlite_storage.users.apply_delta("1", coins=-150, min_coins=150) is None
+    assert sqlite_storage.users.get("1")["coins"] == 100
+
+    row = sqlite_storage.users.apply_delta("1", coins=-100, min_coins=100)
+    assert row["coins"] == 0
+
+def test_apply_delta_concurrent_debits_never_go_negative(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=500)
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: sqlite_storage.users.apply_delta("1", coins=-100, min_coins=100), range(8)))
+
+    assert sum(1 for row in results if row is not None) == 5
+    assert sqlite_storage.users.get("1")["coins"] == 0
+
+def test_apply_delta_expect_rejects_stale_prices(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=1000, tap_power=2)
+
+    assert sqlite_storage.users.apply_delta("1", coins=-100, tap_power=1, expect={"tap_power": 1}) is None
+
+    row = sqlite_storage.users.apply_delta("1", coins=-100, tap_power=1, expect={"tap_power": 2})
+    assert (row["coins"], row["tap_power"]) == (900, 3)
+
+def test_apply_delta_clamp_floors_at_zero(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=30)
+
+    assert sqlite_storage.users.apply_delta("1", coins=-50, clamp_coins=True)["coins"] == 0
+
+def test_apply_delta_settles_energy_before_raising_capacity(sqlite_storage):
+    now = int(time.time())
+    make_user(sqlite_storage, "1", energy=10, max_energy=100, energy_regen_rate=1, last_energy_update=now - 300)
+
+    row = sqlite_storage.users.apply_delta("1", max_energy=50, current_time=now)
+
+    # 300 seconds regenerate 10 energy at one unit per 30 seconds
+    assert row["energy"] == 20
+    assert row["max_energy"] == 150
+    assert row["last_energy_update"] == now
+
+def test_upsert_updates_only_the_given_columns(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=100, username="wolf")
+
+    row = sqlite_storage.users.upsert("1", {"upi_id": "wolf@upi"})
+
+    assert (row["coins"], row["username"], row["upi_id"]) == (100, "wolf", "wolf@upi")
+    assert sqlite_storage.query_one("SELECT COUNT(*) AS count FROM users")["count"] == 1
+
+def _walk(storage, sort, prefix=None, limit=3):
+    """
+    Every page of a keyset listing, following each page's last row
+    """
+    column = USER_SORT_COLUMNS[sort]
+    rows, after = [], None
+    while True:
+        page = storage.users.page("id, telegram_id, username, coins, last_energy_update", sort, after, prefix, limit)
+        rows.extend(page)
+        if len(page) < limit:
+            return rows
+        # Round-trip through the opaque cursor the admin API hands out
+        after = decode_cursor(encode_cursor([page[-1][column], page[-1]["id"]]), 2)
+
+def test_keyset_pages_visit_every_user_once_in_order(sqlite_storage):
+    # Ties on coins exercise the id tiebreak across page boundaries
+    for index, coins in enumerate([5, 3, 5, 1, 3, 5, 0, 9]):
+        make_user(sqlite_storage, str(100 + index), coins=coins)
+
+    rows = _walk(sqlite_storage, "coins")
+
+    assert len(rows) == 8
+    assert len({row["telegram_id"] for row in rows}) == 8
+    assert [(row["coins"], row["id"]) for row in rows] == sorted(
+        ((row["coins"], row["id"]) for row in rows), reverse=True
+    )
+
+def test_keyset_pages_put_nulls_first(sqlite_storage):
+    for index in range(4):
+        make_user(sqlite_storage, str(index), last_energy_update=1000 + index)
+    sqlite_storage.connection().execute("UPDATE users SET last_energy_update = NULL WHERE telegram_id IN ('0', '2')")
+
+    rows = _walk(sqlite_storage, "last_played", limit=1)
+
+    assert [row["telegram_id"] for row in rows] == ["2", "0", "3", "1"]
+
+def test_prefix_search_matches_username_or_telegram_id(sqlite_storage):
+    make_user(sqlite_storage, "111", username="Wolfie")
+    make_user(sqlite_storage, "222", username="wolfgang")
+    make_user(sqlite_storage, "333", username="fox")
+    make_user(sqlite_storage, "3339", username="bear")
+
+    assert {row["telegram_id"] for row in _walk(sqlite_storage, "created", prefix="WOLF")} == {"111", "222"}
+    assert {row["telegram_id"] for row in _walk(sqlite_storage, "created", prefix="333")} == {"333", "3339"}
+
+def test_malformed_cursors_are_rejected():
+    for cursor in ("not base64!", encode_cursor([1]), "e30"):
+        with pytest.raises(ValueError):
+            decode_cursor(cursor, 2)
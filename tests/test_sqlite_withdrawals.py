@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+from tests.conftest import make_user
+
+def _withdrawal(storage, telegram_id, amount, created_at, status="pending"):
+    return storage.withdrawals.insert({
+        "user_id": telegram_id, "amount": amount, "status": status, "created_at": created_at
+    })
+
+def test_bulk_reject_refunds_each_pending_withdrawal_once(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=0)
+    make_user(sqlite_storage, "2", coins=0)
+    first = _withdrawal(sqlite_storage, "1", 100, "2026-01-01T00:00:01")
+    second = _withdrawal(sqlite_storage, "1", 50, "2026-01-01T00:00:02")
+    third = _withdrawal(sqlite_storage, "2", 30, "2026-01-01T00:00:03")
+    done = _withdrawal(sqlite_storage, "2", 70, "2026-01-01T00:00:04", status="completed")
+    ids = [first["id"], second["id"], third["id"], done["id"]]
+
+    reviewed = sqlite_storage.withdrawals.review(ids, "rejected", refund=True)
+    # A repeated request finds nothing pending and refunds nothing
+    repeated = sqlite_storage.withdrawals.review(ids, "rejected", refund=True)
+
+    assert sorted(row["id"] for row in reviewed) == ids[:3]
+    assert repeated == []
+    assert sqlite_storage.users.get("1")["coins"] == 150
+    assert sqlite_storage.users.get("2")["coins"] == 30
+    assert sqlite_storage.withdrawals.get(done["id"])["status"] == "completed"
+
+def test_bulk_approve_moves_no_coins(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=0)
+    withdrawal = _withdrawal(sqlite_storage, "1", 100, "2026-01-01T00:00:01")
+
+    sqlite_storage.withdrawals.review([withdrawal["id"]], "completed")
+
+    assert sqlite_storage.withdrawals.get(withdrawal["id"])["status"] == "completed"
+    assert sqlite_storage.users.get("1")["coins"] == 0
+
+def test_queue_pages_by_status_oldest_first(sqlite_storage):
+    for second in range(5):
+        _withdrawal(sqlite_storage, "1", 10, f"2026-01-01T00:00:0{second}", status="pending" if second % 2 == 0 else "completed")
+
+    first_page = sqlite_storage.withdrawals.page(status="pending", limit=2)
+    last = first_page[-1]
+    second_page = sqlite_storage.withdrawals.page(status="pending", after=(last["created_at"], last["id"]), limit=2)
+
+    assert [row["created_at"][-1] for row in first_page + second_page] == ["0", "2", "4"]
+
+def test_withdrawal_debits_and_records_together(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=5000)
+
+    status, withdrawal, user = sqlite_storage.withdrawals.create("1", 2000, {
+        "status": "pending", "created_at": "2026-01-01T00:00:00"
+    }, "key-1")
+
+    assert status == "created"
+    assert user["coins"] == 3000
+    assert (withdrawal["amount"], withdrawal["user_id"]) == (2000, "1")
+
+def test_retried_withdrawal_is_not_debited_twice(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=5000)
+    row = {"status": "pending", "created_at": "2026-01-01T00:00:00"}
+
+    _, first, _ = sqlite_storage.withdrawals.create("1", 2000, row, "key-1")
+    status, replayed, user = sqlite_storage.withdrawals.create("1", 2000, row, "key-1")
+
+    assert status == "replayed"
+    assert replayed["id"] == first["id"]
+    assert user["coins"] == 3000
+    assert len(sqlite_storage.withdrawals.list_by_user("1")) == 1
+
+def test_concurrent_withdrawals_never_overdraw(sqlite_storage):
+    make_user(sqlite_storage, "1", coins=5000)
+    row = {"status": "pending", "created_at": "2026-01-01T00:00:00"}
+
+    with ThreadPoolExecutor(8) as pool:
+        statuses = list(pool.map(
+            lambda index: sqlite_storage.withdrawals.create("1", 2000, row, f"key-{index}")[0], range(8)
+        ))
+
+    assert statuses.count("created") == 2
+    assert statuses.count("insufficient_funds") == 6
+    assert sqlite_storage.users.get("1")["coins"] == 1000
+
+def test_withdrawal_for_unknown_user(sqlite_storage):
+    assert sqlite_storage.withdrawals.create("missing", 1000, {"created_at": "2026-01-01T00:00:00"}) == (
+        "user_not_found", None, None
+    )
@@ -0,0 +1,32 @@
+from src.storage.supabase_backend import SupabaseStorage
+
+class FakeRPC:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def execute(self):
+        self.client.calls.append(self.name)
+        if self.name in self.client.missing:
+            raise Exception(f"PGRST202 Could not find the function public.{self.name}")
+        return self.name
+
+class FakeClient:
+
+    def __init__(self, missing):
+        self.missing = set(missing)
+        self.calls = []
+
+    def rpc(self, name, params):
+        return FakeRPC(self, name)
+
+def test_missing_rpc_only_disables_itself():
+    client = FakeClient(missing=["user_tap"])
+    storage = SupabaseStorage(client)
+
+    assert storage.rpc("user_tap", {}) is None
+    assert storage.rpc("user_tap", {}) is None
+    assert storage.rpc("user_apply_delta", {}) == "user_apply_delta"
+
+    assert client.calls == ["user_tap", "user_apply_delta"]
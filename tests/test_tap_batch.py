@@ -0,0 +1,47 @@
+from flask import Flask
+import pytest
+from src.routes.user import MAX_TAPS_PER_SECOND, user_bp
+from src.storage import storage
+from tests.conftest import make_user
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(user_bp)
+    return app.test_client()
+
+def test_batch_is_capped_by_its_time_window(client, new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=10, tap_power=2)
+
+    response = client.post("/api/tap/batch", json={
+        "telegram_id": telegram_id, "taps": 1000, "started_at": 0, "ended_at": 1000
+    })
+
+    body = response.get_json()
+    assert body["success"] is True
+    assert body["accepted"] == MAX_TAPS_PER_SECOND
+    assert body["rejected"] == 1000 - MAX_TAPS_PER_SECOND
+    assert body["coins"] == 10 + 2 * MAX_TAPS_PER_SECOND
+    assert storage.users.get(telegram_id)["coins"] == 10 + 2 * MAX_TAPS_PER_SECOND
+
+def test_batch_is_capped_by_energy(client, new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, energy=3, energy_regen_rate=0)
+
+    body = client.post("/api/tap/batch", json={
+        "telegram_id": telegram_id, "taps": 10, "started_at": 0, "ended_at": 5000
+    }).get_json()
+
+    assert body["accepted"] == 3
+    assert body["energy"] == 0
+    assert storage.users.get(telegram_id)["coins"] == 3
+
+def test_batch_rejects_bad_input(client, new_telegram_id):
+    assert client.post("/api/tap/batch", json={"taps": 5}).status_code == 400
+    assert client.post("/api/tap/batch", json={"telegram_id": new_telegram_id(), "taps": 0}).status_code == 400
+    assert client.post("/api/tap/batch", json={"telegram_id": new_telegram_id(), "taps": "many"}).status_code == 400
+
+def test_batch_for_unknown_user(client, new_telegram_id):
+    response = client.post("/api/tap/batch", json={"telegram_id": new_telegram_id(), "taps": 5})
+    assert response.status_code == 404
@@ -0,0 +1,107 @@
+import pytest
+import threading
+import time
+from src.telegram_api import OutboundQueue, TelegramError
+from tests.conftest import wait_for
+
+class FakeAPI:
+    """
+    Records calls; `errors` holds exceptions raised by the next calls
+    """
+
+    def __init__(self, errors=()):
+        self.calls = []
+        self.errors = list(errors)
+        self._lock = threading.Lock()
+
+    def call_once(self, method, data=None, files=None, timeout=None):
+        with self._lock:
+            self.calls.append((time.time(), data))
+            if self.errors:
+                raise self.errors.pop(0)
+        return {"message_id": data["n"]}
+
+@pytest.fixture
+def make_queue():
+    queues = []
+
+    def make(api, **options):
+        options = dict({"workers": 4, "global_rate": 1000, "chat_interval": 0, "group_interval": 0}, **options)
+        queue = OutboundQueue(api, **options)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.stop(timeout=2)
+
+def test_messages_to_a_chat_are_sent_in_order_and_paced(make_queue):
+    api = FakeAPI()
+    queue = make_queue(api, chat_interval=0.05)
+
+    messages = [queue.enqueue("sendMessage", {"n": n}, chat_id=1) for n in range(3)]
+
+    assert [message.wait(5)["message_id"] for message in messages] == [0, 1, 2]
+    sent_at = [sent for sent, _ in api.calls]
+    assert all(later - earlier >= 0.045 for earlier, later in zip(sent_at, sent_at[1:]))
+
+def test_different_chats_are_not_held_by_each_other(make_queue):
+    api = FakeAPI()
+    queue = make_queue(api, chat_interval=10)
+
+    messages = [queue.enqueue("sendMessage", {"n": n}, chat_id=n) for n in range(5)]
+
+    for message in messages:
+        message.wait(2)
+    assert queue.metrics()["sent"] == 5
+
+def test_rate_limited_messages_are_retried_after_retry_after(make_queue):
+    api = FakeAPI([TelegramError("Too Many Requests", 429, retry_after=0.05)])
+    queue = make_queue(api)
+
+    message = queue.enqueue("sendMessage", {"n": 7}, chat_id=1)
+
+    assert message.wait(5) == {"message_id": 7}
+    assert api.calls[1][0] - api.calls[0][0] >= 0.045
+    assert queue.metrics()["rate_limited"] == 1
+
+def test_rejected_messages_fail_without_retrying(make_queue):
+    api = FakeAPI([TelegramError("Bad Request: chat not found", 400)])
+    queue = make_queue(api)
+
+    message = queue.enqueue("sendMessage", {"n": 1}, chat_id=1)
+
+    with pytest.raises(TelegramError):
+        message.wait(5)
+    assert len(api.calls) == 1
+
+def test_full_queue_refuses_more(make_queue):
+    release = threading.Event()
+
+    class BlockedAPI(FakeAPI):
+        def call_once(self, method, data=None, files=None, timeout=None):
+            release.wait(5)
+            return super().call_once(method, data, files, timeout)
+
+    queue = make_queue(BlockedAPI(), workers=1, max_queue=1)
+    # The first message holds the only worker, the second fills the queue
+    queue.enqueue("sendMessage", {"n": 1}, chat_id=1)
+    assert wait_for(lambda: queue.metrics()["in_flight"] == 1)
+    last = queue.enqueue("sendMessage", {"n": 2}, chat_id=2)
+
+    with pytest.raises(TelegramError):
+        queue.enqueue("sendMessage", {"n": 3}, chat_id=3)
+    release.set()
+    assert last.wait(5) == {"message_id": 2}
+
+def test_a_rate_limited_chat_pauses_every_chat(make_queue):
+    api = FakeAPI([TelegramError("Too Many Requests", 429, retry_after=0.2)])
+    queue = make_queue(api)
+
+    limited = queue.enqueue("sendMessage", {"n": 1}, chat_id=1)
+    assert wait_for(lambda: queue.metrics()["rate_limited"] == 1)
+    other = queue.enqueue("sendMessage", {"n": 2}, chat_id=2)
+
+    other.wait(5)
+    limited.wait(5)
+    assert api.calls[1][0] - api.calls[0][0] >= 0.15
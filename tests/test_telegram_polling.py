@@ -0,0 +1,69 @@
+import threading
+from src.telegram_polling import OffsetFile, UpdatePoller
+from src.telegram_updates import UpdateDispatcher
+from tests.conftest import wait_for
+
+class FakeAPI:
+    """
+    Serves queued getUpdates results; exceptions in the queue are raised
+    """
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.offsets = []
+
+    def call_once(self, method, params=None, files=None, timeout=None):
+        self.offsets.append(params.get("offset"))
+        if not self.results:
+            return []
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+class FailingOffsetFile(OffsetFile):
+    def __init__(self, path):
+        super().__init__(path)
+        self.failures = 1
+
+    def save(self, offset):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        super().save(offset)
+
+def _updates(*update_ids):
+    return [{"update_id": update_id, "message": {"chat": {"id": 1}, "text": "hi"}} for update_id in update_ids]
+
+def test_offset_is_saved_after_each_batch(tmp_path):
+    handled = []
+    dispatcher = UpdateDispatcher(lambda update: handled.append(update["update_id"]), workers=2)
+    offsets = OffsetFile(str(tmp_path / "offset.json"))
+    api = FakeAPI([_updates(5, 6), _updates(7)])
+    poller = UpdatePoller(api, dispatcher, offsets)
+
+    assert poller.poll_once() == 2
+    assert poller.poll_once() == 1
+    dispatcher.stop()
+
+    assert handled == [5, 6, 7]
+    assert api.offsets == [None, 7]
+    # A restart continues after the last handled batch
+    assert UpdatePoller(api, dispatcher, offsets).offset == 8
+
+def test_poller_keeps_running_after_unexpected_errors(tmp_path):
+    dispatcher = UpdateDispatcher(lambda update: None, workers=1)
+    offsets = FailingOffsetFile(str(tmp_path / "offset.json"))
+    api = FakeAPI([_updates(1), KeyError("update_id"), _updates(2)])
+    # The first error waits the initial one second, later ones max_backoff
+    poller = UpdatePoller(api, dispatcher, offsets, max_backoff=0.01)
+    runner = threading.Thread(target=poller.run)
+    runner.start()
+
+    assert wait_for(lambda: offsets.load() == 3, timeout=10)
+    poller.stop()
+    runner.join(5)
+    dispatcher.stop()
+
+    assert not runner.is_alive()
+    assert poller.errors == 2
@@ -0,0 +1,107 @@
+import random
+import threading
+import time
+from src.bot import TelegramBot
+from src.models.transaction import ledger
+from src.storage import storage
+from src.telegram_updates import UpdateDispatcher, update_chat_id
+from tests.conftest import make_user
+
+def _message(update_id, chat_id, text="hi"):
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "from": {"id": chat_id}, "text": text}}
+
+def test_updates_for_a_chat_are_handled_one_at_a_time_in_order():
+    handled = {}
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def handler(update):
+        chat_id = update["message"]["chat"]["id"]
+        with lock:
+            if chat_id in running:
+                overlaps.append(chat_id)
+            running.add(chat_id)
+        time.sleep(random.random() / 500)
+        with lock:
+            running.discard(chat_id)
+            handled.setdefault(chat_id, []).append(update["update_id"])
+
+    dispatcher = UpdateDispatcher(handler, workers=8)
+    for update_id in range(200):
+        assert dispatcher.submit(_message(update_id, update_id % 5)) == "queued"
+    assert dispatcher.drain(10)
+    dispatcher.stop()
+
+    assert overlaps == []
+    assert sorted(handled) == list(range(5))
+    assert all(ids == list(range(chat_id, 200, 5)) for chat_id, ids in handled.items())
+
+def test_redelivered_updates_are_dropped():
+    handled = []
+    dispatcher = UpdateDispatcher(lambda update: handled.append(update["update_id"]), workers=2)
+
+    statuses = [dispatcher.submit(_message(update_id, 1)) for update_id in (1, 2, 1, 2, 3)]
+    dispatcher.drain(5)
+    dispatcher.stop()
+
+    assert statuses == ["queued", "queued", "duplicate", "duplicate", "queued"]
+    assert handled == [1, 2, 3]
+
+def test_full_queue_refuses_without_marking_the_update_seen():
+    release = threading.Event()
+    dispatcher = UpdateDispatcher(lambda update: release.wait(5), workers=1, max_queue=1)
+
+    dispatcher.submit(_message(1, 1))
+    dispatcher.submit(_message(2, 1))
+    assert dispatcher.submit(_message(3, 1)) == "full"
+    release.set()
+    dispatcher.drain(5)
+
+    # Telegram's redelivery of the refused update is accepted
+    assert dispatcher.submit(_message(3, 1)) == "queued"
+    dispatcher.stop()
+
+def test_handler_errors_do_not_stop_the_workers():
+    def handler(update):
+        if update["update_id"] == 1:
+            raise KeyError("text")
+
+    dispatcher = UpdateDispatcher(handler, workers=1)
+    dispatcher.submit(_message(1, 1))
+    dispatcher.submit(_message(2, 1))
+    dispatcher.drain(5)
+    dispatcher.stop()
+
+    assert (dispatcher.metrics()["failed"], dispatcher.metrics()["handled"]) == (1, 1)
+
+def test_callback_queries_are_ordered_by_their_chat():
+    assert update_chat_id({"update_id": 1, "callback_query": {"from": {"id": 9}, "message": {"chat": {"id": 4}}}}) == 4
+    assert update_chat_id({"update_id": 1, "callback_query": {"from": {"id": 9}}}) == 9
+
+def test_balance_command_replies(new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=1234)
+    replies = []
+    bot = TelegramBot("test")
+    bot.send_message = lambda chat_id, text, reply_markup=None: replies.append((chat_id, text))
+
+    bot.handle_update({"update_id": 1, "message": {
+        "chat": {"id": int(telegram_id)}, "from": {"id": int(telegram_id)}, "text": "/balance"
+    }})
+
+    assert len(replies) == 1
+    assert "1,234" in replies[0][1]
+
+def test_start_command_records_the_welcome_bonus(new_telegram_id):
+    telegram_id = new_telegram_id()
+    bot = TelegramBot("test")
+    bot.send_message = lambda chat_id, text, reply_markup=None: None
+
+    bot.handle_update({"update_id": 1, "message": {
+        "chat": {"id": int(telegram_id)}, "from": {"id": int(telegram_id), "first_name": "Cub"}, "text": "/start"
+    }})
+    ledger.flush()
+
+    entries = storage.transactions.page(telegram_id)
+    assert [(row["type"], row["amount"]) for row in entries] == [("welcome", 2500)]
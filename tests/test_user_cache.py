@@ -0,0 +1,58 @@
+import time
+from src.models.cache import LRUCache
+from src.models.user import User, user_cache
+from src.storage import storage
+from tests.conftest import make_user
+
+def test_least_recently_used_entries_are_evicted_first():
+    cache = LRUCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+def test_entries_expire_after_their_ttl():
+    cache = LRUCache(max_size=10, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+def test_disabled_cache_stores_nothing():
+    cache = LRUCache(enabled=False)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+def test_cached_users_are_copies(new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=100)
+
+    user = User.get_by_telegram_id(telegram_id)
+    user.coins = 0
+
+    assert User.get_by_telegram_id(telegram_id).coins == 100
+
+def test_debits_update_the_cached_user(new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=100)
+    User.get_by_telegram_id(telegram_id)
+
+    User.apply_delta(telegram_id, coins=-60, min_coins=60)
+
+    assert User.get_by_telegram_id(telegram_id).coins == 40
+
+def test_failed_guard_drops_the_cached_user(new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=100)
+    User.get_by_telegram_id(telegram_id)
+    # Another worker spends the coins behind this process's cache
+    storage.users.apply_delta(telegram_id, coins=-100)
+
+    assert User.apply_delta(telegram_id, coins=-60, min_coins=60) is None
+    assert user_cache.get(telegram_id) is None
+    assert User.get_by_telegram_id(telegram_id).coins == 0
@@ -0,0 +1,73 @@
+from src.models.user import User
+from src.storage import storage
+from tests.conftest import make_user
+
+def test_save_writes_only_changed_fields(new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=100)
+    user = User.get_by_telegram_id(telegram_id)
+    # Coins move elsewhere after the user was read
+    storage.users.apply_delta(telegram_id, coins=50)
+
+    user.upi_id = "wolf@upi"
+    assert user.changed_fields() == {"upi_id": "wolf@upi"}
+    user.save()
+
+    row = storage.users.get(telegram_id)
+    assert (row["coins"], row["upi_id"]) == (150, "wolf@upi")
+
+def test_saving_an_unchanged_user_is_a_no_op(new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id)
+    user = User.get_by_telegram_id(telegram_id)
+
+    assert user.changed_fields() == {}
+    assert user.save() is user
+
+def test_new_users_are_inserted_with_every_column(new_telegram_id):
+    telegram_id = new_telegram_id()
+
+    User(telegram_id=telegram_id, username="cub", coins=2500).save()
+
+    row = storage.users.get(telegram_id)
+    assert (row["username"], row["coins"], row["max_energy"]) == ("cub", 2500, 100)
+
+def test_from_row_keeps_stored_zeros():
+    user = User.from_row({
+        "telegram_id": "1", "coins": 0, "energy": 0, "max_energy": 0, "tap_power": 0,
+        "energy_regen_rate": 0, "last_energy_update": 1000
+    })
+
+    assert (user.coins, user.energy, user.max_energy, user.tap_power, user.energy_regen_rate) == (0, 0, 0, 0, 0)
+    assert user.last_energy_update == 1000
+
+def test_from_row_defaults_missing_and_null_fields():
+    user = User.from_row({"telegram_id": "1", "energy": None, "max_energy": None})
+
+    assert (user.coins, user.energy, user.max_energy, user.tap_power, user.energy_regen_rate) == (0, 100, 100, 1, 1)
+
+def test_get_many_skips_missing_users(new_telegram_id):
+    first, second, missing = new_telegram_id(), new_telegram_id(), new_telegram_id()
+    make_user(storage, first, coins=1)
+    make_user(storage, second, coins=2)
+
+    users = User.get_many([first, second, missing, first])
+
+    assert set(users) == {first, second}
+    assert (users[first].coins, users[second].coins) == (1, 2)
+
+def test_uncached_read_and_forced_columns_overwrite_a_stale_cache(new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, max_energy=100)
+    User.get_by_telegram_id(telegram_id)
+    # Changed behind the cache's back
+    storage.users.upsert(telegram_id, {"max_energy": 200})
+
+    assert User.get_by_telegram_id(telegram_id).max_energy == 100
+    user = User.get_by_telegram_id(telegram_id, use_cache=False)
+    assert user.max_energy == 200
+
+    user.max_energy = 200
+    user.save(force=("max_energy",))
+    assert storage.users.get(telegram_id)["max_energy"] == 200
+    assert user.save(force=("max_energy",)) is user
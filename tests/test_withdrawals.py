@@ -0,0 +1,56 @@
+from flask import Flask
+import pytest
+from src.routes.withdrawal import withdraw_bp
+from src.storage import storage
+from tests.conftest import make_user
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(withdraw_bp)
+    return app.test_client()
+
+def test_retry_with_idempotency_key_returns_the_first_withdrawal(client, new_telegram_id):
+    telegram_id = new_telegram_id()
+    make_user(storage, telegram_id, coins=5000)
+    request = {"telegram_id": telegram_id, "amount": 2000, "upi_id": "wolf@upi"}
+
+    first = client.post("/api/withdraw", json=request, headers={"Idempotency-Key": "attempt-1"}).get_json()
+    retry = client.post("/api/withdraw", json=request, headers={"Idempotency-Key": "attempt-1"}).get_json()
+
+    assert (first["replayed"], retry["replayed"]) == (False, True)
+    assert retry["withdrawal_id"] == first["withdrawal_id"]
+    assert storage.users.get(telegram_id)["coins"] == 3000
+
+def test_invalid_idempotency_key_is_rejected(client, new_telegram_id):
+    response = client.post("/api/withdraw", json={
+        "telegram_id": new_telegram_id(), "amount": 2000, "upi_id": "wolf@upi"
+    }, headers={"Idempotency-Key": "not a key!"})
+    assert response.status_code == 400
+
+def test_history_pages_newest_first_and_revalidates(client, new_telegram_id):
+    telegram_id = new_telegram_id()
+    for second in range(5):
+        storage.withdrawals.insert({
+            "user_id": telegram_id, "amount": 1000, "status": "pending", "created_at": f"2026-01-01 00:00:0{second}"
+        })
+
+    first = client.get(f"/api/withdrawal_history/{telegram_id}?limit=3")
+    body = first.get_json()
+    rest = client.get(f"/api/withdrawal_history/{telegram_id}?limit=3&cursor={body['next_cursor']}").get_json()
+
+    created = [withdrawal["created_at"][-1] for withdrawal in body["withdrawals"] + rest["withdrawals"]]
+    assert created == ["4", "3", "2", "1", "0"]
+    assert rest["next_cursor"] is None
+
+    unchanged = client.get(f"/api/withdrawal_history/{telegram_id}?limit=3", headers={"If-None-Match": first.headers["ETag"]})
+    assert unchanged.status_code == 304
+
+    storage.withdrawals.insert({
+        "user_id": telegram_id, "amount": 1000, "status": "pending", "created_at": "2026-01-01 00:00:09"
+    })
+    changed = client.get(f"/api/withdrawal_history/{telegram_id}?limit=3", headers={"If-None-Match": first.headers["ETag"]})
+    assert changed.status_code == 200
+
+def test_history_rejects_tampered_cursors(client, new_telegram_id):
+    assert client.get(f"/api/withdrawal_history/{new_telegram_id()}?cursor=WzEsMl0").status_code == 400
@@ -0,0 +1,91 @@
+import pytest
+import time
+from src.models.write_behind import WriteBehindBuffer
+from tests.conftest import make_user
+
+@pytest.fixture
+def make_buffer():
+    buffers = []
+
+    def make(flush_fn):
+        # The background flusher never fires during a test; tests flush explicitly
+        buffer = WriteBehindBuffer(flush_fn, enabled=True, flush_interval=3600, max_pending=10000)
+        buffers.append(buffer)
+        return buffer
+
+    yield make
+    for buffer in buffers:
+        # Drop what a test left pending instead of writing it at exit
+        buffer.flush_fn = lambda deltas, current_time: []
+        buffer.stop()
+
+def test_reservations_count_pending_energy(make_buffer):
+    buffer = make_buffer(lambda deltas, current_time: [])
+
+    assert buffer.reserve_taps("1", 60, 2, 100)[0] == 60
+    accepted, pending = buffer.reserve_taps("1", 60, 2, 100)
+
+    assert accepted == 40
+    assert (pending["coins"], pending["energy"]) == (200, 100)
+    assert buffer.reserve_taps("1", 1, 2, 100)[0] == 0
+
+def test_flush_applies_deltas_to_storage(sqlite_storage, make_buffer):
+    now = int(time.time())
+    make_user(sqlite_storage, "1", coins=10, energy=50, energy_regen_rate=0, last_energy_update=now)
+    make_user(sqlite_storage, "2", coins=0, energy=100, energy_regen_rate=0, last_energy_update=now)
+    buffer = make_buffer(lambda deltas, current_time: sqlite_storage.users.apply_tap_deltas(deltas, current_time)[1])
+
+    buffer.reserve_taps("1", 20, 1, 50)
+    buffer.reserve_taps("2", 5, 3, 100)
+    buffer.flush()
+
+    first, second = sqlite_storage.users.get("1"), sqlite_storage.users.get("2")
+    assert (first["coins"], first["energy"]) == (30, 30)
+    assert (second["coins"], second["energy"]) == (15, 95)
+    assert buffer.pending_for("1") is None
+    assert buffer.metrics()["flushed_users"] == 2
+
+def test_failed_flush_keeps_deltas_for_the_next_one(make_buffer):
+    written = []
+
+    def flaky(deltas, current_time):
+        if not written:
+            written.append(None)
+            raise RuntimeError("database unavailable")
+        written.extend(deltas)
+        return []
+
+    buffer = make_buffer(flaky)
+    buffer.reserve_taps("1", 10, 1, 100)
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+
+    # Taps made while the flush failed are merged with the requeued delta
+    buffer.reserve_taps("1", 5, 1, 100)
+    assert buffer.pending_for("1")["coins"] == 15
+
+    buffer.flush()
+    assert written[1:] == [{"telegram_id": "1", "coins": 15, "energy": 15}]
+    assert buffer.metrics()["failed_flushes"] == 1
+
+def test_partially_failed_flush_requeues_only_failures(make_buffer):
+    buffer = make_buffer(lambda deltas, current_time: [delta for delta in deltas if delta["telegram_id"] == "2"])
+    buffer.reserve_taps("1", 3, 1, 100)
+    buffer.reserve_taps("2", 4, 1, 100)
+
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+
+    assert buffer.pending_for("1") is None
+    assert buffer.pending_for("2")["coins"] == 4
+
+def test_flush_user_writes_only_that_user(make_buffer):
+    written = []
+    buffer = make_buffer(lambda deltas, current_time: written.extend(deltas))
+    buffer.reserve_taps("1", 3, 1, 100)
+    buffer.reserve_taps("2", 4, 1, 100)
+
+    buffer.flush_user("1")
+
+    assert [delta["telegram_id"] for delta in written] == ["1"]
+    assert buffer.pending_for("2") is not None